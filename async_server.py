@@ -0,0 +1,307 @@
+"""
+Asyncio Server Module
+
+This script implements an alternative engine for the server built on asyncio, selected with
+`--engine asyncio`. It reuses every command handler of FaultTolerantServer and only replaces
+the selector loops: client connections and replication traffic are served by protocol
+classes on a single event loop, instead of a selector loop in the server process and a
+second one in the internal communicator's thread.
+
+Key Features:
+- Serves clients with an asyncio Protocol per connection. Received bytes go through the
+  same frame decoder, and replies are written to the transport, which buffers whatever
+  the socket does not take right away.
+- Stops reading from a client while its transport holds too much unsent output, using the
+  pause_writing and resume_writing callbacks of the transport.
+- Runs the timers and the group commit at the end of every pass of the event loop that
+  handled requests, and sleeps until the next of them is due otherwise.
+- Runs replication as tasks on the same loop: an internal server whose protocol feeds the
+  internal communicator's message handling, and a task that connects to and pings the
+  other servers and elects the leader, which used to run in a thread of its own.
+- Keeps the snapshotter and the retention worker in their own threads, guarded by the
+  same database lock as with the selector loop. Updates and held replies sent by the
+  retention worker are written from the event loop.
+- Serves the links to the other workers of a partitioned node with a protocol of their
+  own, on the same loop.
+"""
+
+import asyncio
+import threading
+import types
+
+import framing
+import internal_communications
+import server
+
+
+class StreamConnection:
+    """
+    Socket-like wrapper of an asyncio stream to another server, so that the internal
+    communicator can send on it with sendall.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def sendall(self, payload):
+        if self.writer.is_closing() or self.reader.at_eof():
+            raise ConnectionError("connection closed")
+        self.writer.write(payload)
+
+    def close(self):
+        self.writer.close()
+
+
+class InternalProtocol(asyncio.Protocol):
+    """
+    Connection from another server, whose messages are handled by the internal
+    communicator.
+    """
+
+    def __init__(self, communicator):
+        self.communicator = communicator
+        self.data = None
+
+    def connection_made(self, transport):
+        addr = transport.get_extra_info("peername")
+        print(f"INTERNAL: Accepted connection from {addr}")
+        self.data = types.SimpleNamespace(addr=addr, inb=b"", outb=bytearray())
+
+    def data_received(self, data):
+        self.data.outb += data
+        vm = self.communicator.vm
+        with vm.db_lock:
+            self.communicator.handle_received(self, self.data)
+        # Replicated changes are persisted with the batch of the event loop, once its
+        # commit window has passed
+        vm.schedule_end_iteration()
+
+
+class AsyncInternalCommunicator(internal_communications.InternalCommunicator):
+    """
+    Internal communicator whose server and connection upkeep run as tasks on the
+    server's event loop instead of in threads.
+    """
+
+    async def serve(self):
+        """
+        Serves connections from other servers, and keeps connecting to and pinging
+        them, until cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        internal_server = await loop.create_server(
+            lambda: InternalProtocol(self), self.host, self.port, reuse_address=True
+        )
+        async with internal_server:
+            await self.update_connected_machines_async()
+
+    def distribute_update(self, update):
+        """
+        Sends an update to the other servers from the event loop, which owns their
+        streams, even when the change was made by the retention worker's thread.
+        """
+        self.vm.call_in_loop(super().distribute_update, update)
+
+    async def update_connected_machines_async(self):
+        while True:
+            connected_addrs = self.ping_connected_servers()
+
+            for addr in self.connectable_ports:
+                if addr in connected_addrs or addr == (self.host, self.port):
+                    continue
+
+                try:
+                    reader, writer = await asyncio.open_connection(*addr)
+                    self.add_connected_server(addr, StreamConnection(reader, writer))
+                except OSError:
+                    self.remove_connected_server(addr)
+
+            # Check and elect a leader if necessary
+            self.update_leader()
+
+            await asyncio.sleep(1)
+
+
+class ClientProtocol(asyncio.Protocol):
+    """
+    Connection from a client. It stands in for the client's socket in the command
+    handlers, which send replies with its send method.
+    """
+
+    def __init__(self, vm):
+        self.vm = vm
+        self.transport = None
+        self.data = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        addr = transport.get_extra_info("peername")
+        print(f"Accepted connection from {addr}")
+        self.data = self.vm.connection_data(addr)
+        # Stop reading requests while this much output is buffered
+        transport.set_write_buffer_limits(high=server.MAX_PENDING_OUTPUT)
+        with self.vm.db_lock:
+            self.vm.clients[f"{addr[0]}:{addr[1]}"] = (self, self.data)
+
+    def send(self, payload):
+        """
+        Writes a reply to the transport, which buffers it until the socket takes it.
+        """
+        if self.transport.is_closing():
+            raise ConnectionError("connection closed")
+        self.transport.write(payload)
+        return len(payload)
+
+    def data_received(self, data):
+        self.data.frames.feed(data)
+        with self.vm.db_lock:
+            self.vm.handle_received(self, self.data)
+        self.vm.schedule_end_iteration()
+
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        print(f"Closing connection to {self.data.addr}")
+        with self.vm.db_lock:
+            self.vm.end_session(self.data)
+
+
+class LinkProtocol(asyncio.Protocol):
+    """
+    Link to another worker of the same node, carrying the requests, replies and updates
+    routed between their partitions.
+    """
+
+    def __init__(self, vm, partition):
+        self.vm = vm
+        self.partition = partition
+        self.frames = framing.FrameDecoder()
+
+    def connection_made(self, transport):
+        self.vm.router.links[self.partition] = transport.write
+
+    def data_received(self, data):
+        self.frames.feed(data)
+        with self.vm.db_lock:
+            for frame in self.frames:
+                self.vm.handle_link_frame(self.partition, frame)
+        self.vm.schedule_end_iteration()
+
+    def connection_lost(self, exc):
+        print(f"{self.vm.id} : Lost the link to worker {self.partition}")
+
+
+class AsyncFaultTolerantServer(server.FaultTolerantServer):
+    """
+    FaultTolerantServer that serves clients and replication traffic from an asyncio
+    event loop.
+    """
+
+    def queue_output(self, sock, data, payload):
+        """
+        Writes a reply to the client's transport, which queues whatever the socket does
+        not take right away.
+        """
+        try:
+            sock.send(payload)
+        except ConnectionError:
+            # The client disconnected; connection_lost cleans up after it
+            pass
+
+    def send_held(self, sock, payload):
+        """
+        Sends replies that the group committer held, unless the client has disconnected
+        since. The retention worker flushes the committer from its own thread, so the
+        replies are written from the event loop.
+        """
+        self.call_in_loop(self.queue_output, sock, None, payload)
+
+    def call_in_loop(self, callback, *args):
+        """
+        Calls `callback` right away on the event loop's thread, and schedules it on
+        the loop from any other thread, as transports are not thread-safe.
+        """
+        if threading.get_ident() == self.loop_thread or self.loop.is_closed():
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def close_connection(self, sock, data):
+        """
+        Closes a client's transport; connection_lost logs out the user connected
+        through it.
+        """
+        sock.transport.close()
+
+    def schedule_end_iteration(self):
+        """
+        Ends the current iteration once the event loop has handled every event that is
+        ready, as the selector loop does after each select.
+        """
+        if self.iteration_handle is not None:
+            if not isinstance(self.iteration_handle, asyncio.TimerHandle):
+                return
+            self.iteration_handle.cancel()
+        self.iteration_handle = self.loop.call_soon(self.run_end_iteration)
+
+    def run_end_iteration(self):
+        """
+        Ends the iteration, then schedules the next one for when a group commit or
+        timer is due.
+        """
+        self.iteration_handle = None
+        with self.db_lock:
+            self.end_iteration()
+            timeout = self.next_timeout()
+        if timeout is not None:
+            self.iteration_handle = self.loop.call_later(
+                timeout, self.run_end_iteration
+            )
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.iteration_handle = None
+
+        self.internal_communicator = AsyncInternalCommunicator(
+            **self.internal_communicator_args
+        )
+        self.start_retention_worker()
+        replication = asyncio.create_task(self.internal_communicator.serve())
+
+        for partition, link in self.partition_links.items():
+            await self.loop.connect_accepted_socket(
+                lambda partition=partition: LinkProtocol(self, partition), link
+            )
+
+        # Every worker of a partitioned node listens on the same port
+        client_server = await self.loop.create_server(
+            lambda: ClientProtocol(self),
+            self.host,
+            self.port,
+            reuse_address=True,
+            reuse_port=self.router is not None,
+        )
+        print("Listening on", (self.host, self.port))
+        # Timers for messages that were stored with an expiry
+        self.schedule_end_iteration()
+        try:
+            async with client_server:
+                await replication
+        finally:
+            replication.cancel()
+
+    def run(self):
+        self.open_database()
+        self.start_workers()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print(f"{self.id} : Caught keyboard interrupt, exiting")
+        finally:
+            self.stop_workers()
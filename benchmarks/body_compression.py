@@ -0,0 +1,170 @@
+"""
+Body Compression Benchmark
+
+This script measures what compressing message bodies costs and saves, by storing the same
+chat-like messages with bodies kept in memory, appended to a body segment as they are, and
+compressed with zlib with and without a dictionary trained from earlier messages. For each
+layout it reports the bytes the bodies take on disk, the memory taken by the store, and the
+CPU time spent storing the messages and reading every body back as replies do.
+
+Run it from the repository root with:
+
+    python -m benchmarks.body_compression
+"""
+
+import gc
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import body_store
+import message_store
+
+NUM_MESSAGES = 100_000
+NUM_USERS = 1000
+
+WORDS = (
+    "the a to and you I it is that for on are with be this have at we not but can "
+    "what so if just all was do get will me my your about there out up like know "
+    "meeting tomorrow today tonight lunch dinner class homework problem set lecture "
+    "office hours deadline project server client message thanks sounds good see "
+    "later maybe sure okay yes no ping call back running late on my way"
+).split()
+PHRASES = (
+    "sounds good, see you then",
+    "are you coming to lecture today?",
+    "can we push the meeting to tomorrow?",
+    "thanks! I'll take a look tonight",
+    "did you finish the problem set yet?",
+    "on my way, running a few minutes late",
+)
+
+
+def build_bodies(num_messages, seed=2620):
+    """
+    Returns `num_messages` chat-like message bodies: common phrases, short replies and
+    longer messages made of common words.
+    """
+    rng = random.Random(seed)
+    bodies = []
+    for _ in range(num_messages):
+        kind = rng.random()
+        if kind < 0.3:
+            bodies.append(rng.choice(PHRASES))
+        elif kind < 0.5:
+            bodies.append(rng.choice(("ok", "lol", "yes", "no", "thanks!", "sure")))
+        else:
+            bodies.append(" ".join(rng.choices(WORDS, k=rng.randint(5, 40))))
+    return bodies
+
+
+def build_store(vm_id, bodies, layout):
+    """
+    Stores the given bodies as undelivered messages between NUM_USERS users, with
+    bodies kept according to `layout`.
+    """
+    segment = None
+    if layout != "inline":
+        dictionary = None
+        if layout == "zlib + dictionary":
+            # Trained from messages that are not part of the measured ones
+            dictionary = body_store.train_dictionary(
+                json.dumps(body).encode("utf-8")
+                for body in build_bodies(10_000, seed=1)
+            )
+        segment = body_store.BodySegment(
+            vm_id, compress=layout != "mmap", dictionary=dictionary
+        )
+
+    store = message_store.MessageStore(bodies=segment)
+    for msg_id, body in enumerate(bodies):
+        store.add(
+            message_store.Message(
+                msg_id,
+                f"user{msg_id % NUM_USERS}",
+                f"user{(msg_id * 7 + 1) % NUM_USERS}",
+                # A copy of its own, as if it had just been received
+                body.encode("utf-8").decode("utf-8"),
+            ),
+            "undelivered",
+        )
+    return store
+
+
+def disk_bytes(store):
+    """
+    Returns the bytes the bodies of a store take on disk: the size of its body segment,
+    or the size of the bodies encoded in a snapshot if they are kept in memory.
+    """
+    if store.bodies is not None:
+        return store.bodies.stored_bytes()
+    return sum(
+        len(msg.encoded_message())
+        for receiver in store.receivers("undelivered")
+        for msg in store.peek(receiver, store.count(receiver), "undelivered")
+    )
+
+
+def read_all(store):
+    """
+    Reads the encoded body of every message, as replies to clients do.
+    """
+    for receiver in store.receivers("undelivered"):
+        for msg in store.peek(receiver, store.count(receiver), "undelivered"):
+            bytes(msg.encoded_message())
+
+
+def measure_memory(vm_id, bodies, layout):
+    """
+    Returns the memory taken by a store of the given bodies, in MiB.
+    """
+    gc.collect()
+    tracemalloc.start()
+    store = build_store(vm_id, bodies, layout)
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del store
+    return allocated / 2**20
+
+
+def main():
+    bodies = build_bodies(NUM_MESSAGES)
+    text_bytes = sum(len(body.encode("utf-8")) for body in bodies)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            print(f"{NUM_MESSAGES} messages, {text_bytes / 2**20:.1f} MiB of text")
+            print(
+                f"{'layout':>18} {'disk (MiB)':>11} {'memory (MiB)':>13} "
+                f"{'store (s)':>10} {'read all (s)':>13}"
+            )
+            for i, layout in enumerate(("inline", "mmap", "zlib", "zlib + dictionary")):
+                # Timed without tracing allocations, which would slow it down
+                start = time.process_time()
+                store = build_store(f"time{i}", bodies, layout)
+                stored = time.process_time() - start
+
+                start = time.process_time()
+                read_all(store)
+                read = time.process_time() - start
+
+                disk = disk_bytes(store) / 2**20
+                del store
+                memory = measure_memory(f"memory{i}", bodies, layout)
+
+                print(
+                    f"{layout:>18} {disk:>11.1f} {memory:>13.1f} {stored:>10.2f} "
+                    f"{read:>13.2f}"
+                )
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Account Deletion Benchmark
+
+This script measures how long it takes to delete an account, together with every message it
+sent or received, as the number of messages belonging to other users grows. It compares the
+list filtering that the server used to perform against the indexed MessageStore.
+
+Run it from the repository root with:
+
+    python -m benchmarks.delete_account
+"""
+
+import time
+
+import message_store
+
+# Messages sent and received by the deleted account, kept fixed across runs
+TARGET_MESSAGES = 1000
+
+
+def build_messages(num_other_messages):
+    """
+    Builds an undelivered box holding `num_other_messages` messages exchanged between
+    other users, plus TARGET_MESSAGES messages sent to or from the deleted account.
+    """
+    messages = []
+    for msg_id in range(num_other_messages):
+        messages.append(
+            {
+                "id": msg_id,
+                "sender": f"user{msg_id % 1000}",
+                "receiver": f"user{(msg_id + 1) % 1000}",
+                "message": "hello",
+            }
+        )
+    for msg_id in range(num_other_messages, num_other_messages + TARGET_MESSAGES):
+        messages.append(
+            {
+                "id": msg_id,
+                "sender": "target" if msg_id % 2 else "user0",
+                "receiver": "user0" if msg_id % 2 else "target",
+                "message": "hello",
+            }
+        )
+    return messages
+
+
+def delete_with_lists(messages, acct):
+    """
+    Deletes an account's messages by filtering both boxes, as the server used to.
+    """
+    boxes = {"undelivered": messages, "delivered": []}
+    for box in boxes.values():
+        box[:] = [
+            msg_obj
+            for msg_obj in box
+            if msg_obj["sender"] != acct and msg_obj["receiver"] != acct
+        ]
+
+
+def delete_with_store(store, acct):
+    """
+    Deletes an account's messages through the sender and receiver indexes.
+    """
+    store.remove_user(acct)
+
+
+def main():
+    print(f"{'other messages':>15} {'list filter (ms)':>17} {'indexed (ms)':>13}")
+    for num_other_messages in (10_000, 100_000, 1_000_000):
+        messages = build_messages(num_other_messages)
+        store = message_store.MessageStore(undelivered=messages)
+
+        start = time.perf_counter()
+        delete_with_lists(list(messages), "target")
+        list_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        delete_with_store(store, "target")
+        store_ms = (time.perf_counter() - start) * 1000
+
+        assert store.size("undelivered") == num_other_messages
+        print(f"{num_other_messages:>15} {list_ms:>17.2f} {store_ms:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
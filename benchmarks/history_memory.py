@@ -0,0 +1,87 @@
+"""
+Delivered History Memory Benchmark
+
+This script measures how much memory the message store takes as the delivered history of
+1000 users grows, with every delivered message kept in memory and with older delivered
+messages archived to a history store on disk.
+
+Run it from the repository root with:
+
+    python -m benchmarks.history_memory
+"""
+
+import gc
+import os
+import tempfile
+import time
+import tracemalloc
+
+import history_store
+import message_store
+
+NUM_USERS = 1000
+HOT_MESSAGES = 100
+
+
+def fill_store(store, num_messages):
+    """
+    Files `num_messages` delivered messages exchanged between NUM_USERS users.
+    """
+    for msg_id in range(num_messages):
+        store.add(
+            message_store.Message(
+                msg_id,
+                f"user{msg_id % NUM_USERS}",
+                f"user{(msg_id * 7 + 1) % NUM_USERS}",
+                f"message number {msg_id}",
+            ),
+            "delivered",
+        )
+
+
+def measure(vm_id, num_messages, hot_messages):
+    """
+    Fills a store and returns the memory it holds, in MiB, along with the time it took
+    to fill it, in seconds.
+    """
+    history = None
+    if hot_messages is not None:
+        history = history_store.HistoryStore(vm_id, hot_messages=hot_messages)
+
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    store = message_store.MessageStore(history=history)
+    fill_store(store, num_messages)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del store
+    return allocated / (1024 * 1024), elapsed
+
+
+def main():
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            print(f"{NUM_USERS} users, {HOT_MESSAGES} delivered messages kept per user")
+            print(
+                f"{'messages':>10} {'all in memory (MiB)':>20} {'archived (MiB)':>15} "
+                f"{'fill, archived (s)':>19}"
+            )
+            for num_messages in (100_000, 300_000, 1_000_000):
+                in_memory, _ = measure("bench", num_messages, None)
+                archived, elapsed = measure("bench", num_messages, HOT_MESSAGES)
+                history_store.remove_old_generations("bench")
+                print(
+                    f"{num_messages:>10} {in_memory:>20.1f} {archived:>15.1f} "
+                    f"{elapsed:>19.2f}"
+                )
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Message Memory Benchmark
+
+This script measures how much memory 1M stored messages take, comparing the dictionary per
+message that the server used to keep with the slotted message records of the MessageStore.
+Messages are decoded from JSON first, as they are when a server loads its database, so every
+message starts out with its own copy of the sender and receiver names.
+
+Run it from the repository root with:
+
+    python -m benchmarks.message_memory
+"""
+
+import gc
+import json
+import time
+import tracemalloc
+
+import message_store
+
+NUM_MESSAGES = 1_000_000
+NUM_USERS = 1000
+
+
+def encode_messages(num_messages):
+    """
+    Returns the JSON encoding of `num_messages` short messages exchanged between
+    NUM_USERS users.
+    """
+    return json.dumps(
+        [
+            {
+                "id": msg_id,
+                "sender": f"user{msg_id % NUM_USERS}",
+                "receiver": f"user{(msg_id * 7 + 1) % NUM_USERS}",
+                "message": f"message number {msg_id}",
+            }
+            for msg_id in range(num_messages)
+        ]
+    )
+
+
+def measure(build):
+    """
+    Runs `build` and returns the memory still allocated by its result, in MiB, along
+    with the time it took, in seconds.
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return allocated / (1024 * 1024), elapsed
+
+
+def main():
+    encoded = encode_messages(NUM_MESSAGES)
+
+    layouts = {
+        "dict per message": lambda: json.loads(encoded),
+        "slotted records": lambda: [
+            message_store.Message.from_dict(msg_obj) for msg_obj in json.loads(encoded)
+        ],
+    }
+
+    print(f"{NUM_MESSAGES} messages from {NUM_USERS} users")
+    print(
+        f"{'layout':>17} {'memory (MiB)':>13} {'bytes/message':>14} {'build (s)':>10}"
+    )
+    for name, build in layouts.items():
+        allocated, elapsed = measure(build)
+        per_message = allocated * 1024 * 1024 / NUM_MESSAGES
+        print(f"{name:>17} {allocated:>13.1f} {per_message:>14.0f} {elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Protocol Encoding Benchmark
+
+This script compares the JSON objects of protocol version 0 with the binary encoding of
+version 1, on the requests and replies a client exchanges most often. For each of them it
+reports the bytes sent on the wire, framing included, and the time taken to encode and to
+decode one message in either version.
+
+Run it from the repository root with:
+
+    python -m benchmarks.protocol_encoding
+"""
+
+import hashlib
+import json
+import time
+
+import framing
+import protocol
+
+REPEAT = 20_000
+
+PASSWORD = hashlib.sha256(b"password").hexdigest()
+MESSAGES = [
+    {"id": 1000 + i, "sender": f"user{i}", "message": f"message number {i}"}
+    for i in range(50)
+]
+
+REQUESTS = {
+    "login": {"username": "user1", "password": PASSWORD},
+    "send_msg": {
+        "sender": "user1",
+        "recipient": "user2",
+        "message": "hello there, how are you?",
+        "ttl": None,
+    },
+    "refresh_home": {"username": "user1"},
+    "get_undelivered": {"username": "user1", "num_messages": 50},
+    "delete_msg": {"current_user": "user1", "delete_ids": list(range(1000, 1020))},
+}
+
+REPLIES = {
+    "login": {"username": "user1", "undeliv_messages": 3},
+    "refresh_home": {"undeliv_messages": 3},
+    "user_list": {"user_list": [f"user{i}" for i in range(100)]},
+    "messages": {"messages": MESSAGES},
+}
+
+
+def encode_json(command, data):
+    # Version 0 messages as the bundled client sends them, terminated by a null byte
+    message = {"version": 0, "command": command, "data": data}
+    return json.dumps(message).encode("utf-8") + framing.TERMINATOR
+
+
+def time_per_call(function, *args):
+    """
+    Returns the average time taken by a call to `function`, in microseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        function(*args)
+    return (time.perf_counter() - start) / REPEAT * 1e6
+
+
+def measure(kind, command, data, encode, decode):
+    wire_v0 = encode_json(command, data)
+    payload_v1 = encode(command, data, 1)
+    wire_v1 = framing.encode_frame(payload_v1)
+
+    print(
+        f"{kind:>7} {command:>16} {len(wire_v0):>9} {len(wire_v1):>9} "
+        f"{time_per_call(encode_json, command, data):>10.2f} "
+        f"{time_per_call(encode, command, data, 1):>10.2f} "
+        f"{time_per_call(json.loads, wire_v0[:-1]):>10.2f} "
+        f"{time_per_call(decode, payload_v1):>10.2f}"
+    )
+
+
+def main():
+    print(
+        f"{'':>7} {'command':>16} {'v0 bytes':>9} {'v1 bytes':>9} {'v0 enc us':>10} "
+        f"{'v1 enc us':>10} {'v0 dec us':>10} {'v1 dec us':>10}"
+    )
+    for command, data in REQUESTS.items():
+        measure(
+            "request", command, data, protocol.encode_request, protocol.decode_request
+        )
+    for command, data in REPLIES.items():
+        measure("reply", command, data, protocol.encode_reply, protocol.decode_reply)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Server Engines Benchmark
+
+This script compares the selectors loop with the asyncio engine, by starting a server with
+each of them and driving it from an asyncio client. It reports the latency percentiles of
+search requests sent back to back by a growing number of concurrent clients, and how many
+connections the server accepts and answers at once, up to a cap.
+
+Run it from the repository root with:
+
+    python -m benchmarks.server_engines
+"""
+
+import asyncio
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import framing
+
+HOST = "127.0.0.1"
+PORT = 52600
+INTERNAL_PORT = 62600
+DURATION = 3.0
+MAX_CONNECTIONS = 8000
+
+REQUEST = framing.encode_frame(
+    json.dumps(
+        {"version": 0, "command": "search", "data": {"search": "user1*"}}
+    ).encode()
+)
+
+
+def start_server(engine, workdir):
+    """
+    Starts a single server with the given engine in a process of its own.
+    """
+    return subprocess.Popen(
+        [
+            sys.executable,
+            os.path.abspath("main_distributed.py"),
+            "--num_servers",
+            "1",
+            "--engine",
+            engine,
+            "--host",
+            HOST,
+            "--start_server_port",
+            str(PORT),
+            "--start_internal_port",
+            str(INTERNAL_PORT),
+            "--internal_other_servers",
+            HOST,
+            "--internal_other_ports",
+            str(INTERNAL_PORT),
+            "--internal_max_ports",
+            "1",
+        ],
+        cwd=workdir,
+        env={**os.environ, "PYTHONPATH": os.getcwd()},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def stop_server(process):
+    os.killpg(process.pid, signal.SIGKILL)
+    process.wait()
+
+
+async def connect():
+    """
+    Opens a connection to the server, retrying while it starts up.
+    """
+    for _ in range(100):
+        try:
+            return await asyncio.open_connection(HOST, PORT)
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("the server did not start")
+
+
+async def request(reader, writer):
+    """
+    Sends a search request and waits for its reply.
+    """
+    writer.write(REQUEST)
+    header = await reader.readexactly(framing.FRAME_HEADER.size)
+    _, length = framing.FRAME_HEADER.unpack(header)
+    await reader.readexactly(length)
+
+
+async def measure_latency(num_clients):
+    """
+    Returns the latencies of the requests sent back to back by `num_clients` clients
+    for DURATION seconds, in seconds.
+    """
+    streams = [await connect() for _ in range(num_clients)]
+    latencies = []
+    deadline = time.perf_counter() + DURATION
+
+    async def client(reader, writer):
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            await request(reader, writer)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(client(reader, writer) for reader, writer in streams))
+    for _, writer in streams:
+        writer.close()
+    return latencies
+
+
+async def measure_connections():
+    """
+    Opens up to MAX_CONNECTIONS connections, then sends a request on each of them at
+    once. Returns how many were answered, how long opening the connections took, and
+    how long answering all of them took.
+    """
+    streams = []
+    start = time.perf_counter()
+    for _ in range(MAX_CONNECTIONS):
+        try:
+            streams.append(
+                await asyncio.wait_for(asyncio.open_connection(HOST, PORT), 5)
+            )
+        except (OSError, asyncio.TimeoutError):
+            break
+    connected = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(asyncio.wait_for(request(reader, writer), 10) for reader, writer in streams),
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - start
+    for _, writer in streams:
+        writer.close()
+    return sum(result is None for result in results), connected, elapsed
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def benchmark(engine):
+    with tempfile.TemporaryDirectory() as workdir:
+        process = start_server(engine, workdir)
+        try:
+            reader, writer = await connect()
+            # Users for the searches to match
+            for i in range(100):
+                create = {
+                    "version": 0,
+                    "command": "create",
+                    "data": {"username": f"user{i}", "password": "pass"},
+                }
+                writer.write(framing.encode_frame(json.dumps(create).encode()))
+                header = await reader.readexactly(framing.FRAME_HEADER.size)
+                await reader.readexactly(framing.FRAME_HEADER.unpack(header)[1])
+            writer.close()
+
+            for num_clients in (1, 10, 100):
+                latencies = await measure_latency(num_clients)
+                print(
+                    f"{engine:>10} {num_clients:>8} {len(latencies) / DURATION:>10.0f} "
+                    f"{percentile(latencies, 0.5) * 1000:>9.2f} "
+                    f"{percentile(latencies, 0.99) * 1000:>9.2f} "
+                    f"{percentile(latencies, 0.999) * 1000:>10.2f}"
+                )
+
+            return await measure_connections()
+        finally:
+            stop_server(process)
+
+
+def main():
+    # Each connection takes a file descriptor in both processes
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print(
+        f"{'engine':>10} {'clients':>8} {'req/s':>10} {'p50 (ms)':>9} {'p99 (ms)':>9} "
+        f"{'p999 (ms)':>10}"
+    )
+    connections = {}
+    for engine in ("selectors", "asyncio"):
+        connections[engine] = asyncio.run(benchmark(engine))
+
+    print()
+    print(
+        f"{'engine':>10} {'answered connections':>21} {'connected in (s)':>17} "
+        f"{'all answered in (s)':>20}"
+    )
+    for engine, (answered, connected, elapsed) in connections.items():
+        print(f"{engine:>10} {answered:>21} {connected:>17.2f} {elapsed:>20.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Server Workers Benchmark
+
+This script measures how client throughput scales with the number of worker processes a
+server runs with `--workers`. It starts a server with 1, 2 and 4 workers, then drives it
+from several client processes, each keeping many connections busy with refresh_home
+requests for users spread across every partition. Connections land on any worker, so most
+requests are routed to the worker owning their user: with N workers, only 1 in N of them
+is handled by the worker that received it.
+
+Throughput can only scale with the number of cores of the machine, which is printed with
+the results. Run it from the repository root with:
+
+    python -m benchmarks.server_workers
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import framing
+
+HOST = "127.0.0.1"
+PORT = 52700
+INTERNAL_PORT = 62700
+DURATION = 3.0
+CLIENT_PROCESSES = 4
+CONNECTIONS_PER_PROCESS = 25
+PIPELINE_DEPTH = 4
+NUM_USERS = 1000
+
+
+def start_server(workers, workdir):
+    """
+    Starts a single server with the given number of workers in a process of its own.
+    """
+    return subprocess.Popen(
+        [
+            sys.executable,
+            os.path.abspath("main_distributed.py"),
+            "--num_servers",
+            "1",
+            "--workers",
+            str(workers),
+            "--host",
+            HOST,
+            "--start_server_port",
+            str(PORT),
+            "--start_internal_port",
+            str(INTERNAL_PORT),
+            "--internal_other_servers",
+            HOST,
+            "--internal_other_ports",
+            str(INTERNAL_PORT),
+            "--internal_max_ports",
+            "1",
+        ],
+        cwd=workdir,
+        env={**os.environ, "PYTHONPATH": os.getcwd()},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def stop_server(process):
+    os.killpg(process.pid, signal.SIGKILL)
+    process.wait()
+    # Workers may outlive the process that started them for a moment, and the next
+    # server would share the port with them
+    while True:
+        try:
+            socket.create_connection((HOST, PORT), timeout=1).close()
+        except OSError:
+            return
+        time.sleep(0.1)
+
+
+def encode_request(command, data):
+    return framing.encode_frame(
+        json.dumps({"version": 0, "command": command, "data": data}).encode()
+    )
+
+
+async def connect():
+    """
+    Opens a connection to the server, retrying while it starts up.
+    """
+    for _ in range(100):
+        try:
+            return await asyncio.open_connection(HOST, PORT)
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("the server did not start")
+
+
+async def read_reply(reader):
+    header = await reader.readexactly(framing.FRAME_HEADER.size)
+    return await reader.readexactly(framing.FRAME_HEADER.unpack(header)[1])
+
+
+async def create_users():
+    """
+    Creates the users whose homes are refreshed, then logs them out.
+    """
+    reader, writer = await connect()
+    for i in range(NUM_USERS):
+        writer.write(
+            encode_request("create", {"username": f"user{i}", "password": "p"})
+        )
+        writer.write(encode_request("logout", {"username": f"user{i}"}))
+    for _ in range(2 * NUM_USERS):
+        await read_reply(reader)
+    writer.close()
+
+
+async def drive(process_index):
+    """
+    Keeps PIPELINE_DEPTH requests in flight on each connection of this process for
+    DURATION seconds, and returns the number of requests answered.
+    """
+    streams = [await connect() for _ in range(CONNECTIONS_PER_PROCESS)]
+    deadline = time.perf_counter() + DURATION
+    answered = 0
+
+    async def client(index, reader, writer):
+        nonlocal answered
+        username = (
+            f"user{(process_index * CONNECTIONS_PER_PROCESS + index) % NUM_USERS}"
+        )
+        request = encode_request("refresh_home", {"username": username})
+        writer.write(request * PIPELINE_DEPTH)
+        while time.perf_counter() < deadline:
+            await read_reply(reader)
+            answered += 1
+            writer.write(request)
+
+    await asyncio.gather(
+        *(
+            client(index, reader, writer)
+            for index, (reader, writer) in enumerate(streams)
+        )
+    )
+    for _, writer in streams:
+        writer.close()
+    return answered
+
+
+def run_client(process_index):
+    return asyncio.run(drive(process_index))
+
+
+def benchmark(workers):
+    with tempfile.TemporaryDirectory() as workdir:
+        process = start_server(workers, workdir)
+        try:
+            asyncio.run(create_users())
+            with multiprocessing.Pool(CLIENT_PROCESSES) as pool:
+                answered = sum(pool.map(run_client, range(CLIENT_PROCESSES)))
+            return answered / DURATION
+        finally:
+            stop_server(process)
+
+
+def main():
+    print(f"cores: {os.cpu_count()}")
+    print(f"{'workers':>8} {'req/s':>10} {'speedup':>8}")
+    baseline = None
+    for workers in (1, 2, 4):
+        throughput = benchmark(workers)
+        baseline = baseline or throughput
+        print(f"{workers:>8} {throughput:>10.0f} {throughput / baseline:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
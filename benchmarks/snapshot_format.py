@@ -0,0 +1,109 @@
+"""
+Snapshot Format Benchmark
+
+This script compares the JSON document of nested dictionaries that snapshots and full-state
+syncs used to be encoded as with the binary snapshot format, on a database holding a growing
+number of messages exchanged between 1000 users. For each format it reports the size of the
+snapshot and the time taken to encode the message store into it and to decode every message
+back out of it.
+
+Run it from the repository root with:
+
+    python -m benchmarks.snapshot_format
+"""
+
+import json
+import time
+
+import message_store
+import snapshot_format
+
+NUM_USERS = 1000
+
+
+def build_store(num_messages):
+    """
+    Returns a store holding `num_messages` messages exchanged between NUM_USERS users,
+    half of them delivered.
+    """
+    store = message_store.MessageStore()
+    for msg_id in range(num_messages):
+        store.add(
+            message_store.Message(
+                msg_id,
+                f"user{msg_id % NUM_USERS}",
+                f"user{(msg_id * 7 + 1) % NUM_USERS}",
+                f"message number {msg_id}",
+            ),
+            "delivered" if msg_id % 2 else "undelivered",
+        )
+    return store
+
+
+def measure(encode, decode):
+    """
+    Returns the size of the encoded snapshot, and the time taken to encode and decode
+    it, in seconds.
+    """
+    start = time.perf_counter()
+    encoded = encode()
+    encoded_in = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decode(encoded)
+    decoded_in = time.perf_counter() - start
+    return len(encoded), encoded_in, decoded_in
+
+
+def measure_formats(store, tables):
+    """
+    Returns the (format, (size, encode time, decode time)) of a snapshot of `store` and
+    the other `tables` in either format.
+    """
+
+    def encode_document():
+        # As sent by older versions: every message as a dictionary
+        document = {**tables, "messages": store.to_dict()}
+        return json.dumps(document).encode("utf-8")
+
+    def encode_snapshot():
+        return snapshot_format.dumps({**tables, "messages": store.export()})
+
+    def decode_snapshot(encoded):
+        decoded = snapshot_format.loads(encoded)
+        for _, _, _, senders, _, _, data in decoded["messages"]["mailboxes"]:
+            message_store.decode_mailbox(data, senders)
+
+    return [
+        ("json", measure(encode_document, json.loads)),
+        ("binary", measure(encode_snapshot, decode_snapshot)),
+    ]
+
+
+def main():
+    tables = {
+        "users": {f"user{i}": {"password": "pass"} for i in range(NUM_USERS)},
+        "settings": {"counter": 0},
+        "sessions": {
+            f"user{i}": f"127.0.0.1:{50000 + i}" for i in range(0, NUM_USERS, 10)
+        },
+    }
+
+    print(f"{NUM_USERS} users")
+    print(
+        f"{'messages':>10} {'format':>7} {'size (MiB)':>11} {'encode (s)':>11} "
+        f"{'decode (s)':>11}"
+    )
+    for num_messages in (100_000, 300_000, 1_000_000):
+        # The store is only referenced by the call, so it is freed before the next
+        # one is built
+        results = measure_formats(build_store(num_messages), tables)
+        for name, (size, encoded_in, decoded_in) in results:
+            print(
+                f"{num_messages:>10} {name:>7} {size / 2**20:>11.1f} "
+                f"{encoded_in:>11.2f} {decoded_in:>11.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Startup Benchmark
+
+This script measures how long a server takes to load a database holding a growing number of
+messages exchanged between 1000 users, comparing the single JSON document that the messages
+table used to be stored as with the per-mailbox layout that is decoded on demand. It also
+times the first request that touches a mailbox after the load.
+
+Run it from the repository root with:
+
+    python -m benchmarks.startup
+"""
+
+import os
+import tempfile
+import time
+
+import database_wrapper
+import message_store
+
+NUM_USERS = 1000
+
+
+def build_store(num_messages):
+    """
+    Returns a store holding `num_messages` undelivered messages exchanged between
+    NUM_USERS users.
+    """
+    store = message_store.MessageStore()
+    for msg_id in range(num_messages):
+        store.add(
+            message_store.Message(
+                msg_id,
+                f"user{msg_id % NUM_USERS}",
+                f"user{(msg_id * 7 + 1) % NUM_USERS}",
+                f"message number {msg_id}",
+            ),
+            "undelivered",
+        )
+    return store
+
+
+def measure_load(vm_id):
+    """
+    Loads the database and returns the time it took, along with the time the first
+    count and fetch of a single mailbox took afterwards, in seconds.
+    """
+    start = time.perf_counter()
+    _, messages, _ = database_wrapper.load_database(vm_id)
+    loaded = time.perf_counter() - start
+
+    start = time.perf_counter()
+    messages.count("user1")
+    messages.peek("user1", 10, "undelivered")
+    first_request = time.perf_counter() - start
+    return loaded, first_request
+
+
+def main():
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            users = {f"user{i}": {"password": "pass"} for i in range(NUM_USERS)}
+            settings = {"counter": 0}
+            results = []
+            for num_messages in (100_000, 300_000, 1_000_000):
+                store = build_store(num_messages)
+
+                # The single document layout of older versions is still loaded, by
+                # decoding every message up front
+                database_wrapper.save_database(
+                    "bench", users, {"mailboxes": []}, settings
+                )
+                os.remove(database_wrapper.messages_database_path("bench"))
+                database_wrapper.write_json_atomically(
+                    database_wrapper.legacy_messages_database_path("bench"),
+                    store.to_dict(),
+                )
+                document = measure_load("bench")
+
+                database_wrapper.save_database(
+                    "bench", users, store.snapshot(), settings
+                )
+                mailboxes = measure_load("bench")
+                del store
+
+                results.append((num_messages, document, mailboxes))
+
+            print(f"{NUM_USERS} users")
+            print(
+                f"{'messages':>10} {'document load (s)':>18} {'mailbox load (s)':>17} "
+                f"{'first request (ms)':>19}"
+            )
+            for num_messages, document, mailboxes in results:
+                print(
+                    f"{num_messages:>10} {document[0]:>18.2f} {mailboxes[0]:>17.2f} "
+                    f"{mailboxes[1] * 1000:>19.2f}"
+                )
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+Body Store Module
+
+This script implements append-only segment files for message bodies. Bodies are the bulk of
+the stored data, so instead of keeping them as Python strings and encoding them again on
+every snapshot, each body is encoded once, appended to a segment file, and read back
+through a memory mapping of that file.
+
+Key Features:
+- Appends each body to the segment as an encoded JSON string, so that replies can copy
+  it into their payload as is, straight from the mapping.
+- Refers to bodies by offset and length, so snapshots store a small reference instead of
+  the body itself and loading them does not decode any body.
+- Maps the segment with mmap and only remaps it once it has grown past the mapped size.
+- Starts a new generation of the segment whenever the store is built from scratch or
+  compacted, so the segment referenced by the snapshot on disk is never overwritten.
+- Optionally compresses bodies with raw zlib streams, primed with a dictionary of strings
+  that are frequent in existing messages, and only decompresses a body when it is read.
+  Bodies that do not shrink are stored as they are, so segments can mix both. A segment
+  started without any message to train a dictionary from trains one from the first
+  bodies appended to it, and compresses the bodies appended after them with it.
+"""
+
+import json
+import mmap
+import os
+import re
+import zlib
+from collections import Counter
+
+bodies_database_path = lambda id, g: f"database/bodies_{id}_{g}.dat"  # noqa: E731
+dictionary_path = lambda id, g: f"database/bodies_{id}_{g}.zdict"  # noqa: E731
+
+# Encoded JSON strings start with a quote, so these bytes mark compressed bodies instead,
+# compressed with the dictionary of the segment, or before the segment had one
+COMPRESSED = b"\x00"
+COMPRESSED_WITHOUT_DICTIONARY = b"\x01"
+# zlib only looks back this far, so a longer dictionary would not help
+MAX_DICTIONARY_BYTES = 32 * 1024
+# Number of bodies compressed without a dictionary before one is trained from them
+DICTIONARY_SAMPLES = 1024
+# Raw deflate streams, without the zlib header and checksum that would make up most of a
+# short compressed body
+WBITS = -15
+
+
+def list_generations(vm_id):
+    """
+    Returns the generation numbers of the body segments on disk, in ascending order.
+    """
+    if not os.path.exists("database"):
+        return []
+
+    prefix = f"bodies_{vm_id}_"
+    generations = []
+    for filename in os.listdir("database"):
+        if filename.startswith(prefix) and filename.endswith(".dat"):
+            generation = filename[len(prefix) : -len(".dat")]
+            if generation.isdigit():
+                generations.append(int(generation))
+    return sorted(generations)
+
+
+def remove_old_generations(vm_id, generation=None):
+    """
+    Deletes the body segments older than `generation`, or every body segment if
+    `generation` is None.
+    """
+    for old_generation in list_generations(vm_id):
+        if generation is None or old_generation < generation:
+            os.remove(bodies_database_path(vm_id, old_generation))
+            if os.path.exists(dictionary_path(vm_id, old_generation)):
+                os.remove(dictionary_path(vm_id, old_generation))
+
+
+def train_dictionary(samples, size=MAX_DICTIONARY_BYTES):
+    """
+    Builds a compression dictionary of at most `size` bytes from encoded sample bodies,
+    out of the words, and short bodies, that save the most bytes across the samples.
+    The most valuable strings are placed last, where matches are cheapest to encode.
+    Returns None if nothing occurs more than once.
+    """
+    counts = Counter()
+    for sample in samples:
+        sample = bytes(sample)
+        if len(sample) <= 64:
+            counts[sample] += 1
+        counts.update(re.findall(rb"\s*[^\s\"]+", sample))
+
+    strings = []
+    total = 0
+    for string, count in sorted(
+        counts.items(), key=lambda item: item[1] * len(item[0]), reverse=True
+    ):
+        if count < 2:
+            break
+        if total + len(string) > size:
+            continue
+        strings.append(string)
+        total += len(string)
+
+    if not strings:
+        return None
+    return b"".join(reversed(strings))
+
+
+class Body:
+    """
+    Reference to the body of a message stored in a body segment.
+    """
+
+    __slots__ = ("segment", "offset", "length")
+
+    def __init__(self, segment, offset, length):
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+
+    def raw(self):
+        """
+        Returns the body as an encoded JSON string, as a view of the segment mapping, or
+        decompressed if it is stored compressed.
+        """
+        return self.segment.decode(self.segment.read(self.offset, self.length))
+
+    def __str__(self):
+        return json.loads(bytes(self.raw()))
+
+    def __repr__(self):
+        return f"Body(offset={self.offset!r}, length={self.length!r})"
+
+
+class BodySegment:
+    """
+    Append-only file of message bodies, read through a memory mapping.
+
+    With `compress`, appended bodies are compressed with zlib, primed with `dictionary`
+    if given. The dictionary of a generation is stored next to it when the segment is
+    created, and can never change afterwards, as the bodies compressed with it depend on
+    it. Compressed bodies are read back whether or not `compress` is set.
+    """
+
+    def __init__(self, vm_id, generation=None, compress=False, dictionary=None):
+        self.vm_id = vm_id
+
+        if generation is None:
+            generation = max(list_generations(vm_id) + [-1]) + 1
+        self.generation = generation
+        self.path = bodies_database_path(vm_id, generation)
+
+        self.compress = compress
+        self.dictionary = dictionary
+        if dictionary is not None and not os.path.exists(self.path):
+            self._write_dictionary()
+
+        # Bodies appended while compressing without a dictionary, which one is trained
+        # from once there are DICTIONARY_SAMPLES of them
+        self.untrained = []
+
+        self._file = None
+        self._map = None
+        self._pid = None
+
+    @classmethod
+    def from_dict(cls, vm_id, bodies, compress=False, dictionary=None):
+        """
+        Opens the segment described by to_dict, or a new, empty segment primed with
+        `dictionary` if `bodies` is None.
+        """
+        if bodies is None:
+            return cls(vm_id, compress=compress, dictionary=dictionary)
+
+        dictionary = None
+        path = dictionary_path(vm_id, bodies["generation"])
+        # The segment may have been primed with a dictionary after the snapshot was taken
+        if bodies.get("dictionary") or os.path.exists(path):
+            with open(path, "rb") as dictionary_file:
+                dictionary = dictionary_file.read()
+        return cls(
+            vm_id,
+            generation=bodies["generation"],
+            compress=compress,
+            dictionary=dictionary,
+        )
+
+    def to_dict(self):
+        """
+        Returns the description of the segment, to be stored in a snapshot.
+        """
+        bodies = {"generation": self.generation}
+        if self.dictionary is not None:
+            bodies["dictionary"] = True
+        return bodies
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_file"] = None
+        state["_map"] = None
+        state["_pid"] = None
+        return state
+
+    def _write_dictionary(self):
+        if not os.path.exists("database"):
+            os.makedirs("database")
+        with open(
+            dictionary_path(self.vm_id, self.generation), "wb"
+        ) as dictionary_file:
+            dictionary_file.write(self.dictionary)
+            dictionary_file.flush()
+            os.fsync(dictionary_file.fileno())
+
+    @property
+    def file(self):
+        if self._file is None or self._pid != os.getpid():
+            if not os.path.exists("database"):
+                os.makedirs("database")
+            # Kept open between appends, and closed by close
+            self._file = open(self.path, "ab")  # noqa: SIM115
+            self._pid = os.getpid()
+        return self._file
+
+    def close(self):
+        """
+        Closes the file bodies are appended to, once nothing is appended to this
+        generation anymore. Bodies can still be read through the mapping.
+        """
+        if self._file is not None and self._pid == os.getpid():
+            self._file.close()
+        self._file = None
+        self._pid = None
+
+    def new_generation(self, dictionary=None):
+        """
+        Returns an empty segment of a newer generation, primed with `dictionary`, to
+        compact this one into.
+        """
+        return BodySegment(
+            self.vm_id,
+            generation=max(list_generations(self.vm_id) + [self.generation]) + 1,
+            compress=self.compress,
+            dictionary=dictionary,
+        )
+
+    def stored_bytes(self):
+        """
+        Returns the size of the segment file, including bodies that are no longer used.
+        """
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def append(self, text):
+        """
+        Appends a body to the segment and returns a reference to it.
+        """
+        return self.append_encoded(json.dumps(text, ensure_ascii=False).encode("utf-8"))
+
+    def append_encoded(self, encoded):
+        """
+        Appends a body that is already encoded as a JSON string, and returns a reference
+        to it.
+        """
+        if self.compress:
+            if self.dictionary is not None:
+                compressor = zlib.compressobj(wbits=WBITS, zdict=self.dictionary)
+                marker = COMPRESSED
+            else:
+                compressor = zlib.compressobj(wbits=WBITS)
+                marker = COMPRESSED_WITHOUT_DICTIONARY
+                self.train(encoded)
+            compressed = compressor.compress(encoded) + compressor.flush()
+            if len(compressed) + len(marker) < len(encoded):
+                encoded = marker + compressed
+
+        body_file = self.file
+        offset = body_file.tell()
+        # Bodies are separated by newlines so that the segment stays readable
+        body_file.write(encoded)
+        body_file.write(b"\n")
+        body_file.flush()
+        return Body(self, offset, len(encoded))
+
+    def train(self, sample):
+        """
+        Keeps a body appended without a dictionary, and primes the segment with a
+        dictionary trained from the first DICTIONARY_SAMPLES of them. The bodies already
+        in the segment stay as they are.
+        """
+        if self.untrained is None:
+            return
+        self.untrained.append(bytes(sample))
+        if len(self.untrained) < DICTIONARY_SAMPLES:
+            return
+
+        self.dictionary = train_dictionary(self.untrained)
+        # Only ever trained once per segment, even if nothing was worth a dictionary
+        self.untrained = None
+        if self.dictionary is not None:
+            self._write_dictionary()
+
+    def ref(self, offset, length):
+        """
+        Returns a reference to a body that was appended earlier.
+        """
+        return Body(self, offset, length)
+
+    def decode(self, stored):
+        """
+        Returns a stored body as an encoded JSON string, decompressing it if needed.
+        """
+        marker = stored[:1]
+        if marker == COMPRESSED:
+            decompressor = zlib.decompressobj(wbits=WBITS, zdict=self.dictionary)
+        elif marker == COMPRESSED_WITHOUT_DICTIONARY:
+            decompressor = zlib.decompressobj(wbits=WBITS)
+        else:
+            return stored
+        return decompressor.decompress(stored[1:]) + decompressor.flush()
+
+    def read(self, offset, length):
+        """
+        Returns a view of `length` bytes of the segment starting at `offset`, without
+        copying them.
+        """
+        if self._map is None or offset + length > len(self._map):
+            # Views of the previous mapping keep it alive until they are released
+            with open(self.path, "rb") as body_file:
+                self._map = mmap.mmap(body_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._map)[offset : offset + length]
@@ -7,6 +7,10 @@ from the server.
 
 Key Features:
 - Uses JSON-based communication with the server instead of plain text commands.
+- Negotiates the compact binary protocol version 1 with each server it connects to, and
+  falls back to JSON with servers that do not support it.
+- Receives the messages servers push to logged in users over version 1 connections, and
+  shows them on the home screen as they arrive instead of waiting for a refresh.
 - Supports user authentication (signup, login).
 - Manages different UI states: home, messages, user list.
 - Receives server responses as JSON objects, allowing structured data handling.
@@ -22,7 +26,7 @@ import screens_json.signup
 import screens_json.home
 import screens_json.messages
 import screens_json.user_list
-import json
+import protocol
 import argparse
 import time
 import threading
@@ -76,10 +80,8 @@ def update_socket_thread(hosts, ports, num_ports):
 
         for addr, conn in connected_servers:
             try:
-                conn.sendall(
-                    f"{json.dumps({'version': 0, 'command': 'check_connection', 'data': {}})}\0".encode(
-                        "utf-8"
-                    )
+                conn.send_request(
+                    {"version": 0, "command": "check_connection", "data": {}}
                 )
                 connected_addrs.append(addr)
             except Exception:
@@ -102,7 +104,9 @@ def update_socket_thread(hosts, ports, num_ports):
                         break
 
                 if not found_addr:
-                    connected_servers.append((addr, s))
+                    conn = protocol.Connection(s)
+                    conn.negotiate()
+                    connected_servers.append((addr, conn))
             except Exception:
                 for ind, (saved_addr, conn) in enumerate(connected_servers):
                     if saved_addr == addr:
@@ -164,14 +168,13 @@ def connect_socket(hosts, ports, num_ports):
                 messagebox.showerror("Error", "Could not connect to server!")
                 break
 
-            data = s.recv(1024)
-            json_data = json.loads(data.decode("utf-8"))
+            json_data = s.recv_reply()
             version = json_data["version"]
             command = json_data["command"]
             command_data = json_data["data"]
 
             # Handle different server commands
-            if version != 0:
+            if version not in protocol.VERSIONS:
                 print("Error: mismatch of API version!")
                 messagebox.showerror("Error", "Mismatch of API version!")
             elif command == "login":
@@ -0,0 +1,110 @@
+"""
+Command Table Module
+
+This script implements the tables that servers dispatch commands through. Every command
+is registered once with the function that handles it, which is passed the request after it
+has been decoded, and every call to it is counted and timed.
+
+Key Features:
+- Finds the handler of a command with a single dictionary lookup, instead of comparing the
+  command with every known one in turn.
+- Records the time spent in the handler of every command in a histogram of power-of-two
+  buckets of microseconds, which takes a few integer operations per call and a fixed
+  amount of memory however many calls are made.
+- Reports the number of calls, mean, approximate percentiles and histogram of every
+  command as a dictionary, which servers send to clients with the "stats" command.
+"""
+
+import time
+
+# Bucket i counts the calls that took less than 2**i microseconds and at least half as
+# long. The last bucket also counts every longer call, from about 4 seconds
+NUM_BUCKETS = 23
+
+
+class LatencyHistogram:
+    """
+    Number of calls to a command, and how long they took.
+    """
+
+    __slots__ = ("calls", "total", "buckets")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.buckets = [0] * NUM_BUCKETS
+
+    def record(self, seconds: float):
+        self.calls += 1
+        self.total += seconds
+        self.buckets[min(int(seconds * 1e6).bit_length(), NUM_BUCKETS - 1)] += 1
+
+    def percentile(self, fraction: float):
+        """
+        Returns the upper bound, in microseconds, of the bucket holding the given
+        fraction of the calls, or 0 if no call was made.
+        """
+        rank = fraction * self.calls
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return 2**bucket
+        return 0
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "mean_us": round(self.total / self.calls * 1e6, 1) if self.calls else 0,
+            "p50_us": self.percentile(0.5),
+            "p99_us": self.percentile(0.99),
+            # Upper bound of each bucket in microseconds -> calls, for non-empty ones
+            "histogram": {
+                str(2**bucket): count
+                for bucket, count in enumerate(self.buckets)
+                if count
+            },
+        }
+
+
+class CommandTable:
+    """
+    Handlers of the commands a server accepts from one kind of peer, and the latency of
+    the calls made to each of them.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.latencies = {}
+
+    def register(self, command: str, handler):
+        self.handlers[command] = handler
+        self.latencies[command] = LatencyHistogram()
+
+    def __contains__(self, command):
+        return command in self.handlers
+
+    def handle(self, command, *args):
+        """
+        Calls the handler of `command` with `args`, timing the call. Returns False,
+        without calling anything, if no handler is registered for it.
+        """
+        handler = self.handlers.get(command) if isinstance(command, str) else None
+        if handler is None:
+            return False
+        start = time.perf_counter()
+        try:
+            handler(*args)
+        finally:
+            self.latencies[command].record(time.perf_counter() - start)
+        return True
+
+    def stats(self):
+        """
+        Returns the statistics of every command that has been called at least once.
+        """
+        return {
+            command: histogram.to_dict()
+            for command, histogram in self.latencies.items()
+            if histogram.calls
+        }
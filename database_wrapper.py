@@ -1,115 +1,660 @@
 """
 Database Management Module
 
-This script manages user, message, and settings databases stored in JSON files. It ensures
-that required directories exist, handles missing or corrupted files gracefully, and resets
-specific user fields upon loading.
+This script manages user, message, and settings databases stored in binary snapshot files
+(see snapshot_format), falling back to the JSON files of older versions. It ensures
+that required directories exist and handles missing or corrupted files gracefully, without
+writing anything back while loading. Individual mutations are appended to a write-ahead log
+so that the cost of persisting a change is proportional to the change itself, and the table
+files are periodically rewritten as a snapshot in the background so the log stays short.
 
 Key Features:
 - Automatically creates the database directory if it does not exist.
-- Loads JSON-based databases safely, initializing default values when necessary.
-- Resets user login states and address fields on startup to ensure consistency.
-- Supports structured message storage with separate lists for undelivered and delivered messages.
+- Loads tables safely, falling back to default values for missing or corrupted files
+  without rewriting them.
+- Keeps user records free of session state (login status and address), which lives only
+  in the memory of the running server, so nothing has to be reset on startup.
+- Supports structured message storage with separate lists for undelivered and delivered messages,
+  loaded into a MessageStore of compact message records.
+- Optionally archives older delivered messages to a history store on disk; a snapshot of the
+  messages table then only holds the page index of the archived messages.
+- Optionally keeps message bodies in a memory-mapped body segment; a snapshot of the messages
+  table then refers to each body by offset, so loading it does not decode any body.
+- Writes each table as a binary snapshot, the messages table as one record per mailbox
+  holding a small header and its encoded messages, and loads it through a memory mapping
+  by decoding the headers only; mailboxes are decoded on first use.
+- Reports how long loading each table and replaying the log took.
 - Maintains a settings file for application-wide configuration values.
+- Appends one compact JSON record per mutation to a write-ahead log and replays the log
+  on load, so the table files only need to be rewritten on a full save.
+- Splits the log into numbered segments; a snapshot of the tables records the first
+  segment it does not cover, and the segments before it are deleted.
+- Provides a background snapshotter that takes snapshots based on a time interval or the
+  size of the log, whichever comes first.
+- Tracks which tables the logged mutations touched, so a snapshot only rewrites the tables
+  that changed since the previous one.
 
 Last Updated: February 12, 2025
 """
 
+import gc
 import json
+import mmap
 import os
+import threading
+import time
 
+import body_store
+import history_store
+import message_store
+import snapshot_format
 
 # Define database file paths
-users_database_path = lambda id: f"database/users_{id}.json"  # noqa: E731
-messages_database_path = lambda id: f"database/messages_{id}.json"  # noqa: E731
-settings_database_path = lambda id: f"database/settings_{id}.json"  # noqa: E731
+users_database_path = lambda id: f"database/users_{id}.snap"  # noqa: E731
+messages_database_path = lambda id: f"database/messages_{id}.snap"  # noqa: E731
+settings_database_path = lambda id: f"database/settings_{id}.snap"  # noqa: E731
+# Tables written by older versions, loaded when there is no snapshot of them yet
+legacy_users_database_path = lambda id: f"database/users_{id}.json"  # noqa: E731
+legacy_messages_database_path = lambda id: f"database/messages_{id}.json"  # noqa: E731
+legacy_settings_database_path = lambda id: f"database/settings_{id}.json"  # noqa: E731
+log_database_path = lambda id, seg: f"database/log_{id}_{seg}.jsonl"  # noqa: E731
+manifest_database_path = lambda id: f"database/manifest_{id}.json"  # noqa: E731
+
+# Write-ahead log state, keyed by VM ID: the segment currently appended to, its open
+# file handle, and the number of bytes logged since the last rotation
+_log_segments = {}
+_log_files = {}
+_log_bytes = {}
+
+# Tables changed since the last rotation of the write-ahead log, keyed by VM ID
+_dirty_tables = {}
+# Tables changed in the log segments rotated out since the last snapshot that was
+# written, keyed by VM ID
+_rotated_tables = {}
+
+# Tables touched by each write-ahead log operation
+LOG_OPERATION_TABLES = {
+    "put_user": ("users",),
+    "delete_user": ("users", "messages"),
+    "add_message": ("messages", "settings"),
+    "deliver_messages": ("messages",),
+    "delete_messages": ("messages",),
+    "expire_message": ("messages",),
+}
+
+# Serializes snapshot writes so that an older snapshot never overwrites a newer one
+_snapshot_lock = threading.Lock()
+
+# Seconds spent loading each table and replaying the log at the last load, keyed by VM ID
+load_timings = {}
 
 
 def safe_load(filepath, default_value):
     """
-    Safely loads a JSON file. If the file is missing or contains invalid JSON, it
-    initializes the file with a default value and returns that instead.
+    Safely loads a JSON file. If the file is missing or contains invalid JSON, the
+    default value is returned instead. The file is left as it is; it is only replaced
+    by the next snapshot.
     """
     try:
         with open(filepath, "r") as file:
             return json.load(file)
-    except (json.JSONDecodeError, FileNotFoundError):
-        with open(filepath, "w") as file:
-            json.dump(default_value, file)
+    except FileNotFoundError:
+        return default_value
+    except json.JSONDecodeError:
+        print(f"Could not decode {filepath}, using default values")
+        return default_value
+
+
+def load_table(filepath, table, default_value):
+    """
+    Loads a table from a binary snapshot file through a memory mapping, so that the
+    encoded mailboxes of the messages table are views of the mapping and are not
+    decoded. If the file is missing, empty or corrupted, the default value is returned
+    instead, and the file is left as it is.
+    """
+    try:
+        with open(filepath, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return snapshot_format.read_tables(mapped)[table]
+    except FileNotFoundError:
+        return default_value
+    except ValueError:
+        print(f"Could not decode {filepath}, using default values")
         return default_value
 
 
-def load_database(vm_id):
+def load_users_table(vm_id):
+    """
+    Loads the users table, from the JSON file of older versions if it has no snapshot.
+    """
+    if not os.path.exists(users_database_path(vm_id)):
+        return safe_load(legacy_users_database_path(vm_id), {})
+    return load_table(users_database_path(vm_id), "users", {})
+
+
+def load_settings_table(vm_id):
+    """
+    Loads the settings table, from the JSON file of older versions if it has no
+    snapshot.
+    """
+    default_settings = {
+        "counter": 0,
+        "host": "127.0.0.1",
+        "port": 54400,
+        "host_json": "127.0.0.1",
+        "port_json": 54444,
+    }
+    if not os.path.exists(settings_database_path(vm_id)):
+        return safe_load(legacy_settings_database_path(vm_id), default_settings)
+    return load_table(settings_database_path(vm_id), "settings", default_settings)
+
+
+def load_messages_table(vm_id):
+    """
+    Loads the messages table without decoding any message, from the JSON file of older
+    versions if it has no snapshot, and as an empty table if no file can be read.
+    """
+    empty = {"undelivered": [], "delivered": []}
+    if os.path.exists(messages_database_path(vm_id)):
+        return load_table(messages_database_path(vm_id), "messages", empty)
+    return safe_load(legacy_messages_database_path(vm_id), empty)
+
+
+def _report_load_time(vm_id, table, entries, start):
+    """
+    Records and prints the time spent loading a table since `start`.
+    """
+    elapsed = time.perf_counter() - start
+    load_timings.setdefault(vm_id, {})[table] = elapsed
+    print(f"{vm_id}: loaded {table} ({entries} entries) in {elapsed * 1000:.1f} ms")
+
+
+def load_database(
+    vm_id, hot_messages=None, cache_pages=64, mmap_bodies=False, compress_bodies=False
+):
     """
-    Loads user, message, and settings databases from JSON files.
+    Loads user, message, and settings databases from JSON files, then replays the
+    write-ahead log on top of them. With `hot_messages`, only that many delivered
+    messages per user are kept in memory and older ones are archived to disk, with up to
+    `cache_pages` pages of them cached. With `mmap_bodies`, message bodies are kept in a
+    memory-mapped body segment, compressed with zlib if `compress_bodies` is set.
     """
+    # Loading only allocates objects that stay alive, so there is nothing for the cyclic
+    # garbage collector to find while it runs
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _load_database(
+            vm_id, hot_messages, cache_pages, mmap_bodies, compress_bodies
+        )
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _load_database(vm_id, hot_messages, cache_pages, mmap_bodies, compress_bodies):
     users, messages, settings = None, None, None
+    load_timings[vm_id] = {}
 
     # Create the database folder if it does not exist
     if not os.path.exists("database"):
         os.makedirs("database")
 
     # Load users with safe default
-    users = safe_load(users_database_path(vm_id), {})
+    start = time.perf_counter()
+    users = load_users_table(vm_id)
+    _report_load_time(vm_id, "users", len(users), start)
 
-    for user in users:
-        if users[user]["logged_in"]:
-            users[user]["logged_in"] = False
-            users[user]["addr"] = None
-
-    # Load messages with safe default
-    messages = safe_load(
-        messages_database_path(vm_id), {"undelivered": [], "delivered": []}
+    # Load messages with safe default. Mailboxes are only decoded once they are used
+    start = time.perf_counter()
+    messages = build_message_store(
+        vm_id,
+        load_messages_table(vm_id),
+        hot_messages,
+        cache_pages,
+        mmap_bodies,
+        compress_bodies,
+    )
+    _report_load_time(
+        vm_id,
+        "messages",
+        messages.size("undelivered") + messages.size("delivered"),
+        start,
     )
 
     # Load settings with safe default
-    settings = safe_load(
-        settings_database_path(vm_id),
-        {
-            "counter": 0,
-            "host": "127.0.0.1",
-            "port": 54400,
-            "host_json": "127.0.0.1",
-            "port_json": 54444,
-        },
-    )
+    start = time.perf_counter()
+    settings = load_settings_table(vm_id)
+    _report_load_time(vm_id, "settings", len(settings), start)
+
+    # Bring the tables up to date with the mutations logged since the last snapshot, and
+    # direct new records to a fresh segment in case the last one ends in a torn record
+    start = time.perf_counter()
+    records = read_log(vm_id, snapshot_log_segment(vm_id))
+    apply_log_records(records, users, messages, settings)
+    _report_load_time(vm_id, "log", len(records), start)
+    _close_log(vm_id)
+    _log_segments[vm_id] = _next_log_segment(vm_id)
+
+    # The replayed records are only on disk in the log, so the next snapshot has to
+    # write out the tables they touched
+    _dirty_tables[vm_id] = set()
+    _rotated_tables[vm_id] = set()
+    mark_dirty(vm_id, records)
 
     return users, messages, settings
 
 
-def load_client_database(vm_id):
+def build_message_store(
+    vm_id,
+    messages,
+    hot_messages=None,
+    cache_pages=64,
+    mmap_bodies=False,
+    compress_bodies=False,
+):
+    """
+    Builds a MessageStore from the plain layout of the messages table, or from the
+    per-mailbox layout of a snapshot, whose mailboxes are added without being decoded.
+    The archived messages and body segment of a snapshot are kept on disk, and a history
+    store or body segment is attached whenever messages are to be archived or bodies
+    stored. With `compress_bodies`, new bodies are compressed, and a new segment built
+    from plain messages is primed with a dictionary trained from them.
+    """
+    bodies = None
+    if "bodies" in messages or mmap_bodies:
+        dictionary = None
+        if compress_bodies and "bodies" not in messages:
+            dictionary = body_store.train_dictionary(
+                json.dumps(body, ensure_ascii=False).encode("utf-8")
+                for body in _message_bodies(messages)
+            )
+        bodies = body_store.BodySegment.from_dict(
+            vm_id, messages.get("bodies"), compress_bodies, dictionary
+        )
+
+    history = None
+    if "history" in messages or hot_messages is not None:
+        history = history_store.HistoryStore.from_dict(
+            vm_id,
+            messages.get("history"),
+            hot_messages=hot_messages,
+            cache_pages=cache_pages,
+            bodies=bodies,
+        )
+
+    if "mailboxes" in messages:
+        store = message_store.MessageStore(history=history, bodies=bodies)
+        # Mailboxes are only added without being decoded if their bodies and archived
+        # messages are stored the way this store keeps them, which is not the case for
+        # the mailboxes of a full-state sync, which hold every body and message
+        lazy = (bodies is None or "bodies" in messages) and (
+            history is None or "history" in messages
+        )
+        for mailbox in messages["mailboxes"]:
+            if lazy:
+                store.add_encoded_mailbox(*mailbox)
+            else:
+                store.add_mailbox(*mailbox)
+    else:
+        store = message_store.MessageStore.from_dict(messages, history, bodies)
+
+    for msg_id, receiver, expires_at in messages.get("expirations", []):
+        store.set_expiry(msg_id, receiver, expires_at)
+    return store
+
+
+def _message_bodies(messages):
     """
-    Loads user, message, and settings databases from JSON files for the client.
+    Yields the bodies held by a messages table in the plain or per-mailbox layout.
     """
-    settings = None
+    for box in message_store.BOXES:
+        for msg_obj in messages.get(box, []):
+            yield msg_obj["message"]
+    for _, _, _, senders, _, _, data in messages.get("mailboxes", []):
+        for _, _, body in message_store.decode_mailbox(data, senders):
+            if isinstance(body, str):
+                yield body
+
 
+def load_client_database(vm_id):
+    """
+    Loads the settings database for the client.
+    """
     if not os.path.exists("database"):
         raise Exception("Database directory does not exist.")
 
-    settings = safe_load(
-        settings_database_path(vm_id),
-        {
-            "counter": 0,
-            "host": "127.0.0.1",
-            "port": 54400,
-            "host_json": "127.0.0.1",
-            "port_json": 54444,
-        },
+    return load_settings_table(vm_id)
+
+
+def save_database(vm_id, users, messages, settings):
+    """
+    Saves user, message, and settings data back to snapshot files. Since the files then
+    hold the complete state, every write-ahead log segment is discarded afterwards.
+    """
+    write_snapshot(
+        vm_id,
+        {"users": users, "messages": messages, "settings": settings},
+        rotate_log(vm_id),
     )
+    mark_written(vm_id)
 
-    return settings
 
+def write_json_atomically(filepath, value):
+    """
+    Writes a JSON file through a temporary file, so that a crash never leaves a
+    partially written file behind.
+    """
+    with open(f"{filepath}.tmp", "w") as file:
+        json.dump(value, file)
+        _sync_file(file)
+    os.replace(f"{filepath}.tmp", filepath)
 
-def save_database(vm_id, users, messages, settings):
+
+def write_table_atomically(filepath, table, value):
+    """
+    Writes a table as a binary snapshot through a temporary file, so that a crash never
+    leaves a partially written file behind. The messages table is either in the
+    per-mailbox layout returned by MessageStore.snapshot or in the plain layout.
     """
-    Saves user, message, and settings data back to JSON files.
+    if table == "messages" and "mailboxes" not in value:
+        value = message_store.MessageStore.from_dict(value).snapshot()
+
+    with open(f"{filepath}.tmp", "wb") as file:
+        writer = snapshot_format.SnapshotWriter(file)
+        writer.write_tables({table: value})
+        writer.close()
+        _sync_file(file)
+    os.replace(f"{filepath}.tmp", filepath)
+
+
+def _sync_file(file):
     """
-    with open(users_database_path(vm_id), "w") as users_file:
-        json.dump(users, users_file)
-    with open(messages_database_path(vm_id), "w") as messages_file:
-        json.dump(messages, messages_file)
-    with open(settings_database_path(vm_id), "w") as settings_file:
-        json.dump(settings, settings_file)
+    Forces a file written through a temporary file to stable storage, so that it can
+    never replace the previous version with contents that are lost in a crash.
+    """
+    file.flush()
+    os.fsync(file.fileno())
+
+
+def _sync_path(path):
+    """
+    Forces a file that is already written, or the entries of a directory, to stable
+    storage, so that what a snapshot refers to survives a crash.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _remove_if_exists(filepath):
+    if os.path.exists(filepath):
+        os.remove(filepath)
+
+
+def _sync_if_exists(filepath):
+    if os.path.exists(filepath):
+        _sync_path(filepath)
+
+
+def write_snapshot(vm_id, tables, log_segment):
+    """
+    Writes a snapshot covering every log segment before `log_segment`, then deletes those
+    segments. `tables` maps table names ("users", "messages", "settings") to their
+    contents; tables that are left out must not have changed since they were last
+    written. A snapshot older than the one already on disk is skipped.
+    """
+    with _snapshot_lock:
+        if not os.path.exists("database"):
+            os.makedirs("database")
+
+        if log_segment < snapshot_log_segment(vm_id):
+            return
+
+        if "users" in tables:
+            write_table_atomically(users_database_path(vm_id), "users", tables["users"])
+            _remove_if_exists(legacy_users_database_path(vm_id))
+        if "messages" in tables:
+            # Bodies and archived messages are only flushed when they are appended, so
+            # they are synced before the snapshot that refers to them replaces the old one
+            history = tables["messages"].get("history")
+            bodies = tables["messages"].get("bodies")
+            if history is not None:
+                _sync_if_exists(
+                    history_store.history_database_path(vm_id, history["generation"])
+                )
+            if bodies is not None:
+                _sync_if_exists(
+                    body_store.bodies_database_path(vm_id, bodies["generation"])
+                )
+            _sync_path("database")
+
+            write_table_atomically(
+                messages_database_path(vm_id), "messages", tables["messages"]
+            )
+            _remove_if_exists(legacy_messages_database_path(vm_id))
+            # History files and body segments that the new snapshot does not refer to
+            # are no longer needed
+            history_store.remove_old_generations(
+                vm_id, history["generation"] if history is not None else None
+            )
+            body_store.remove_old_generations(
+                vm_id, bodies["generation"] if bodies is not None else None
+            )
+        if "settings" in tables:
+            write_table_atomically(
+                settings_database_path(vm_id), "settings", tables["settings"]
+            )
+            _remove_if_exists(legacy_settings_database_path(vm_id))
+        write_json_atomically(
+            manifest_database_path(vm_id), {"log_segment": log_segment}
+        )
+        # The log segments are the only copy of the changes until the renamed tables
+        # and manifest are durable
+        _sync_path("database")
+
+        for segment in list_log_segments(vm_id):
+            if segment < log_segment:
+                os.remove(log_database_path(vm_id, segment))
+
+
+def snapshot_log_segment(vm_id):
+    """
+    Returns the first write-ahead log segment not covered by the snapshot on disk.
+    """
+    try:
+        with open(manifest_database_path(vm_id), "r") as manifest_file:
+            return json.load(manifest_file)["log_segment"]
+    except (json.JSONDecodeError, FileNotFoundError, KeyError):
+        return 0
+
+
+def list_log_segments(vm_id):
+    """
+    Returns the numbers of the write-ahead log segments on disk, in ascending order.
+    """
+    if not os.path.exists("database"):
+        return []
+
+    prefix = f"log_{vm_id}_"
+    segments = []
+    for filename in os.listdir("database"):
+        if filename.startswith(prefix) and filename.endswith(".jsonl"):
+            segment = filename[len(prefix) : -len(".jsonl")]
+            if segment.isdigit():
+                segments.append(int(segment))
+    return sorted(segments)
+
+
+def _next_log_segment(vm_id):
+    """
+    Returns a segment number that is newer than every segment on disk and not covered
+    by the current snapshot.
+    """
+    return max(list_log_segments(vm_id) + [snapshot_log_segment(vm_id) - 1]) + 1
+
+
+def _close_log(vm_id):
+    """
+    Closes the open write-ahead log segment, if any.
+    """
+    log_file = _log_files.pop(vm_id, None)
+    if log_file is not None:
+        log_file.close()
+
+
+def append_log(vm_id, records, fsync=False):
+    """
+    Appends mutation records to the current write-ahead log segment, one compact JSON
+    object per line. The segment is kept open between calls so that an append costs a
+    single write. With `fsync`, the records are also forced to stable storage.
+    """
+    log_file = _log_files.get(vm_id)
+    if log_file is None:
+        if not os.path.exists("database"):
+            os.makedirs("database")
+        if vm_id not in _log_segments:
+            _log_segments[vm_id] = _next_log_segment(vm_id)
+        # Kept open between appends, and closed by _close_log on rotation or
+        # truncation
+        log_file = open(  # noqa: SIM115
+            log_database_path(vm_id, _log_segments[vm_id]), "a", encoding="utf-8"
+        )
+        _log_files[vm_id] = log_file
+
+    encoded = "".join(
+        json.dumps(record, separators=(",", ":")) + "\n" for record in records
+    )
+    log_file.write(encoded)
+    log_file.flush()
+    if fsync:
+        os.fsync(log_file.fileno())
+    _log_bytes[vm_id] = _log_bytes.get(vm_id, 0) + len(encoded)
+    mark_dirty(vm_id, records)
+
+
+def mark_dirty(vm_id, records):
+    """
+    Marks the tables touched by the given write-ahead log records as changed.
+    """
+    dirty = _dirty_tables.setdefault(vm_id, set())
+    for record in records:
+        dirty.update(LOG_OPERATION_TABLES[record["op"]])
+
+
+def dirty_tables(vm_id):
+    """
+    Returns the names of the tables changed since the last snapshot that was written,
+    or since they were last loaded from the log.
+    """
+    return _dirty_tables.get(vm_id, set()) | _rotated_tables.get(vm_id, set())
+
+
+def mark_written(vm_id):
+    """
+    Marks the tables changed in the log segments rotated out so far as written, once a
+    snapshot covering those segments has been written. Tables changed in the current
+    segment stay dirty.
+    """
+    _rotated_tables[vm_id] = set()
+
+
+def rotate_log(vm_id):
+    """
+    Closes the current write-ahead log segment so that subsequent records go to a new
+    one, and returns the number of the new segment. The tables changed in the closed
+    segment stay dirty until mark_written is called.
+    """
+    _close_log(vm_id)
+    if vm_id in _log_segments:
+        _log_segments[vm_id] += 1
+    else:
+        _log_segments[vm_id] = _next_log_segment(vm_id)
+    _log_bytes[vm_id] = 0
+    _rotated_tables.setdefault(vm_id, set()).update(_dirty_tables.pop(vm_id, ()))
+    return _log_segments[vm_id]
+
+
+def log_size(vm_id):
+    """
+    Returns the number of bytes logged since the last rotation.
+    """
+    return _log_bytes.get(vm_id, 0)
+
+
+def read_log(vm_id, first_segment=0):
+    """
+    Reads every complete record from the write-ahead log segments numbered
+    `first_segment` or above. A record at the end of a segment that was only partially
+    written (e.g. because of a crash) is ignored.
+    """
+    records = []
+    for segment in list_log_segments(vm_id):
+        if segment < first_segment:
+            continue
+        with open(log_database_path(vm_id, segment), "r", encoding="utf-8") as log_file:
+            for line in log_file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+    return records
+
+
+def truncate_log(vm_id):
+    """
+    Discards every write-ahead log segment along with the snapshot manifest.
+    """
+    _close_log(vm_id)
+    _log_segments.pop(vm_id, None)
+    _log_bytes.pop(vm_id, None)
+    _dirty_tables.pop(vm_id, None)
+    _rotated_tables.pop(vm_id, None)
+    for segment in list_log_segments(vm_id):
+        os.remove(log_database_path(vm_id, segment))
+    if os.path.exists(manifest_database_path(vm_id)):
+        os.remove(manifest_database_path(vm_id))
+
+
+def apply_log_records(records, users, messages, settings):
+    """
+    Replays write-ahead log records on top of the given tables, in place. `messages` is
+    a MessageStore. Supported operations are:
+
+    - put_user: stores the full record of a user
+    - delete_user: removes a user along with every message they sent or received
+    - add_message: files a new message under the given box and advances the counter,
+      recording when it expires if it was sent with a TTL
+    - deliver_messages: moves messages from undelivered to delivered
+    - delete_messages: removes delivered messages of a receiver
+    - expire_message: removes an expired message from the given box and forgets when it
+      expires
+
+    Every operation is idempotent, so replaying a record twice is harmless.
+    """
+    for record in records:
+        op = record["op"]
+        if op == "put_user":
+            users[record["username"]] = record["user"]
+        elif op == "delete_user":
+            users.pop(record["username"], None)
+            messages.remove_user(record["username"])
+        elif op == "add_message":
+            msg = message_store.Message.from_dict(record["message"])
+            if messages.locate(msg.id, msg.receiver) is None:
+                messages.add(msg, record["box"])
+            if record.get("expires_at") is not None:
+                messages.set_expiry(msg.id, msg.receiver, record["expires_at"])
+            settings["counter"] = max(settings["counter"], msg.id)
+        elif op == "deliver_messages":
+            messages.deliver_ids(record["ids"], record.get("receiver"))
+        elif op == "delete_messages":
+            messages.delete(record["receiver"], record["ids"])
+        elif op == "expire_message":
+            messages.pop_expiry(record["id"])
+            messages.delete(record["receiver"], [record["id"]], record["box"])
 
 
 def reset_database(vm_id):
@@ -128,3 +673,84 @@ def reset_database(vm_id):
 
     save_database(vm_id, users, messages, settings)
     return users, messages, settings
+
+
+class Snapshotter(threading.Thread):
+    """
+    Background thread that periodically snapshots the tables of a running server and
+    discards the write-ahead log segments the snapshot covers. A snapshot is taken once
+    `interval` seconds have passed since the previous one or once more than
+    `max_log_bytes` have been logged, but only if any table changed, and only the tables
+    that changed are copied and rewritten.
+
+    The tables are copied while holding `lock`, which must also be held by everything
+    that mutates the database; encoding and writing the snapshot happen without it.
+    """
+
+    def __init__(
+        self,
+        vm_id,
+        database,
+        lock,
+        interval=60.0,
+        max_log_bytes=16 * 1024 * 1024,
+        poll_interval=0.5,
+    ):
+        super().__init__(daemon=True)
+
+        self.vm_id = vm_id
+        self.database = database
+        self.lock = lock
+        self.interval = interval
+        self.max_log_bytes = max_log_bytes
+        self.poll_interval = min(poll_interval, interval)
+        self.stopped = threading.Event()
+
+    def snapshot(self):
+        """
+        Takes a snapshot of the tables that changed since the last one. Returns whether a
+        snapshot was written.
+        """
+        with self.lock:
+            dirty = dirty_tables(self.vm_id)
+            if not dirty:
+                return False
+
+            log_segment = rotate_log(self.vm_id)
+            tables = {}
+            if "users" in dirty:
+                tables["users"] = {
+                    username: dict(user)
+                    for username, user in self.database["users"].items()
+                }
+            if "messages" in dirty:
+                tables["messages"] = self.database["messages"].copy_snapshot()
+            if "settings" in dirty:
+                tables["settings"] = dict(self.database["settings"])
+
+        if "messages" in tables:
+            tables["messages"] = message_store.encode_snapshot(tables["messages"])
+        write_snapshot(self.vm_id, tables, log_segment)
+        with self.lock:
+            mark_written(self.vm_id)
+        return True
+
+    def run(self):
+        last_snapshot = time.monotonic()
+        while not self.stopped.wait(self.poll_interval):
+            if (
+                time.monotonic() - last_snapshot >= self.interval
+                or log_size(self.vm_id) >= self.max_log_bytes
+            ):
+                try:
+                    self.snapshot()
+                except Exception as e:
+                    # The tables stay dirty, so the next attempt writes them again
+                    print(f"{self.vm_id} : Error writing snapshot: {e}")
+                last_snapshot = time.monotonic()
+
+    def stop(self):
+        """
+        Stops the thread after its current iteration.
+        """
+        self.stopped.set()
@@ -0,0 +1,124 @@
+"""
+Framing Module
+
+This script implements how requests are framed on a client connection, and an incremental
+decoder that extracts complete frames from the bytes received so far. Frames used to be
+found by decoding everything buffered and splitting it on "\0" for every command, which got
+slower the more was buffered and could parse a frame before all of it had arrived.
+
+Key Features:
+- Length-prefixed frames: a marker byte, the length of the payload as a 4-byte big-endian
+  unsigned integer, then the payload, so a frame is known to be complete as soon as enough
+  bytes have arrived, without looking at its contents.
+- Version 0 frames: JSON text terminated by "\0", as sent by existing clients. The marker
+  byte never starts a JSON text, so both kinds of frames can be mixed on one connection.
+- Buffers received bytes in a bytearray and consumes frames by moving an offset forward.
+  Consumed bytes are only dropped once they make up at least half of the buffer, so the
+  cost of extracting frames is linear in the number of bytes received.
+- Remembers how far it has searched for a terminator, so a version 0 frame that arrives
+  in many pieces is only scanned once.
+- Rejects frames larger than a limit instead of buffering them forever.
+"""
+
+import struct
+
+LENGTH_PREFIXED = 0x01
+TERMINATOR = b"\0"
+# Marker byte and payload length of a length-prefixed frame
+FRAME_HEADER = struct.Struct("!BI")
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+
+
+class FrameError(ValueError):
+    """
+    Raised when the bytes received on a connection cannot be framed.
+    """
+
+
+def encode_frame(payload):
+    """
+    Returns `payload` as a length-prefixed frame.
+    """
+    return FRAME_HEADER.pack(LENGTH_PREFIXED, len(payload)) + payload
+
+
+class FrameDecoder:
+    """
+    Extracts complete frames, length-prefixed or terminated by "\0", from the bytes
+    received on a connection. Feed it what recv returns, then call next_frame until it
+    returns None.
+    """
+
+    def __init__(self, max_frame_bytes=MAX_FRAME_BYTES):
+        self.max_frame_bytes = max_frame_bytes
+        self.buffer = bytearray()
+        # Offset of the first byte that is not part of a frame returned yet
+        self.start = 0
+        # Offset up to which the current version 0 frame holds no terminator
+        self.scanned = 0
+        # Whether the peer has sent length-prefixed frames, and expects them back
+        self.length_prefixed = False
+
+    def __len__(self):
+        return len(self.buffer) - self.start
+
+    def feed(self, data):
+        """
+        Appends received bytes to the buffer.
+        """
+        if self.start and self.start >= len(self.buffer) - self.start:
+            del self.buffer[: self.start]
+            self.scanned -= self.start
+            self.start = 0
+        self.buffer += data
+
+    def _take(self, start, end, next_start):
+        """
+        Returns a copy of the buffer between `start` and `end`, and consumes it up to
+        `next_start`.
+        """
+        with memoryview(self.buffer) as view:
+            payload = bytes(view[start:end])
+        self.start = self.scanned = next_start
+        return payload
+
+    def next_frame(self):
+        """
+        Returns the payload of the next complete frame, without its header or
+        terminator, or None if no complete frame has been received yet. Raises
+        FrameError if the frame is too large.
+        """
+        buffer = self.buffer
+        start = self.start
+        if start == len(buffer):
+            if start:
+                buffer.clear()
+                self.start = self.scanned = 0
+            return None
+
+        if buffer[start] == LENGTH_PREFIXED:
+            if len(buffer) - start < FRAME_HEADER.size:
+                return None
+            _, length = FRAME_HEADER.unpack_from(buffer, start)
+            if length > self.max_frame_bytes:
+                raise FrameError(f"frame of {length} bytes is too large")
+            end = start + FRAME_HEADER.size + length
+            if len(buffer) < end:
+                return None
+            self.length_prefixed = True
+            return self._take(start + FRAME_HEADER.size, end, end)
+
+        end = buffer.find(TERMINATOR, max(start, self.scanned))
+        if end == -1:
+            self.scanned = len(buffer)
+            if len(buffer) - start > self.max_frame_bytes:
+                raise FrameError("unterminated frame is too large")
+            return None
+        return self._take(start, end, end + 1)
+
+    def __iter__(self):
+        """
+        Yields the payload of every complete frame received so far.
+        """
+        while (frame := self.next_frame()) is not None:
+            yield frame
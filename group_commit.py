@@ -0,0 +1,115 @@
+"""
+Group Commit Module
+
+This script implements the layer between the server's handlers and the write-ahead log that
+groups the mutations of one selector loop iteration (or of a configurable time window) and
+persists them together, trading a few milliseconds of latency for far fewer writes and
+fsyncs under bursty load.
+
+Key Features:
+- "commit" durability: every commit is written and fsynced before the handler returns.
+- "batch" durability: commits are collected and written with a single fsync at the end of
+  the loop iteration or time window, and replies are held until their batch is durable,
+  then sent with one write per client.
+- "async" durability: commits are collected and written with a single fsync at the end of
+  the loop iteration or time window, but replies are sent right away.
+"""
+
+import time
+
+import database_wrapper
+
+DURABILITY_LEVELS = ("commit", "batch", "async")
+
+
+class GroupCommitter:
+    """
+    Collects write-ahead log records and the replies that depend on them, and persists
+    them according to the durability level. `window` is the number of seconds to keep
+    collecting after the first pending record; 0 flushes at the end of every loop
+    iteration. Held replies are sent with `send(sock, payload)`, or sock.send if it is
+    None.
+    """
+
+    def __init__(self, vm_id, durability="batch", window=0.0, send=None):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"Unknown durability level: {durability}")
+
+        self.vm_id = vm_id
+        self.durability = durability
+        self.window = window
+        self.send = (
+            send if send is not None else lambda sock, payload: sock.send(payload)
+        )
+
+        self.pending_records = []
+        self.held_replies = []
+        self.batch_started = None
+
+    def commit(self, records):
+        """
+        Commits write-ahead log records, either right away or as part of the current
+        batch.
+        """
+        if self.durability == "commit":
+            database_wrapper.append_log(self.vm_id, records, fsync=True)
+            return
+
+        if self.batch_started is None:
+            self.batch_started = time.monotonic()
+        self.pending_records.extend(records)
+
+    def hold_reply(self, sock, payload):
+        """
+        Holds a reply until the current batch is durable. Returns False if the reply
+        should be sent right away instead.
+        """
+        if self.durability != "batch":
+            return False
+
+        if self.batch_started is None:
+            self.batch_started = time.monotonic()
+        self.held_replies.append((sock, payload))
+        return True
+
+    def flush(self):
+        """
+        Writes and fsyncs every pending record as one batch, then sends the replies that
+        were waiting for it.
+        """
+        if self.pending_records:
+            database_wrapper.append_log(self.vm_id, self.pending_records, fsync=True)
+            self.pending_records = []
+
+        # Sending a reply may commit more changes and hold more replies, which make up
+        # the next batch
+        held_replies, self.held_replies = self.held_replies, []
+        self.batch_started = None
+
+        # The replies held for a client are sent back in a single write
+        replies_by_sock = {}
+        for sock, payload in held_replies:
+            replies_by_sock.setdefault(sock, []).append(payload)
+        for sock, replies in replies_by_sock.items():
+            try:
+                self.send(sock, b"".join(replies))
+            except OSError:
+                # The client disconnected while its reply was held
+                pass
+
+    def timeout(self):
+        """
+        Returns how long the selector loop may block before the current batch is due, or
+        None if nothing is pending.
+        """
+        if self.batch_started is None:
+            return None
+        return max(0.0, self.batch_started + self.window - time.monotonic())
+
+    def end_iteration(self):
+        """
+        Called at the end of each selector loop iteration; flushes the current batch if
+        its time window has passed.
+        """
+        if self.batch_started is not None and self.timeout() == 0:
+            self.flush()
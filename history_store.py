@@ -0,0 +1,414 @@
+"""
+History Store Module
+
+This script implements the cold tier of the message store. Delivered messages are only
+read when their receiver asks for them, so once a receiver has more than a configured
+number of delivered messages in memory, the oldest ones are moved out to pages in a history
+file on disk and paged back in only when they are requested.
+
+Key Features:
+- Appends pages of up to `page_size` delivered messages of a single receiver to a history
+  file. Pages are never modified in place: changing a page appends a new version of it, so
+  the page index stored in a snapshot stays valid after a crash.
+- Keeps only a small index entry per page in memory (offset, length, number of messages,
+  senders, size of the bodies and smallest and largest message ID), so resident memory
+  does not grow with the number of archived messages, retention limits can be checked
+  without reading any page, and deleting messages only reads and rewrites the pages
+  whose range of IDs holds them.
+- Keeps the most recently read pages in a bounded LRU cache.
+- Starts a new generation of the history file whenever the store is built from scratch or
+  compacted, so the file referenced by the snapshot on disk is never overwritten.
+"""
+
+import bisect
+import json
+import os
+import sys
+from collections import OrderedDict, namedtuple
+
+import message_store
+
+history_database_path = lambda id, g: f"database/history_{id}_{g}.jsonl"  # noqa: E731
+
+# Number of messages per page
+PAGE_SIZE = 64
+
+# Location of a page in the history file, with the number of messages it holds, the names
+# of their senders, the number of bytes of their bodies and the smallest and largest of
+# their IDs
+Page = namedtuple(
+    "Page", ["offset", "length", "count", "senders", "size", "min_id", "max_id"]
+)
+
+
+def list_generations(vm_id):
+    """
+    Returns the generation numbers of the history files on disk, in ascending order.
+    """
+    if not os.path.exists("database"):
+        return []
+
+    prefix = f"history_{vm_id}_"
+    generations = []
+    for filename in os.listdir("database"):
+        if filename.startswith(prefix) and filename.endswith(".jsonl"):
+            generation = filename[len(prefix) : -len(".jsonl")]
+            if generation.isdigit():
+                generations.append(int(generation))
+    return sorted(generations)
+
+
+def remove_old_generations(vm_id, generation=None):
+    """
+    Deletes the history files older than `generation`, or every history file if
+    `generation` is None.
+    """
+    for old_generation in list_generations(vm_id):
+        if generation is None or old_generation < generation:
+            os.remove(history_database_path(vm_id, old_generation))
+
+
+class HistoryStore:
+    """
+    Delivered messages archived on disk, in pages grouped by receiver. Within a
+    receiver, pages are kept oldest first.
+
+    `hot_messages` is the number of delivered messages per receiver that the message
+    store keeps in memory before archiving the oldest page of them, or None to never
+    archive messages. `cache_pages` bounds the number of pages kept in memory after
+    being read. When the message store keeps bodies in a body segment, `bodies` is that
+    segment, and pages hold references to the bodies instead of the bodies themselves.
+    """
+
+    def __init__(
+        self,
+        vm_id,
+        hot_messages=None,
+        page_size=PAGE_SIZE,
+        cache_pages=64,
+        generation=None,
+        pages=None,
+        bodies=None,
+    ):
+        self.vm_id = vm_id
+        self.hot_messages = hot_messages
+        self.page_size = page_size
+        self.cache_pages = cache_pages
+        self.bodies = bodies
+
+        if generation is None:
+            generation = max(list_generations(vm_id) + [-1]) + 1
+        self.generation = generation
+        self.path = history_database_path(vm_id, generation)
+
+        # Receiver -> pages of their archived messages, oldest first
+        self.pages = {}
+        for receiver, receiver_pages in (pages or {}).items():
+            self.pages[sys.intern(receiver)] = [
+                self._load_page(*page) for page in receiver_pages
+            ]
+
+        # Page offset -> messages of the page, least recently read first
+        self._cache = OrderedDict()
+        self._file = None
+        self._pid = None
+
+    @staticmethod
+    def _load_page(offset, length, count, senders, size, min_id, max_id):
+        """
+        Builds an index entry stored by to_dict.
+        """
+        return Page(
+            offset,
+            length,
+            count,
+            frozenset(map(sys.intern, senders)),
+            size,
+            min_id,
+            max_id,
+        )
+
+    @classmethod
+    def from_dict(cls, vm_id, history, **kwargs):
+        """
+        Opens the history described by a page index returned by to_dict, or a new,
+        empty history if `history` is None.
+        """
+        if history is None:
+            return cls(vm_id, **kwargs)
+        return cls(
+            vm_id, generation=history["generation"], pages=history["pages"], **kwargs
+        )
+
+    def to_dict(self):
+        """
+        Returns the page index, to be stored in a snapshot.
+        """
+        return {
+            "generation": self.generation,
+            "pages": {
+                receiver: [
+                    [
+                        page.offset,
+                        page.length,
+                        page.count,
+                        sorted(page.senders),
+                        page.size,
+                        page.min_id,
+                        page.max_id,
+                    ]
+                    for page in receiver_pages
+                ]
+                for receiver, receiver_pages in self.pages.items()
+            },
+        }
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_cache"] = OrderedDict()
+        state["_file"] = None
+        state["_pid"] = None
+        return state
+
+    @property
+    def file(self):
+        if self._file is None or self._pid != os.getpid():
+            if not os.path.exists("database"):
+                os.makedirs("database")
+            # Kept open between appends and reads, and closed by close
+            self._file = open(self.path, "a+b")  # noqa: SIM115
+            self._pid = os.getpid()
+        return self._file
+
+    def close(self):
+        """
+        Closes the history file, once this generation has been replaced by a newer one.
+        """
+        if self._file is not None and self._pid == os.getpid():
+            self._file.close()
+        self._file = None
+        self._pid = None
+
+    def _write_page(self, msgs):
+        """
+        Appends a page holding the given messages to the history file.
+        """
+        encoded = message_store.encode_entries(msgs) + b"\n"
+
+        history_file = self.file
+        history_file.seek(0, os.SEEK_END)
+        offset = history_file.tell()
+        history_file.write(encoded)
+        history_file.flush()
+        return Page(
+            offset,
+            len(encoded),
+            len(msgs),
+            frozenset(msg.sender for msg in msgs),
+            sum(msg.body_size for msg in msgs),
+            min(msg.id for msg in msgs),
+            max(msg.id for msg in msgs),
+        )
+
+    def _read_page(self, receiver, page):
+        """
+        Returns the messages of a page, from the cache if it was read recently. The
+        returned list must not be modified.
+        """
+        msgs = self._cache.get(page.offset)
+        if msgs is not None:
+            self._cache.move_to_end(page.offset)
+            return msgs
+
+        history_file = self.file
+        history_file.seek(page.offset)
+        msgs = []
+        for msg_id, sender, message in json.loads(history_file.read(page.length)):
+            if isinstance(message, list):
+                message = self.bodies.ref(*message)
+            msgs.append(message_store.Message(msg_id, sender, receiver, message))
+
+        self._cache[page.offset] = msgs
+        if len(self._cache) > self.cache_pages:
+            self._cache.popitem(last=False)
+        return msgs
+
+    def _rewrite_pages(self, receiver, keep, may_change=None):
+        """
+        Rewrites the pages of a receiver that hold messages for which `keep` returns
+        False, without those messages. With `may_change`, only the pages for which it
+        returns True are read. Returns the IDs of the removed messages.
+        """
+        removed_ids = []
+        rewritten = []
+        for page in self.pages[receiver]:
+            if may_change is not None and not may_change(page):
+                rewritten.append(page)
+                continue
+
+            msgs = self._read_page(receiver, page)
+            kept = [msg for msg in msgs if keep(msg)]
+            if len(kept) == len(msgs):
+                rewritten.append(page)
+                continue
+
+            removed_ids.extend(msg.id for msg in msgs if not keep(msg))
+            if kept:
+                rewritten.append(self._write_page(kept))
+
+        if rewritten:
+            self.pages[receiver] = rewritten
+        else:
+            del self.pages[receiver]
+        return removed_ids
+
+    def archive(self, receiver, msgs):
+        """
+        Archives delivered messages of a receiver, which must be newer than the
+        messages already archived for them.
+        """
+        self.pages.setdefault(receiver, []).append(self._write_page(msgs))
+
+    def count(self, receiver):
+        """
+        Returns the number of archived messages of a receiver.
+        """
+        return sum(page.count for page in self.pages.get(receiver, ()))
+
+    def size(self):
+        """
+        Returns the number of archived messages, across all receivers.
+        """
+        return sum(
+            page.count
+            for receiver_pages in self.pages.values()
+            for page in receiver_pages
+        )
+
+    def body_bytes(self, receiver=None):
+        """
+        Returns the number of bytes of the archived bodies of a receiver, or of every
+        receiver.
+        """
+        if receiver is not None:
+            return sum(page.size for page in self.pages.get(receiver, ()))
+        return sum(
+            page.size
+            for receiver_pages in self.pages.values()
+            for page in receiver_pages
+        )
+
+    def oldest_id(self, receiver):
+        """
+        Returns the smallest ID of the archived messages of a receiver, or None if they
+        have none.
+        """
+        return min((page.min_id for page in self.pages.get(receiver, ())), default=None)
+
+    def stored_bytes(self):
+        """
+        Returns the size of the history file, including pages that are no longer used.
+        """
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def live_bytes(self):
+        """
+        Returns the number of bytes of the history file taken by pages still in use.
+        """
+        return sum(
+            page.length
+            for receiver_pages in self.pages.values()
+            for page in receiver_pages
+        )
+
+    def has_messages(self):
+        """
+        Returns whether any message is archived.
+        """
+        return bool(self.pages)
+
+    def peek(self, receiver, num_messages):
+        """
+        Returns up to `num_messages` of the oldest archived messages of a receiver,
+        reading only the pages needed.
+        """
+        msgs = []
+        for page in self.pages.get(receiver, ()):
+            if len(msgs) >= num_messages:
+                break
+            msgs.extend(self._read_page(receiver, page)[: num_messages - len(msgs)])
+        return msgs
+
+    def messages(self):
+        """
+        Yields every archived message, receiver by receiver.
+        """
+        for receiver, receiver_pages in list(self.pages.items()):
+            for page in receiver_pages:
+                yield from self._read_page(receiver, page)
+
+    def delete(self, receiver, msg_ids):
+        """
+        Deletes the archived messages of a receiver with the given IDs, and returns the
+        IDs that were actually deleted.
+        """
+        if receiver not in self.pages:
+            return []
+
+        msg_ids = set(msg_ids)
+        sorted_ids = sorted(msg_ids)
+
+        def may_change(page):
+            # Whether any of the IDs falls within the range of IDs of the page
+            index = bisect.bisect_left(sorted_ids, page.min_id)
+            return index < len(sorted_ids) and sorted_ids[index] <= page.max_id
+
+        return self._rewrite_pages(
+            receiver, lambda msg: msg.id not in msg_ids, may_change
+        )
+
+    def remove_user(self, username):
+        """
+        Removes every archived message that a user sent or received. Only the pages
+        whose index lists the user as a sender are read.
+        """
+        for page in self.pages.pop(username, ()):
+            self._cache.pop(page.offset, None)
+
+        for receiver, receiver_pages in list(self.pages.items()):
+            if any(username in page.senders for page in receiver_pages):
+                self._rewrite_pages(receiver, lambda msg: msg.sender != username)
+
+    def clear(self):
+        """
+        Removes every archived message.
+        """
+        self.pages = {}
+        self._cache.clear()
+
+    def compacted(self, bodies=None):
+        """
+        Returns a new generation of the history holding only the pages in use. With
+        `bodies`, the bodies of the archived messages are copied to that segment, which
+        the new history refers to instead.
+        """
+        history = HistoryStore(
+            self.vm_id,
+            hot_messages=self.hot_messages,
+            page_size=self.page_size,
+            cache_pages=self.cache_pages,
+            generation=max(list_generations(self.vm_id) + [self.generation]) + 1,
+            bodies=bodies if bodies is not None else self.bodies,
+        )
+        for receiver, receiver_pages in self.pages.items():
+            for page in receiver_pages:
+                msgs = []
+                for msg in self._read_page(receiver, page):
+                    message = msg.message
+                    if bodies is not None and not isinstance(message, str):
+                        message = bodies.append_encoded(message.raw())
+                    msgs.append(
+                        message_store.Message(msg.id, msg.sender, receiver, message)
+                    )
+                history.archive(receiver, msgs)
+        return history
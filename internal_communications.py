@@ -1,11 +1,14 @@
+import command_table
+import functools
 import json
 import socket
 import threading
 import time
-import database_wrapper
 import selectors
 import types
 
+import snapshot_format
+
 
 class InternalCommunicator(threading.Thread):
     def __init__(
@@ -37,6 +40,34 @@ class InternalCommunicator(threading.Thread):
         self.leader = None  # Store the current leader
         self.loaded_database = False
 
+        # Handlers of the messages other servers send, each passed the decoded message
+        # and the binary payload that follows it
+        self.commands = command_table.CommandTable()
+        for command, handler in (
+            ("ping", self.handle_ping),
+            ("internal_update", self.handle_internal_update),
+            ("distribute_update", self.handle_distributed_update),
+            ("get_database", self.send_database),
+            ("set_database", self.set_database),
+        ):
+            self.commands.register(command, handler)
+
+        # Handlers of the changes other servers replicate, which apply them without
+        # replying to anyone
+        self.updates = command_table.CommandTable()
+        for command, handler in (
+            ("create", vm.create_account),
+            ("login", vm.login),
+            ("logout", vm.logout),
+            ("delete_acct", vm.delete_account),
+            ("send_msg", vm.deliver_message),
+            ("get_undelivered", vm.get_undelivered_messages),
+            ("delete_msg", vm.delete_messages),
+        ):
+            self.updates.register(
+                command, functools.partial(handler, internal_change=True)
+            )
+
     def get_database_from_leader(self):
         """Fetches the database from the current leader."""
         if self.leader is not None:
@@ -51,22 +82,59 @@ class InternalCommunicator(threading.Thread):
                     except Exception as e:
                         print(f"INTERNAL {self.id}: Error fetching database: {e}")
 
+    def ping_connected_servers(self):
+        """
+        Pings every connected server, dropping those that can no longer be reached, and
+        returns the addresses of the others.
+        """
+        connected_addrs = []
+
+        for addr, conn in list(self.connected_servers):
+            try:
+                conn.sendall(
+                    f"{json.dumps({'version': 0, 'command': 'ping'})}\0".encode("utf-8")
+                )
+                connected_addrs.append(addr)
+            except Exception:
+                print(f"INTERNAL {self.id}: Connection to {addr} lost.")
+                conn.close()
+                self.connected_servers.remove((addr, conn))
+        return connected_addrs
+
+    def add_connected_server(self, addr, conn):
+        """
+        Adds a connection to another server, unless it is already connected.
+        """
+        found_addr = False
+        for saved_addr, _ in self.connected_servers:
+            if saved_addr == addr:
+                found_addr = True
+                break
+
+        if not found_addr:
+            self.connected_servers.append((addr, conn))
+
+    def remove_connected_server(self, addr):
+        """
+        Closes and drops the connection to a server that could not be reached.
+        """
+        for ind, (saved_addr, conn) in enumerate(self.connected_servers):
+            if saved_addr == addr:
+                conn.close()
+                del self.connected_servers[ind]
+
+    def update_leader(self):
+        """
+        Elects a leader if necessary, and fetches its database until it is loaded.
+        """
+        self.check_and_elect_leader()
+
+        if not self.loaded_database:
+            self.get_database_from_leader()
+
     def update_connected_machines(self):
         while True:
-            connected_addrs = []
-
-            for addr, conn in self.connected_servers:
-                try:
-                    conn.sendall(
-                        f"{json.dumps({'version': 0, 'command': 'ping'})}\0".encode(
-                            "utf-8"
-                        )
-                    )
-                    connected_addrs.append(addr)
-                except Exception:
-                    print(f"INTERNAL {self.id}: Connection to {addr} lost.")
-                    conn.close()
-                    self.connected_servers.remove((addr, conn))
+            connected_addrs = self.ping_connected_servers()
 
             for addr in self.connectable_ports:
                 if addr in connected_addrs or addr == (self.host, self.port):
@@ -75,26 +143,12 @@ class InternalCommunicator(threading.Thread):
                 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 try:
                     s.connect(addr)
-
-                    found_addr = False
-                    for saved_addr, _ in self.connected_servers:
-                        if saved_addr == addr:
-                            found_addr = True
-                            break
-
-                    if not found_addr:
-                        self.connected_servers.append((addr, s))
+                    self.add_connected_server(addr, s)
                 except Exception:
-                    for ind, (saved_addr, conn) in enumerate(self.connected_servers):
-                        if saved_addr == addr:
-                            conn.close()
-                            del self.connected_servers[ind]
+                    self.remove_connected_server(addr)
 
             # Check and elect a leader if necessary
-            self.check_and_elect_leader()
-
-            if not self.loaded_database:
-                self.get_database_from_leader()
+            self.update_leader()
 
             time.sleep(1)
 
@@ -123,6 +177,10 @@ class InternalCommunicator(threading.Thread):
         self.loaded_database = False
         print(f"INTERNAL {self.id}: New leader elected: {self.leader}")
 
+    def is_leader(self):
+        """Returns whether this server is the current leader."""
+        return self.leader == f"{self.host}:{self.port}"
+
     def distribute_update(self, update):
         for _, sock in self.connected_servers:
             data_obj = {
@@ -142,7 +200,7 @@ class InternalCommunicator(threading.Thread):
         data = key.data
         if mask & selectors.EVENT_READ:
             try:
-                recv_data = conn.recv(4096)
+                recv_data = conn.recv(65536)
             except ConnectionResetError:
                 recv_data = None
 
@@ -152,99 +210,79 @@ class InternalCommunicator(threading.Thread):
                 self.sel.unregister(conn)
                 conn.close()
                 return
-        if mask & selectors.EVENT_WRITE:
-            if data.outb:
-                # Process complete messages terminated by newline.
+        self.handle_received(conn, data)
 
-                lines = data.outb.decode("utf-8").split("\0")[:-1]
-                for line in lines:
-                    try:
-                        msg = json.loads(line)
-
-                        if msg["command"] == "ping":
-                            pass
-                        elif msg["command"] == "internal_update":
-                            if "leader" in msg["data"]:
-                                self.leader = msg["data"]["leader"]
-                                print(
-                                    f"INTERNAL {self.id}: Leader updated to {self.leader}"
-                                )
-                        elif msg["command"] == "distribute_update":
-                            command = msg["data"]["command"]
-                            received_data = msg["data"]
-
-                            if command == "create":
-                                self.vm.create_account(conn, received_data, True)
-                            elif command == "login":
-                                self.vm.login(conn, received_data, True)
-                            elif command == "logout":
-                                self.vm.logout(conn, received_data, True)
-                            elif command == "search":
-                                self.vm.search_messages(conn, received_data)
-                            elif command == "delete_acct":
-                                self.vm.delete_account(conn, received_data, True)
-                            elif command == "send_msg":
-                                self.vm.deliver_message(conn, received_data, True)
-                            elif command == "get_undelivered":
-                                self.vm.get_undelivered_messages(conn, received_data)
-                            elif command == "get_delivered":
-                                self.vm.get_delivered_messages(conn, received_data)
-                            elif command == "refresh_home":
-                                self.vm.refresh_home(conn, received_data)
-                            elif command == "delete_msg":
-                                self.vm.delete_messages(conn, received_data, True)
-                            else:
-                                # Command not recognized
-                                print(f"No valid command: {received_data}")
-                                data.outb = data.outb[len(received_data) :]
-                        elif msg["command"] == "get_database":
-                            for addr, sock in self.connected_servers:
-                                if addr[0] == msg["host"] and addr[1] == msg["port"]:
-                                    sock.sendall(
-                                        (
-                                            json.dumps(
-                                                {
-                                                    "version": 0,
-                                                    "command": "set_database",
-                                                    "data": {
-                                                        "users": self.vm.database[
-                                                            "users"
-                                                        ],
-                                                        "messages": self.vm.database[
-                                                            "messages"
-                                                        ],
-                                                        "settings": self.vm.database[
-                                                            "settings"
-                                                        ],
-                                                    },
-                                                }
-                                            )
-                                            + "\0"
-                                        ).encode("utf-8")
-                                    )
-                        elif msg["command"] == "set_database":
-                            print(f"INTERNAL {self.id}: Updating users database")
-                            self.vm.database["users"] = msg["data"]["users"]
-                            print(f"INTERNAL {self.id}: Updating messages database")
-                            self.vm.database["messages"] = msg["data"]["messages"]
-                            print(f"INTERNAL {self.id}: Updating settings database")
-                            self.vm.database["settings"] = msg["data"]["settings"]
-                            database_wrapper.save_database(
-                                self.id,
-                                self.vm.database["users"],
-                                self.vm.database["messages"],
-                                self.vm.database["settings"],
-                            )
-                            print(f"INTERNAL {self.id}: Updating COMPLETE database")
-                            self.loaded_database = True
-                        else:
-                            print(f"INTERNAL {self.id}: Error parsing message: {line}")
-                    except Exception as e:
-                        print(
-                            f"INTERNAL {self.id}: Error parsing message: {e}\n\nLINE: {line}"
-                        )
+    def handle_received(self, conn, data):
+        """
+        Handles every complete message received so far on a connection.
+        """
+        # Process complete messages, each terminated by "\0". A message with a
+        # "length" is followed by that many bytes of binary payload
+        while True:
+            end = data.outb.find(b"\0")
+            if end == -1:
+                break
+            line = data.outb[:end].decode("utf-8", errors="replace")
+            try:
+                msg = json.loads(line)
+                payload_end = end + 1 + msg.get("length", 0)
+            except (json.JSONDecodeError, AttributeError) as e:
+                print(f"INTERNAL {self.id}: Error parsing message: {e}\n\nLINE: {line}")
+                del data.outb[: end + 1]
+                continue
+
+            if len(data.outb) < payload_end:
+                # Wait for the rest of the payload
+                break
+            payload = bytes(data.outb[end + 1 : payload_end])
+            del data.outb[:payload_end]
+            self.handle_message(conn, msg, payload, line)
 
-                data.outb = data.outb[len(data.outb.decode("utf-8")) :]
+    def handle_message(self, conn, msg, payload, line):
+        """Handles a message from another server, along with its binary payload."""
+        try:
+            if not self.commands.handle(msg["command"], conn, msg, payload):
+                print(f"INTERNAL {self.id}: Error parsing message: {line}")
+        except Exception as e:
+            print(f"INTERNAL {self.id}: Error parsing message: {e}\n\nLINE: {line}")
+
+    def handle_ping(self, conn, msg, payload):
+        pass
+
+    def handle_internal_update(self, conn, msg, payload):
+        if "leader" in msg["data"]:
+            self.leader = msg["data"]["leader"]
+            print(f"INTERNAL {self.id}: Leader updated to {self.leader}")
+
+    def handle_distributed_update(self, conn, msg, payload):
+        """Applies a change replicated by another server."""
+        update = msg["data"]
+        with self.vm.transaction():
+            handled = self.updates.handle(update["command"], conn, None, update["data"])
+        if not handled:
+            # Command not recognized
+            print(f"No valid command: {update}")
+
+    def send_database(self, conn, msg, payload):
+        """Sends the database to the server that asked for it."""
+        # The database is sent as a binary snapshot following the message
+        snapshot = snapshot_format.dumps(self.vm.export_database())
+        header = {
+            "version": 0,
+            "command": "set_database",
+            "length": len(snapshot),
+        }
+        for addr, sock in self.connected_servers:
+            if addr[0] == msg["host"] and addr[1] == msg["port"]:
+                sock.sendall(json.dumps(header).encode("utf-8") + b"\0")
+                sock.sendall(snapshot)
+
+    def set_database(self, conn, msg, payload):
+        """Replaces the database with the one sent by the leader."""
+        print(f"INTERNAL {self.id}: Updating database")
+        self.vm.replace_database(snapshot_format.loads(payload))
+        print(f"INTERNAL {self.id}: Updating COMPLETE database")
+        self.loaded_database = True
 
     def accept_wrapper(self, sock):
         """
@@ -253,9 +291,9 @@ class InternalCommunicator(threading.Thread):
         conn, addr = sock.accept()
         print(f"INTERNAL: Accepted connection from {addr}")
         conn.setblocking(False)
-        data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"")
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        self.sel.register(conn, events, data=data)
+        data = types.SimpleNamespace(addr=addr, inb=b"", outb=bytearray())
+        # Nothing is ever written back on these connections, so only wait for reads
+        self.sel.register(conn, selectors.EVENT_READ, data=data)
 
     def run(self):
         """Starts a TCP server to listen for incoming connections and messages."""
@@ -272,8 +310,13 @@ class InternalCommunicator(threading.Thread):
 
         while True:
             events = self.sel.select(timeout=None)
-            for key, mask in events:
-                if key.data is None:
-                    self.accept_wrapper(key.fileobj)
-                else:
-                    self.handle_connection(key, mask)
+            with self.vm.db_lock:
+                for key, mask in events:
+                    if key.data is None:
+                        self.accept_wrapper(key.fileobj)
+                    else:
+                        self.handle_connection(key, mask)
+
+                # Replicated changes are persisted with the batch of the client loop,
+                # which is woken up to flush it once its commit window has passed
+                self.vm.wake_loop()
@@ -1,7 +1,14 @@
+import async_server
 import server
 import argparse
+import retention
+import socket
 import sys
 
+# Offset between the internal ports of consecutive workers of a node, so that each
+# partition replicates with the same partition on the other nodes
+WORKER_PORT_STRIDE = 100
+
 
 def parse_args(args):
     """
@@ -38,6 +45,101 @@ def parse_args(args):
         default="10",
         help="Comma-separated list of other server ports.",
     )
+    parser.add_argument(
+        "--snapshot_interval",
+        type=float,
+        default=60.0,
+        help="Seconds between background snapshots of the database.",
+    )
+    parser.add_argument(
+        "--snapshot_log_bytes",
+        type=int,
+        default=16 * 1024 * 1024,
+        help="Write-ahead log size in bytes that triggers an early snapshot.",
+    )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        choices=["json", "sqlite"],
+        default="json",
+        help="Storage engine for the database.",
+    )
+    parser.add_argument(
+        "--durability",
+        type=str,
+        choices=["commit", "batch", "async"],
+        default="batch",
+        help="When changes are fsynced, and whether replies wait for them.",
+    )
+    parser.add_argument(
+        "--commit_window_ms",
+        type=float,
+        default=0.0,
+        help="Milliseconds to keep grouping changes before persisting them.",
+    )
+    parser.add_argument(
+        "--hot_messages",
+        type=int,
+        default=100,
+        help="Delivered messages per user kept in memory; -1 keeps all of them.",
+    )
+    parser.add_argument(
+        "--history_cache_pages",
+        type=int,
+        default=64,
+        help="Pages of archived delivered messages cached in memory.",
+    )
+    parser.add_argument(
+        "--message_bodies",
+        type=str,
+        choices=["inline", "mmap", "zlib"],
+        default="mmap",
+        help="Whether message bodies are kept in memory, in a memory-mapped file, or "
+        "compressed in a memory-mapped file.",
+    )
+    parser.add_argument(
+        "--retention_max_age",
+        type=float,
+        default=None,
+        help="Seconds after which delivered messages are evicted.",
+    )
+    parser.add_argument(
+        "--retention_max_messages",
+        type=int,
+        default=None,
+        help="Delivered messages kept per user before the oldest are evicted.",
+    )
+    parser.add_argument(
+        "--retention_max_bytes",
+        type=int,
+        default=None,
+        help="Total bytes of delivered message bodies kept before evicting.",
+    )
+    parser.add_argument(
+        "--retention_interval",
+        type=float,
+        default=60.0,
+        help="Seconds between passes of the retention worker.",
+    )
+    parser.add_argument(
+        "--retention_batch_size",
+        type=int,
+        default=1000,
+        help="Messages evicted per batch by the retention worker.",
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["selectors", "asyncio"],
+        default="selectors",
+        help="Event loop that serves clients and replication traffic.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes per server, each owning a partition of the users.",
+    )
     return parser.parse_args(args)
 
 
@@ -47,21 +149,60 @@ def main():
     server_ports = [args.start_server_port + i for i in range(args.num_servers)]
     internal_ports = [args.start_internal_port + i for i in range(args.num_servers)]
 
+    server_class = (
+        async_server.AsyncFaultTolerantServer
+        if args.engine == "asyncio"
+        else server.FaultTolerantServer
+    )
     processes = []
 
     for i, port in enumerate(server_ports):
-        # Start a server for each port
-        ser = server.FaultTolerantServer(
-            id=i,
-            host=args.host,
-            port=port,
-            current_starting_port=internal_ports[i],
-            internal_other_servers=args.internal_other_servers.split(","),
-            internal_other_ports=list(map(int, args.internal_other_ports.split(","))),
-            internal_max_ports=list(map(int, args.internal_max_ports.split(","))),
-        )
-        ser.start()
-        processes.append(ser)
+        # Links between every pair of workers of this server, keyed by worker
+        links = [{} for _ in range(args.workers)]
+        for a in range(args.workers):
+            for b in range(a + 1, args.workers):
+                links[a][b], links[b][a] = socket.socketpair()
+
+        # Start a server for each port, with a process for each worker
+        for worker in range(args.workers):
+            offset = worker * WORKER_PORT_STRIDE
+            ser = server_class(
+                id=i,
+                host=args.host,
+                port=port,
+                current_starting_port=internal_ports[i] + offset,
+                internal_other_servers=args.internal_other_servers.split(","),
+                internal_other_ports=[
+                    int(other_port) + offset
+                    for other_port in args.internal_other_ports.split(",")
+                ],
+                internal_max_ports=list(map(int, args.internal_max_ports.split(","))),
+                snapshot_interval=args.snapshot_interval,
+                snapshot_log_bytes=args.snapshot_log_bytes,
+                storage=args.storage,
+                durability=args.durability,
+                commit_window=args.commit_window_ms / 1000,
+                hot_messages=args.hot_messages if args.hot_messages >= 0 else None,
+                history_cache_pages=args.history_cache_pages,
+                message_bodies=args.message_bodies,
+                retention_policy=retention.RetentionPolicy(
+                    max_age=args.retention_max_age,
+                    max_messages=args.retention_max_messages,
+                    max_bytes=args.retention_max_bytes,
+                ),
+                retention_interval=args.retention_interval,
+                retention_batch_size=args.retention_batch_size,
+                partition=worker,
+                num_partitions=args.workers,
+                partition_links=links[worker],
+            )
+            ser.start()
+            processes.append(ser)
+
+        # The workers have their own copies of the links
+        for worker_links in links:
+            for link in worker_links.values():
+                link.close()
 
     try:
         for ser in processes:
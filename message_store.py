@@ -0,0 +1,751 @@
+"""
+Message Store Module
+
+This script implements the in-memory store for the undelivered and delivered messages of a
+server. Besides the two boxes themselves, the store keeps a mailbox per receiver so that
+handlers never have to walk the messages of every other user.
+
+Key Features:
+- Keeps both boxes as ordered tables keyed by message ID, in the order messages were filed.
+- Maintains an ordered mailbox per receiver for each box, kept in sync on insert, move
+  and delete, so that unread counts are O(1) and fetching N messages is O(N).
+- Indexes every message by ID with its box and receiver, so deleting k messages is O(k).
+- Indexes messages by sender, so deleting an account only touches the messages that
+  account sent or received.
+- Stores each message as a compact slotted record with interned sender and receiver
+  names, instead of a dictionary per message.
+- Optionally stores message bodies in an append-only body segment read through mmap,
+  keeping only a reference to each body in memory. Compressed segments get a new
+  dictionary, trained from the most recent bodies, whenever they are compacted, and a
+  store started without any body is compacted once it has enough bodies to train one.
+- Optionally moves the oldest delivered messages of each receiver to a history store on
+  disk, so that only undelivered and recent delivered messages stay in memory.
+- Loads mailboxes from a snapshot lazily: each mailbox is kept encoded, with only its
+  summary (number of messages, senders, size and smallest ID) decoded, until a handler
+  first touches it.
+- Records when messages sent with a TTL expire, so that the server can schedule their
+  expiry again after a restart.
+- Tracks the size of the bodies in every mailbox, and compacts the body segment and
+  history into new generations once deleted messages take up too much of them.
+- Converts to and from the plain {"undelivered": [...], "delivered": [...]} layout, and
+  to and from the per-mailbox layout used by binary snapshots and by the full-state sync
+  between servers.
+"""
+
+import json
+import sys
+from collections import OrderedDict, namedtuple
+from itertools import islice
+
+import body_store
+import snapshot_format
+
+BOXES = ("undelivered", "delivered")
+
+# Mailbox loaded from a snapshot but not decoded yet: its entries as encoded by
+# snapshot_format.encode_entries (or as a JSON list of [id, sender, body] entries, in
+# older snapshots), the number of entries, the names of their senders in the order the
+# entries refer to them, the number of bytes of their bodies and the smallest of their IDs
+EncodedMailbox = namedtuple(
+    "EncodedMailbox", ["data", "count", "senders", "size", "min_id"]
+)
+
+
+class Message:
+    """
+    A stored message. Records use __slots__ instead of a per-instance dictionary, and
+    usernames are interned so that every message of a user shares the same strings.
+    Records are converted to dictionaries only when they are written to JSON.
+
+    `message` is either the body itself or a body_store.Body reference to it.
+    """
+
+    __slots__ = ("id", "sender", "receiver", "message")
+
+    def __init__(self, id, sender, receiver, message):
+        self.id = id
+        self.sender = sys.intern(sender)
+        self.receiver = sys.intern(receiver)
+        self.message = message
+
+    @classmethod
+    def from_dict(cls, msg_obj, bodies=None):
+        """
+        Builds a record from a {"id", "sender", "receiver", "message"} dictionary, or
+        from a snapshot entry whose "body" refers to a body in the `bodies` segment.
+        """
+        if "body" in msg_obj:
+            message = bodies.ref(*msg_obj["body"])
+        else:
+            message = msg_obj["message"]
+        return cls(msg_obj["id"], msg_obj["sender"], msg_obj["receiver"], message)
+
+    def to_dict(self, body_refs=False):
+        """
+        Returns the record as a {"id", "sender", "receiver", "message"} dictionary. With
+        `body_refs`, a body stored in a segment is given as a "body" reference instead.
+        """
+        msg_obj = {"id": self.id, "sender": self.sender, "receiver": self.receiver}
+        if body_refs and not isinstance(self.message, str):
+            msg_obj["body"] = [self.message.offset, self.message.length]
+        else:
+            msg_obj["message"] = self.text
+        return msg_obj
+
+    @property
+    def text(self):
+        """
+        The body of the message, read from its body segment if it is stored in one.
+        """
+        return str(self.message)
+
+    @property
+    def body_size(self):
+        """
+        The number of bytes the body takes in storage.
+        """
+        if isinstance(self.message, str):
+            return len(self.message.encode("utf-8"))
+        return self.message.length
+
+    @property
+    def stored_body(self):
+        """
+        The body itself, or the (offset, length) of the body in its segment.
+        """
+        if isinstance(self.message, str):
+            return self.message
+        return (self.message.offset, self.message.length)
+
+    def encoded_message(self):
+        """
+        Returns the body encoded as a JSON string, sliced straight from the segment
+        mapping if it is stored in one.
+        """
+        if isinstance(self.message, str):
+            return json.dumps(self.message, ensure_ascii=False).encode("utf-8")
+        return self.message.raw()
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return (self.id, self.sender, self.receiver, self.text) == (
+            other.id,
+            other.sender,
+            other.receiver,
+            other.text,
+        )
+
+    def __repr__(self):
+        return (
+            f"Message(id={self.id!r}, sender={self.sender!r}, "
+            f"receiver={self.receiver!r}, message={self.message!r})"
+        )
+
+
+class MessageStore:
+    """
+    Undelivered and delivered messages, indexed by receiver.
+
+    Indexing the store with a box name (e.g. store["delivered"]) returns the messages in
+    that box as a list of dictionaries, and assigning a list of dictionaries to a box
+    replaces its contents. Both are O(total messages) and only meant for serialization
+    and tests; handlers should use the mailbox methods, which take and return Message
+    records.
+
+    With a `history` (a history_store.HistoryStore), once a receiver has more delivered
+    messages in memory than the history's `hot_messages`, the oldest page of them is
+    archived to disk. The mailbox methods cover archived messages transparently. With
+    `bodies` (a body_store.BodySegment), the body of every message filed in the store is
+    appended to that segment and only a reference to it is kept.
+
+    Mailboxes added with add_encoded_mailbox are only decoded once a method needs their
+    messages; counting them does not decode them.
+    """
+
+    def __init__(self, undelivered=(), delivered=(), history=None, bodies=None):
+        # Box name -> message ID -> message, in filing order
+        self._boxes = {box: OrderedDict() for box in BOXES}
+        # Box name -> receiver -> message ID -> message, in filing order
+        self._mailboxes = {box: {} for box in BOXES}
+        # Message ID -> (box name, receiver)
+        self._locations = {}
+        # Sender -> IDs of the messages they sent, across both boxes
+        self._sent = {}
+        # Box name -> receiver -> mailbox that has not been decoded yet
+        self._encoded = {box: {} for box in BOXES}
+        # Box name -> number of messages in mailboxes that have not been decoded yet
+        self._encoded_sizes = {box: 0 for box in BOXES}
+        # Box name -> receiver -> bytes of the bodies in their mailbox, decoded or not
+        self._body_bytes = {box: {} for box in BOXES}
+        # Message ID -> (receiver, time it expires at) of the messages sent with a TTL
+        self._expirations = {}
+        # Delivered messages archived on disk
+        self.history = history
+        # Segment holding the bodies of the messages
+        self.bodies = bodies
+
+        for msg_obj in undelivered:
+            self.add(Message.from_dict(msg_obj, bodies), "undelivered")
+        for msg_obj in delivered:
+            self.add(Message.from_dict(msg_obj, bodies), "delivered")
+
+    @classmethod
+    def from_dict(cls, messages, history=None, bodies=None):
+        """
+        Builds a store from the {"undelivered": [...], "delivered": [...]} layout.
+        """
+        return cls(messages["undelivered"], messages["delivered"], history, bodies)
+
+    def to_dict(self):
+        """
+        Returns the contents of the store in the {"undelivered": [...], "delivered": [...]}
+        layout, including archived messages.
+        """
+        return {box: self[box] for box in BOXES}
+
+    def snapshot(self):
+        """
+        Returns the contents of the store to be written to a snapshot, as a list of
+        [box, receiver, count, senders, size, min_id, data] mailboxes where data holds
+        their entries encoded by snapshot_format.encode_entries. Mailboxes that were
+        never decoded are included as they were loaded. Archived messages and stored
+        bodies are already on disk, so only the page index of the history and references
+        to the bodies are included.
+        """
+        return encode_snapshot(self.copy_snapshot())
+
+    def copy_snapshot(self):
+        """
+        Returns what snapshot does, except that the entries of decoded mailboxes are
+        copied as (id, sender, body) tuples instead of being encoded. It does not share
+        anything the store mutates, so encode_snapshot can be called on it without
+        holding the lock that guards the store.
+        """
+        decoded = []
+        mailboxes = []
+        for box in BOXES:
+            for receiver, mailbox in self._mailboxes[box].items():
+                decoded.append(
+                    [
+                        box,
+                        receiver,
+                        [
+                            (msg.id, msg.sender, msg.stored_body)
+                            for msg in mailbox.values()
+                        ],
+                        self._body_bytes[box][receiver],
+                        (),
+                    ]
+                )
+            for receiver, encoded in self._encoded[box].items():
+                mailboxes.append(
+                    [
+                        box,
+                        receiver,
+                        encoded.count,
+                        list(encoded.senders),
+                        encoded.size,
+                        encoded.min_id,
+                        encoded.data,
+                    ]
+                )
+
+        messages = {"mailboxes": mailboxes, "decoded": decoded}
+        if self._expirations:
+            messages["expirations"] = self.expirations()
+        if self.history is not None:
+            messages["history"] = self.history.to_dict()
+        if self.bodies is not None:
+            messages["bodies"] = self.bodies.to_dict()
+        return messages
+
+    def export(self):
+        """
+        Returns the contents of the store, including archived messages, in the
+        per-mailbox layout of snapshot, but with every body included in its mailbox, to
+        be sent to another server in a full-state sync.
+        """
+        self._decode_all()
+
+        archived = {}
+        if self.history is not None:
+            for msg in self.history.messages():
+                archived.setdefault(msg.receiver, []).append(msg)
+
+        mailboxes = []
+        for box in BOXES:
+            receivers = self._mailboxes[box]
+            if box == "delivered":
+                receivers = dict.fromkeys([*archived, *receivers])
+            for receiver in receivers:
+                msgs = self._mailboxes[box].get(receiver, {}).values()
+                if box == "delivered":
+                    msgs = [*archived.get(receiver, ()), *msgs]
+                mailboxes.append(
+                    encode_mailbox(
+                        box,
+                        receiver,
+                        [(msg.id, msg.sender, msg.text) for msg in msgs],
+                        sum(msg.body_size for msg in msgs),
+                    )
+                )
+        return {"mailboxes": mailboxes, "expirations": self.expirations()}
+
+    def add_mailbox(self, box, receiver, count, senders, size, min_id, data):
+        """
+        Files every message of a mailbox in the layout returned by snapshot or export,
+        as add does, so that their bodies are stored and old messages archived the way
+        this store does.
+        """
+        for msg_id, sender, body in decode_mailbox(data, senders):
+            if not isinstance(body, str):
+                body = self.bodies.ref(*body)
+            self.add(Message(msg_id, sender, receiver, body), box)
+
+    def add_encoded_mailbox(self, box, receiver, count, senders, size, min_id, data):
+        """
+        Adds a mailbox from a snapshot without decoding it. The receiver must not have
+        any other message in that box yet.
+        """
+        receiver = sys.intern(receiver)
+        self._encoded[box][receiver] = EncodedMailbox(
+            data, count, tuple(senders), size, min_id
+        )
+        self._encoded_sizes[box] += count
+        self._body_bytes[box][receiver] = size
+
+    def _decode(self, box, receiver):
+        """
+        Decodes a mailbox that was added with add_encoded_mailbox, if there is one.
+        """
+        encoded = self._encoded[box].pop(receiver, None)
+        if encoded is None:
+            return
+        self._encoded_sizes[box] -= encoded.count
+
+        # Messages are filed directly, as their bodies are already stored and the
+        # mailbox held fewer messages than the history's threshold when it was saved
+        receiver = sys.intern(receiver)
+        mailbox = self._mailboxes[box].setdefault(receiver, OrderedDict())
+        size = 0
+        for msg_id, sender, body in decode_mailbox(encoded.data, encoded.senders):
+            if isinstance(body, list):
+                body = self.bodies.ref(*body)
+            msg = Message(msg_id, sender, receiver, body)
+            self._boxes[box][msg_id] = msg
+            mailbox[msg_id] = msg
+            self._locations[msg_id] = (box, receiver)
+            self._sent.setdefault(msg.sender, set()).add(msg_id)
+            size += msg.body_size
+        self._body_bytes[box][receiver] = size
+
+    def _decode_all(self, box=None):
+        """
+        Decodes every mailbox of a box, or of both boxes, that was added with
+        add_encoded_mailbox.
+        """
+        for decoded_box in BOXES if box is None else (box,):
+            for receiver in list(self._encoded[decoded_box]):
+                self._decode(decoded_box, receiver)
+
+    def __getitem__(self, box):
+        self._decode_all(box)
+        msgs = self._boxes[box].values()
+        if box == "delivered" and self.history is not None:
+            msgs = list(self.history.messages()) + list(msgs)
+        return [msg.to_dict() for msg in msgs]
+
+    def __setitem__(self, box, msg_objs):
+        for msg_id, msg in self._boxes[box].items():
+            del self._locations[msg_id]
+            self._unindex_sender(msg)
+        self._boxes[box] = OrderedDict()
+        self._mailboxes[box] = {}
+        self._encoded[box] = {}
+        self._encoded_sizes[box] = 0
+        self._body_bytes[box] = {}
+        if box == "delivered" and self.history is not None:
+            self.history.clear()
+        for msg_obj in msg_objs:
+            self.add(Message.from_dict(msg_obj, self.bodies), box)
+
+    def size(self, box):
+        """
+        Returns the number of messages in a box, across all receivers.
+        """
+        size = len(self._boxes[box]) + self._encoded_sizes[box]
+        if box == "delivered" and self.history is not None:
+            size += self.history.size()
+        return size
+
+    def has_messages(self, box):
+        """
+        Returns whether a box holds any message at all.
+        """
+        if self._boxes[box] or self._encoded_sizes[box]:
+            return True
+        if box == "delivered" and self.history is not None:
+            return self.history.has_messages()
+        return False
+
+    def add(self, msg, box):
+        """
+        Files a message at the end of a box and of its receiver's mailbox.
+        """
+        if self.bodies is not None and isinstance(msg.message, str):
+            msg.message = self.bodies.append(msg.message)
+
+        self._decode(box, msg.receiver)
+        self._boxes[box][msg.id] = msg
+        self._mailboxes[box].setdefault(msg.receiver, OrderedDict())[msg.id] = msg
+        self._locations[msg.id] = (box, msg.receiver)
+        self._sent.setdefault(msg.sender, set()).add(msg.id)
+        self._body_bytes[box][msg.receiver] = (
+            self._body_bytes[box].get(msg.receiver, 0) + msg.body_size
+        )
+
+        if box == "delivered":
+            self._archive(msg.receiver)
+
+    def _archive(self, receiver):
+        """
+        Moves the oldest page of a receiver's delivered messages to the history once
+        they have more than `hot_messages` delivered messages in memory.
+        """
+        if self.history is None or self.history.hot_messages is None:
+            return
+
+        mailbox = self._mailboxes["delivered"][receiver]
+        if len(mailbox) < self.history.hot_messages + self.history.page_size:
+            return
+
+        msgs = list(islice(mailbox.values(), self.history.page_size))
+        for msg in msgs:
+            self._remove("delivered", msg)
+        self.history.archive(receiver, msgs)
+
+    def _unindex_sender(self, msg):
+        """
+        Removes a message from the index of its sender.
+        """
+        sent = self._sent[msg.sender]
+        sent.discard(msg.id)
+        if not sent:
+            del self._sent[msg.sender]
+
+    def locate(self, msg_id, receiver=None):
+        """
+        Returns the (box, receiver) pair of a message, or None if it is not stored in
+        memory. Passing the receiver, if known, avoids decoding other mailboxes.
+        """
+        if receiver is None:
+            self._decode_all()
+        else:
+            for box in BOXES:
+                self._decode(box, receiver)
+        return self._locations.get(msg_id)
+
+    def _remove(self, box, msg):
+        """
+        Removes a message from a box and from its receiver's mailbox.
+        """
+        del self._boxes[box][msg.id]
+        del self._locations[msg.id]
+        self._unindex_sender(msg)
+        mailbox = self._mailboxes[box][msg.receiver]
+        del mailbox[msg.id]
+        self._body_bytes[box][msg.receiver] -= msg.body_size
+        if not mailbox:
+            del self._mailboxes[box][msg.receiver]
+            del self._body_bytes[box][msg.receiver]
+
+    def count(self, receiver, box="undelivered"):
+        """
+        Returns the number of messages in a receiver's mailbox.
+        """
+        encoded = self._encoded[box].get(receiver)
+        if encoded is not None:
+            count = encoded.count
+        else:
+            count = len(self._mailboxes[box].get(receiver, ()))
+        if box == "delivered" and self.history is not None:
+            count += self.history.count(receiver)
+        return count
+
+    def receivers(self, box="delivered"):
+        """
+        Returns the receivers that have messages in a box.
+        """
+        receivers = set(self._mailboxes[box]).union(self._encoded[box])
+        if box == "delivered" and self.history is not None:
+            receivers.update(self.history.pages)
+        return receivers
+
+    def body_bytes(self, box="delivered", receiver=None):
+        """
+        Returns the number of bytes of the bodies in a receiver's mailbox, or in a whole
+        box.
+        """
+        if receiver is None:
+            size = sum(self._body_bytes[box].values())
+        else:
+            size = self._body_bytes[box].get(receiver, 0)
+        if box == "delivered" and self.history is not None:
+            size += self.history.body_bytes(receiver)
+        return size
+
+    def oldest_id(self, receiver, box="delivered"):
+        """
+        Returns the smallest message ID in a receiver's mailbox, or None if it is empty.
+        Mailboxes that were not decoded yet and archived pages are not read.
+        """
+        ids = []
+        encoded = self._encoded[box].get(receiver)
+        if encoded is not None:
+            ids.append(encoded.min_id)
+        mailbox = self._mailboxes[box].get(receiver)
+        if mailbox:
+            ids.append(min(mailbox))
+        if box == "delivered" and self.history is not None:
+            archived_id = self.history.oldest_id(receiver)
+            if archived_id is not None:
+                ids.append(archived_id)
+        return min(ids, default=None)
+
+    def peek(self, receiver, num_messages, box="delivered"):
+        """
+        Returns up to `num_messages` of the oldest messages in a receiver's mailbox.
+        """
+        self._decode(box, receiver)
+
+        msgs = []
+        if box == "delivered" and self.history is not None:
+            msgs = self.history.peek(receiver, num_messages)
+
+        mailbox = self._mailboxes[box].get(receiver)
+        if mailbox is not None:
+            msgs.extend(islice(mailbox.values(), num_messages - len(msgs)))
+        return msgs
+
+    def deliver(self, receiver, num_messages):
+        """
+        Moves up to `num_messages` of the oldest undelivered messages of a receiver to
+        the delivered box, and returns them.
+        """
+        self._decode("undelivered", receiver)
+        mailbox = self._mailboxes["undelivered"].get(receiver)
+        if mailbox is None:
+            return []
+
+        moved = []
+        while mailbox and len(moved) < num_messages:
+            _, msg = mailbox.popitem(last=False)
+            del self._boxes["undelivered"][msg.id]
+            self._body_bytes["undelivered"][receiver] -= msg.body_size
+            self.add(msg, "delivered")
+            moved.append(msg)
+
+        if not mailbox:
+            del self._mailboxes["undelivered"][receiver]
+            del self._body_bytes["undelivered"][receiver]
+        return moved
+
+    def deliver_ids(self, msg_ids, receiver=None):
+        """
+        Moves the undelivered messages with the given IDs to the delivered box. IDs of
+        messages that are not undelivered are ignored. Passing the receiver, if known,
+        avoids decoding other mailboxes.
+        """
+        if receiver is None:
+            self._decode_all("undelivered")
+        else:
+            self._decode("undelivered", receiver)
+
+        for msg_id in msg_ids:
+            location = self._locations.get(msg_id)
+            if location is not None and location[0] == "undelivered":
+                msg = self._boxes["undelivered"][msg_id]
+                self._remove("undelivered", msg)
+                self.add(msg, "delivered")
+
+    def delete(self, receiver, msg_ids, box="delivered"):
+        """
+        Deletes the messages with the given IDs that are in a receiver's mailbox, and
+        returns the IDs that were actually deleted. IDs of messages that belong to
+        another receiver or box are ignored.
+        """
+        self._decode(box, receiver)
+
+        msg_ids = list(msg_ids)
+        deleted_ids = []
+        archived_ids = []
+        for msg_id in msg_ids:
+            if self._locations.get(msg_id) == (box, receiver):
+                self._remove(box, self._boxes[box][msg_id])
+                deleted_ids.append(msg_id)
+            else:
+                archived_ids.append(msg_id)
+
+        if box == "delivered" and self.history is not None and archived_ids:
+            # Report the IDs in the order they were requested
+            deleted = set(deleted_ids).union(
+                self.history.delete(receiver, archived_ids)
+            )
+            deleted_ids = [
+                msg_id for msg_id in dict.fromkeys(msg_ids) if msg_id in deleted
+            ]
+        return deleted_ids
+
+    def remove_user(self, username):
+        """
+        Removes every message that a user sent or received. Only that user's messages
+        are visited, regardless of how many messages other users have.
+        """
+        for box in BOXES:
+            for receiver, encoded in list(self._encoded[box].items()):
+                if receiver == username or username in encoded.senders:
+                    self._decode(box, receiver)
+
+        msg_ids = set(self._sent.get(username, ()))
+        for box in BOXES:
+            msg_ids.update(self._mailboxes[box].get(username, ()))
+
+        for msg_id in msg_ids:
+            box, _ = self._locations[msg_id]
+            self._remove(box, self._boxes[box][msg_id])
+
+        if self.history is not None:
+            self.history.remove_user(username)
+
+    def set_expiry(self, msg_id, receiver, expires_at):
+        """
+        Records that a message expires at `expires_at`, in seconds since the epoch.
+        """
+        self._expirations[msg_id] = (sys.intern(receiver), expires_at)
+
+    def pop_expiry(self, msg_id):
+        """
+        Forgets when a message expires, and returns its (receiver, expiry time) pair, or
+        None if it was not sent with a TTL.
+        """
+        return self._expirations.pop(msg_id, None)
+
+    def expirations(self):
+        """
+        Returns the [id, receiver, expiry time] entries of every message that is yet to
+        expire. Messages that were deleted before expiring may still be listed.
+        """
+        return [
+            [msg_id, receiver, expires_at]
+            for msg_id, (receiver, expires_at) in self._expirations.items()
+        ]
+
+    def garbage_ratio(self):
+        """
+        Returns the fraction of the body segment and history file taken by bodies and
+        pages that are no longer used, e.g. because their messages were deleted.
+        """
+        stored, live = 0, 0
+        if self.bodies is not None:
+            stored += self.bodies.stored_bytes()
+            # Every body is followed by a newline in the segment
+            live += sum(self.body_bytes(box) + self.size(box) for box in BOXES)
+        if self.history is not None:
+            stored += self.history.stored_bytes()
+            live += self.history.live_bytes()
+        if not stored:
+            return 0.0
+        return max(0.0, 1 - live / stored)
+
+    def compact(self):
+        """
+        Copies the bodies and archived pages that are still used to new generations of
+        the body segment and history file, leaving out the space taken by deleted
+        messages. Every mailbox is decoded first. The old generations stay on disk until
+        a snapshot that no longer refers to them is written.
+        """
+        self._decode_all()
+
+        old_bodies, old_history = self.bodies, self.history
+        bodies = None
+        if self.bodies is not None:
+            dictionary = None
+            if self.bodies.compress:
+                # Compaction is the only time the dictionary can change, so retrain it
+                # on the most recent bodies
+                dictionary = body_store.train_dictionary(
+                    msg.message.raw()
+                    for box in BOXES
+                    for msg in islice(reversed(self._boxes[box].values()), 4096)
+                    if not isinstance(msg.message, str)
+                )
+            bodies = self.bodies.new_generation(dictionary)
+            for box in BOXES:
+                for msg in self._boxes[box].values():
+                    if not isinstance(msg.message, str):
+                        msg.message = bodies.append_encoded(msg.message.raw())
+            self.bodies = bodies
+
+        if self.history is not None:
+            self.history = self.history.compacted(bodies)
+
+        # Nothing is appended to the old generations anymore
+        if old_bodies is not None:
+            old_bodies.close()
+        if old_history is not None:
+            old_history.close()
+
+
+def encode_mailbox(box, receiver, entries, size, senders=()):
+    """
+    Returns the [box, receiver, count, senders, size, min_id, data] snapshot layout of a
+    non-empty mailbox holding the given (id, sender, body) entries.
+    """
+    senders = list(dict.fromkeys([*senders, *(sender for _, sender, _ in entries)]))
+    return [
+        box,
+        receiver,
+        len(entries),
+        senders,
+        size,
+        min(msg_id for msg_id, _, _ in entries),
+        snapshot_format.encode_entries(entries, senders),
+    ]
+
+
+def encode_snapshot(messages):
+    """
+    Encodes the mailboxes copied by MessageStore.copy_snapshot, returning the layout
+    returned by MessageStore.snapshot.
+    """
+    messages = dict(messages)
+    mailboxes = []
+    for box, receiver, entries, size, senders in messages.pop("decoded"):
+        if entries:
+            mailboxes.append(encode_mailbox(box, receiver, entries, size, senders))
+    messages["mailboxes"] = mailboxes + messages["mailboxes"]
+    return messages
+
+
+def decode_mailbox(data, senders):
+    """
+    Decodes the [id, sender, body] entries of a mailbox from a snapshot.
+    """
+    return snapshot_format.decode_entries(data, senders)
+
+
+def encode_entries(msgs):
+    """
+    Encodes messages of a single mailbox as a list of [id, sender, body] entries, where
+    body is either the body itself or the [offset, length] of the body in its segment.
+    """
+    entries = []
+    for msg in msgs:
+        if isinstance(msg.message, str):
+            entries.append([msg.id, msg.sender, msg.message])
+        else:
+            entries.append(
+                [msg.id, msg.sender, [msg.message.offset, msg.message.length]]
+            )
+    return json.dumps(entries, separators=(",", ":")).encode("utf-8")
@@ -0,0 +1,163 @@
+"""
+Partitioning Module
+
+This script implements how the users of a node are partitioned across the worker processes
+started with `--workers`, so that a node can use more than one core. Every worker is a
+FaultTolerantServer with its own database, write-ahead log and replication, and all of them
+accept clients on the same port. A worker handles the requests for the users it owns
+itself, and routes the others to the worker that owns them.
+
+Key Features:
+- Assigns every user to a partition with a CRC32 hash of their username, so every worker
+  agrees on the owner of a user without coordinating with the others.
+- Routes each command by the user whose data it reads or changes: the receiver of a
+  message, and the logged in user for every other command.
+- Sends requests, replies and updates between the workers of a node as length-prefixed
+  frames on links created with socket pairs, and matches each reply to the callback that
+  waits for it by a request ID.
+"""
+
+import itertools
+import json
+import struct
+import zlib
+
+import framing
+
+# Kinds of frames sent on a link between two workers
+REQUEST = 1
+REPLY = 2
+UPDATE = 3
+
+# Kind, request ID and length of the client address that follows
+LINK_HEADER = struct.Struct("!BIH")
+
+# Field of the request data naming the user whose partition handles each command.
+# Commands without one are handled by the worker that received them
+ROUTING_KEYS = {
+    "create": "username",
+    "login": "username",
+    "logout": "username",
+    "delete_acct": "username",
+    "send_msg": "recipient",
+    "get_undelivered": "username",
+    "get_delivered": "username",
+    "refresh_home": "username",
+    "delete_msg": "current_user",
+    "wait_for_messages": "username",
+}
+
+
+def partition_of(username: str, count: int):
+    """
+    Returns the partition that owns a user, out of `count` partitions.
+    """
+    return zlib.crc32(username.strip().encode("utf-8")) % count
+
+
+def encode_link_frame(kind, request_id, body: bytes, addr=None):
+    """
+    Encodes a frame to send on a link between two workers. Requests carry the address
+    of the client that sent them, as sessions are keyed by it.
+    """
+    addr = f"{addr[0]}:{addr[1]}".encode("utf-8") if addr is not None else b""
+    return framing.encode_frame(
+        LINK_HEADER.pack(kind, request_id, len(addr)) + addr + body
+    )
+
+
+def decode_link_frame(frame: bytes):
+    """
+    Decodes a frame received on a link into its kind, request ID, client address (or
+    None) and body.
+    """
+    kind, request_id, addr_length = LINK_HEADER.unpack_from(frame)
+    start = LINK_HEADER.size
+    addr = None
+    if addr_length:
+        host, _, port = (
+            frame[start : start + addr_length].decode("utf-8").rpartition(":")
+        )
+        addr = (host, int(port))
+    return kind, request_id, addr, frame[start + addr_length :]
+
+
+class RoutedRequest:
+    """
+    Stands in for a client's socket while a worker handles a request on behalf of
+    another worker, or of a client of its own whose reply it has to combine with those
+    of other workers: replies are passed to a callback instead of being sent.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def send(self, payload):
+        self.callback(bytes(payload))
+        return len(payload)
+
+
+class PartitionRouter:
+    """
+    Routes requests between the workers of a node. `links` maps the partition of every
+    other worker to a function that sends bytes to it, and is filled in by the engine
+    that serves the links.
+    """
+
+    def __init__(self, index: int, count: int):
+        self.index = index
+        self.count = count
+        self.links = {}
+
+        # Request ID -> callback waiting for the reply
+        self.waiting = {}
+        self.request_ids = itertools.count()
+
+    def partition_of(self, username):
+        """
+        Returns the partition that owns a user, or None if `username` is not a string,
+        in which case the request is left to fail where it was received.
+        """
+        if not isinstance(username, str):
+            return None
+        return partition_of(username, self.count)
+
+    def owner(self, command, command_data):
+        """
+        Returns the partition that handles a command, or None if any worker can.
+        """
+        key = ROUTING_KEYS.get(command)
+        if key is None or not isinstance(command_data, dict):
+            return None
+        return self.partition_of(command_data.get(key))
+
+    def forward(self, partition, addr, frame: bytes, callback):
+        """
+        Sends a request to the worker owning `partition`, and calls `callback` with the
+        reply once it comes back.
+        """
+        request_id = next(self.request_ids) % 2**32
+        self.waiting[request_id] = callback
+        self.links[partition](encode_link_frame(REQUEST, request_id, frame, addr))
+
+    def reply(self, partition, request_id, payload: bytes):
+        """
+        Sends the reply to a request back to the worker that forwarded it.
+        """
+        self.links[partition](encode_link_frame(REPLY, request_id, payload))
+
+    def complete(self, request_id, payload: bytes):
+        """
+        Passes a reply received from another worker to the callback waiting for it.
+        """
+        callback = self.waiting.pop(request_id, None)
+        if callback is not None:
+            callback(payload)
+
+    def notify(self, update):
+        """
+        Sends an update to every other worker, without waiting for a reply.
+        """
+        frame = encode_link_frame(UPDATE, 0, json.dumps(update).encode("utf-8"))
+        for send in self.links.values():
+            send(frame)
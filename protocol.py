@@ -0,0 +1,392 @@
+"""
+Protocol Module
+
+This script implements version 1 of the client protocol, a compact binary encoding of the
+requests and replies that version 0 sends as JSON objects, and the client side of the
+negotiation of which version a connection uses.
+
+Key Features:
+- Version 1 payloads start with a struct-packed header of the version and an opcode for
+  the command, followed by the fields of the command in a fixed order: integers packed
+  with struct, and strings as UTF-8 prefixed with their length. No field names are sent.
+- Sends lists of strings and of messages column by column, so that decoding a list takes
+  a single struct unpack and a single UTF-8 decode whatever its length.
+- Version 0 payloads are JSON objects, which never start with the version 1 header, so a
+  payload is decoded according to its first byte wherever it comes from.
+- A connection uses version 0 until the client negotiates another version with a "hello"
+  request, sent in version 0, which the server answers with the highest version both of
+  them support. Version 1 messages are sent as length-prefixed frames.
+- Commands without an opcode, and servers or clients that do not negotiate, fall back to
+  JSON, so either side can be upgraded first.
+- Sets aside the new_message frames that servers push to logged in clients, so that they
+  are never mistaken for the reply to a request.
+"""
+
+import collections
+import itertools
+import json
+import math
+import select
+import socket
+import struct
+
+import framing
+
+VERSION = 1
+# Protocol versions this module can encode and decode
+VERSIONS = (0, 1)
+
+# Version and opcode at the start of every version 1 payload
+HEADER = struct.Struct("!BB")
+
+INT = struct.Struct("!i")
+COUNT = struct.Struct("!I")
+SHORT_LENGTH = struct.Struct("!H")
+TTL = struct.Struct("!d")
+
+# Field types
+STR = "str"  # UTF-8 prefixed with a 2-byte length
+TEXT = "text"  # UTF-8 prefixed with a 4-byte length, for message bodies
+NUMBER = "int"  # 4-byte signed integer
+OPTIONAL_SECONDS = "ttl"  # 8-byte float, NaN when there is none
+IDS = "ids"  # 4-byte count, then a 4-byte unsigned integer per ID
+# Lists of strings are sent column by column: the length of every string in characters,
+# then all of the strings as a single TEXT, so that a list is decoded with one struct
+# unpack and one UTF-8 decode, and its strings are sliced out of the decoded text
+STRS = "strs"  # 4-byte count, 2-byte lengths, then the strings
+MESSAGES = "messages"  # 4-byte count, IDs, sender and body lengths, senders, bodies
+
+# Command -> opcode and fields of requests
+REQUESTS = {
+    "create": (1, (("username", STR), ("password", STR))),
+    "login": (2, (("username", STR), ("password", STR))),
+    "logout": (3, (("username", STR),)),
+    "search": (4, (("search", STR),)),
+    "delete_acct": (5, (("username", STR),)),
+    "send_msg": (
+        6,
+        (
+            ("sender", STR),
+            ("recipient", STR),
+            ("message", TEXT),
+            ("ttl", OPTIONAL_SECONDS),
+        ),
+    ),
+    "get_undelivered": (7, (("username", STR), ("num_messages", NUMBER))),
+    "get_delivered": (8, (("username", STR), ("num_messages", NUMBER))),
+    "refresh_home": (9, (("username", STR),)),
+    "delete_msg": (10, (("current_user", STR), ("delete_ids", IDS))),
+    "check_connection": (11, ()),
+    "wait_for_messages": (12, (("username", STR), ("timeout", OPTIONAL_SECONDS))),
+}
+
+# Command -> opcode and fields of replies
+REPLIES = {
+    "login": (64, (("username", STR), ("undeliv_messages", NUMBER))),
+    "user_list": (65, (("user_list", STRS),)),
+    "refresh_home": (66, (("undeliv_messages", NUMBER),)),
+    "messages": (67, (("messages", MESSAGES),)),
+    "logout": (68, ()),
+    "error": (69, (("error", STR),)),
+    "new_message": (70, (("id", NUMBER), ("sender", STR), ("message", TEXT))),
+    "new_messages": (71, (("undeliv_messages", NUMBER), ("messages", MESSAGES))),
+}
+
+# Replies the server sends without being asked, to clients that negotiated version 1
+PUSHES = {"new_message"}
+
+REQUEST_OPCODES = {
+    opcode: (command, fields) for command, (opcode, fields) in REQUESTS.items()
+}
+REPLY_OPCODES = {
+    opcode: (command, fields) for command, (opcode, fields) in REPLIES.items()
+}
+
+
+class ProtocolError(framing.FrameError):
+    """
+    Raised when a version 1 payload cannot be decoded.
+    """
+
+
+def is_binary(payload):
+    """
+    Returns whether a payload is encoded in version 1 rather than as JSON.
+    """
+    return payload[:1] == b"\x01"
+
+
+def encode_str(value, length=SHORT_LENGTH):
+    encoded = value.encode("utf-8")
+    return length.pack(len(encoded)) + encoded
+
+
+def encode_delete_ids(value):
+    """
+    Encodes message IDs, given either as a list of integers or as a comma-separated
+    string, skipping the entries that are not valid IDs as the server does.
+    """
+    if isinstance(value, str):
+        value = value.split(",")
+    ids = [
+        int(msg_id)
+        for msg_id in value
+        if isinstance(msg_id, int) or msg_id.strip().isdigit()
+    ]
+    return COUNT.pack(len(ids)) + struct.pack(f"!{len(ids)}I", *ids)
+
+
+def encode_strs(strings):
+    return (
+        COUNT.pack(len(strings))
+        + struct.pack(f"!{len(strings)}H", *map(len, strings))
+        + encode_str("".join(strings), COUNT)
+    )
+
+
+def encode_messages(ids, senders, bodies):
+    count = len(ids)
+    return (
+        COUNT.pack(count)
+        + struct.pack(
+            f"!{count}I{count}H{count}I",
+            *ids,
+            *map(len, senders),
+            *map(len, bodies),
+        )
+        + encode_str("".join(senders) + "".join(bodies), COUNT)
+    )
+
+
+def encode_field(kind, value):
+    if kind == STR:
+        return encode_str(value)
+    if kind == TEXT:
+        return encode_str(value, COUNT)
+    if kind == NUMBER:
+        return INT.pack(value)
+    if kind == OPTIONAL_SECONDS:
+        return TTL.pack(math.nan if value is None else value)
+    if kind == IDS:
+        return encode_delete_ids(value)
+    if kind == STRS:
+        return encode_strs(value)
+    # MESSAGES
+    return encode_messages(
+        [msg["id"] for msg in value],
+        [msg["sender"] for msg in value],
+        [msg["message"] for msg in value],
+    )
+
+
+def encode_binary(table, command, data):
+    opcode, fields = table[command]
+    return HEADER.pack(VERSION, opcode) + b"".join(
+        encode_field(kind, data.get(name)) for name, kind in fields
+    )
+
+
+def decode_str(payload, offset, length=SHORT_LENGTH):
+    (size,) = length.unpack_from(payload, offset)
+    offset += length.size
+    end = offset + size
+    if end > len(payload):
+        raise ProtocolError("string runs past the end of the payload")
+    return str(payload[offset:end], "utf-8"), end
+
+
+def decode_strs(payload, offset, lengths):
+    """
+    Decodes the strings of a list field, given their lengths in characters, and returns
+    them along with the offset of the next field.
+    """
+    text, offset = decode_str(payload, offset, COUNT)
+    bounds = list(itertools.accumulate(lengths, initial=0))
+    if bounds[-1] != len(text):
+        raise ProtocolError("string lengths do not add up to the strings sent")
+    return [text[start:end] for start, end in zip(bounds, bounds[1:])], offset
+
+
+def decode_field(kind, payload, offset):
+    """
+    Decodes a field starting at `offset`, and returns it along with the offset of the
+    next field.
+    """
+    if kind == STR:
+        return decode_str(payload, offset)
+    if kind == TEXT:
+        return decode_str(payload, offset, COUNT)
+    if kind == NUMBER:
+        return INT.unpack_from(payload, offset)[0], offset + INT.size
+    if kind == OPTIONAL_SECONDS:
+        (value,) = TTL.unpack_from(payload, offset)
+        return (None if math.isnan(value) else value), offset + TTL.size
+
+    (count,) = COUNT.unpack_from(payload, offset)
+    offset += COUNT.size
+    if kind == IDS:
+        ids = struct.unpack_from(f"!{count}I", payload, offset)
+        return list(ids), offset + 4 * count
+    if kind == STRS:
+        lengths = struct.unpack_from(f"!{count}H", payload, offset)
+        return decode_strs(payload, offset + 2 * count, lengths)
+    # MESSAGES
+    columns = struct.unpack_from(f"!{count}I{count}H{count}I", payload, offset)
+    strings, offset = decode_strs(payload, offset + 10 * count, columns[count:])
+    msgs = [
+        {"id": msg_id, "sender": sender, "message": message}
+        for msg_id, sender, message in zip(
+            columns[:count], strings[:count], strings[count:]
+        )
+    ]
+    return msgs, offset
+
+
+def decode_binary(opcodes, payload):
+    try:
+        version, opcode = HEADER.unpack_from(payload)
+        if opcode not in opcodes:
+            raise ProtocolError(f"unknown opcode {opcode}")
+        command, fields = opcodes[opcode]
+        offset = HEADER.size
+        data = {}
+        for name, kind in fields:
+            data[name], offset = decode_field(kind, payload, offset)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ProtocolError(f"malformed payload: {e}") from e
+    if offset != len(payload):
+        raise ProtocolError("trailing bytes after the last field")
+    return {"version": version, "command": command, "data": data}
+
+
+def encode_request(command, data, version=0):
+    """
+    Encodes a request in the given version, or as JSON if the command has no opcode.
+    """
+    if version >= 1 and command in REQUESTS:
+        return encode_binary(REQUESTS, command, data)
+    return json.dumps({"version": 0, "command": command, "data": data}).encode("utf-8")
+
+
+def encode_reply(command, data, version=0):
+    """
+    Encodes a reply in the given version, or as JSON if the command has no opcode.
+    """
+    if version >= 1 and command in REPLIES:
+        return encode_binary(REPLIES, command, data)
+    return json.dumps({"version": 0, "command": command, "data": data}).encode("utf-8")
+
+
+def decode_request(payload):
+    """
+    Decodes a request in either version into a {"version", "command", "data"}
+    dictionary. Raises ProtocolError if a version 1 payload is malformed.
+    """
+    if is_binary(payload):
+        return decode_binary(REQUEST_OPCODES, payload)
+    return json.loads(payload)
+
+
+def decode_reply(payload):
+    """
+    Decodes a reply in either version into a {"version", "command", "data"} dictionary.
+    Raises ProtocolError if a version 1 payload is malformed.
+    """
+    if is_binary(payload):
+        return decode_binary(REPLY_OPCODES, payload)
+    return json.loads(payload)
+
+
+def encode_messages_reply(msgs):
+    """
+    Encodes a "messages" reply in version 1 straight from stored message records.
+    """
+    return HEADER.pack(VERSION, REPLIES["messages"][0]) + encode_messages(
+        [msg.id for msg in msgs],
+        [msg.sender for msg in msgs],
+        [msg.text for msg in msgs],
+    )
+
+
+class Connection:
+    """
+    Client side of a connection to a server. Sends requests and receives replies in the
+    version negotiated with the server, which is version 0 until negotiate succeeds.
+    Messages the server pushes are collected in `pushed` until poll_pushes is called.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.version = 0
+        self.frames = framing.FrameDecoder()
+        self.replies = collections.deque()
+        self.pushed = []
+
+    def negotiate(self, timeout=1.0):
+        """
+        Asks the server for the highest version both sides support, and uses it from
+        then on. Servers that do not answer in time are spoken to in version 0.
+        """
+        hello = {"version": 0, "command": "hello", "data": {"versions": list(VERSIONS)}}
+        self.sock.sendall(json.dumps(hello).encode("utf-8") + framing.TERMINATOR)
+        self.sock.settimeout(timeout)
+        try:
+            reply = json.loads(self.sock.recv(1024))
+        except (socket.timeout, ValueError):
+            return self.version
+        finally:
+            self.sock.settimeout(None)
+        if reply.get("command") == "hello" and reply["data"]["version"] in VERSIONS:
+            self.version = reply["data"]["version"]
+        return self.version
+
+    def send_request(self, request):
+        """
+        Sends a request given as a {"version", "command", "data"} dictionary.
+        """
+        if self.version == 0:
+            self.sock.sendall(json.dumps(request).encode("utf-8") + framing.TERMINATOR)
+            return
+        payload = encode_request(request["command"], request["data"], self.version)
+        self.sock.sendall(framing.encode_frame(payload))
+
+    def receive(self):
+        """
+        Waits for bytes from the server, and sorts the frames completed by them into
+        replies and pushed messages.
+        """
+        received = self.sock.recv(65536)
+        if not received:
+            raise ConnectionError("connection closed")
+        self.frames.feed(received)
+        for frame in self.frames:
+            reply = decode_reply(frame)
+            if reply["command"] in PUSHES:
+                self.pushed.append(reply["data"])
+            else:
+                self.replies.append(reply)
+
+    def recv_reply(self):
+        """
+        Waits for the next reply, and returns it as a {"version", "command", "data"}
+        dictionary.
+        """
+        if self.version == 0:
+            return json.loads(self.sock.recv(1024).decode("utf-8"))
+        while not self.replies:
+            self.receive()
+        return self.replies.popleft()
+
+    def poll_pushes(self):
+        """
+        Returns the messages pushed by the server since the last call, without waiting
+        for more.
+        """
+        if self.version >= 1:
+            while select.select([self.sock], [], [], 0)[0]:
+                self.receive()
+        pushed, self.pushed = self.pushed, []
+        return pushed
+
+    def close(self):
+        self.sock.close()
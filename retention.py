@@ -0,0 +1,242 @@
+"""
+Retention Module
+
+This script implements retention policies for delivered messages and the background worker
+that enforces them, so that the messages a long-running server keeps, and the cost of
+snapshotting them, stay bounded.
+
+Key Features:
+- Evicts delivered messages once they are older than `max_age` seconds, once a user has
+  more than `max_messages` of them, or once their bodies take more than `max_bytes` in
+  total, starting with the oldest messages of the largest mailboxes.
+- Tracks the age of messages without storing a timestamp per message: message IDs only
+  grow, so sampling the message counter on every pass tells which IDs were handed out
+  before a given time.
+- Evicts in batches of at most `batch_size` messages, releasing the database lock between
+  batches so that clients are served in between.
+- Persists evictions as delete_messages records and replicates them to the other servers
+  as delete_msg updates, the same way a user deleting their own messages is.
+- Only evicts on the leader, so that every server applies the same evictions; the other
+  servers keep sampling the counter in case they take over.
+- Compacts the storage of every server once unused space, left behind by evicted or
+  deleted messages, makes up more than `compact_ratio` of it.
+"""
+
+import heapq
+import threading
+import time
+from collections import deque, namedtuple
+
+# Limits on the delivered messages that are kept; None disables a limit
+RetentionPolicy = namedtuple(
+    "RetentionPolicy",
+    ["max_age", "max_messages", "max_bytes"],
+    defaults=(None, None, None),
+)
+
+
+def policy_enabled(policy):
+    """
+    Returns whether a retention policy sets any limit.
+    """
+    return any(limit is not None for limit in policy)
+
+
+class RetentionWorker(threading.Thread):
+    """
+    Background thread that enforces a retention policy on the messages of a running
+    server every `interval` seconds. Eviction and compaction happen while holding the
+    server's database lock.
+    """
+
+    def __init__(
+        self, server, policy, interval=60.0, batch_size=1000, compact_ratio=0.5
+    ):
+        super().__init__(daemon=True)
+
+        self.server = server
+        self.policy = policy
+        self.interval = interval
+        self.batch_size = batch_size
+        self.compact_ratio = compact_ratio
+        self.stopped = threading.Event()
+
+        # (time, message counter) samples, oldest first
+        self._counter_samples = deque()
+
+    def sample_counter(self, now=None):
+        """
+        Records the current value of the message counter, and drops the samples that are
+        no longer needed to tell which messages have expired.
+        """
+        if now is None:
+            now = time.time()
+        self._counter_samples.append((now, self.server.database["settings"]["counter"]))
+
+        if self.policy.max_age is not None:
+            cutoff = now - self.policy.max_age
+            while (
+                len(self._counter_samples) > 1 and self._counter_samples[1][0] <= cutoff
+            ):
+                self._counter_samples.popleft()
+
+    def expired_id(self, now=None):
+        """
+        Returns the largest message ID known to be older than `max_age`, or None if no
+        message is known to be.
+        """
+        if self.policy.max_age is None or not self._counter_samples:
+            return None
+        if now is None:
+            now = time.time()
+
+        sampled_at, counter = self._counter_samples[0]
+        if sampled_at > now - self.policy.max_age:
+            return None
+        return counter
+
+    def _evict_expired(self, budget):
+        """
+        Evicts up to `budget` delivered messages older than `max_age`.
+        """
+        expired_id = self.expired_id()
+        if expired_id is None:
+            return 0
+
+        messages = self.server.database["messages"]
+        evicted = 0
+        for receiver in messages.receivers():
+            if evicted >= budget:
+                break
+            oldest_id = messages.oldest_id(receiver)
+            if oldest_id is None or oldest_id > expired_id:
+                continue
+
+            msg_ids = [
+                msg.id
+                for msg in messages.peek(receiver, budget - evicted)
+                if msg.id <= expired_id
+            ]
+            evicted += len(self.server.evict_messages(receiver, msg_ids))
+        return evicted
+
+    def _evict_over_count(self, budget):
+        """
+        Evicts up to `budget` of the oldest delivered messages of the users that have
+        more than `max_messages`.
+        """
+        if self.policy.max_messages is None:
+            return 0
+
+        messages = self.server.database["messages"]
+        evicted = 0
+        for receiver in messages.receivers():
+            if evicted >= budget:
+                break
+            excess = messages.count(receiver, "delivered") - self.policy.max_messages
+            if excess <= 0:
+                continue
+
+            msg_ids = [
+                msg.id for msg in messages.peek(receiver, min(excess, budget - evicted))
+            ]
+            evicted += len(self.server.evict_messages(receiver, msg_ids))
+        return evicted
+
+    def _evict_over_bytes(self, budget):
+        """
+        Evicts up to `budget` delivered messages while their bodies take more than
+        `max_bytes`, taking the oldest messages of the largest mailbox until it is no
+        larger than the next one.
+        """
+        if self.policy.max_bytes is None:
+            return 0
+
+        messages = self.server.database["messages"]
+        excess = messages.body_bytes() - self.policy.max_bytes
+        if excess <= 0:
+            return 0
+
+        # Max-heap of mailboxes by size
+        sizes = [
+            (-messages.body_bytes(receiver=receiver), receiver)
+            for receiver in messages.receivers()
+        ]
+        heapq.heapify(sizes)
+
+        evicted = 0
+        while sizes and excess > 0 and evicted < budget:
+            size, receiver = heapq.heappop(sizes)
+            size = -size
+            next_size = -sizes[0][0] if sizes else 0
+
+            msg_ids = []
+            for msg in messages.peek(receiver, min(budget - evicted, 64)):
+                if msg_ids and (excess <= 0 or size < next_size):
+                    break
+                msg_ids.append(msg.id)
+                excess -= msg.body_size
+                size -= msg.body_size
+
+            deleted_ids = self.server.evict_messages(receiver, msg_ids)
+            evicted += len(deleted_ids)
+            if deleted_ids and size > 0:
+                heapq.heappush(sizes, (-size, receiver))
+        return evicted
+
+    def evict_batch(self):
+        """
+        Evicts up to `batch_size` messages that break the policy, and returns how many
+        were evicted.
+        """
+        with self.server.db_lock, self.server.transaction():
+            evicted = self._evict_expired(self.batch_size)
+            evicted += self._evict_over_count(self.batch_size - evicted)
+            evicted += self._evict_over_bytes(self.batch_size - evicted)
+
+            # The worker is not tied to the client loop, so persist the batch right away
+            self.server.committer.flush()
+        return evicted
+
+    def compact(self):
+        """
+        Compacts the storage of the messages if enough of it is unused. Returns whether
+        it was compacted.
+        """
+        with self.server.db_lock:
+            messages = self.server.database["messages"]
+            if messages.garbage_ratio() < self.compact_ratio:
+                return False
+            messages.compact()
+        return True
+
+    def run_once(self):
+        """
+        Samples the message counter and, on the leader, evicts batches until nothing
+        breaks the policy. Every server then compacts its own storage if needed. Returns
+        the number of evicted messages.
+        """
+        with self.server.db_lock:
+            self.sample_counter()
+
+        evicted = 0
+        if self.server.internal_communicator.is_leader():
+            while not self.stopped.is_set():
+                batch = self.evict_batch()
+                evicted += batch
+                if batch < self.batch_size:
+                    break
+
+        self.compact()
+        return evicted
+
+    def run(self):
+        self.run_once()
+        while not self.stopped.wait(self.interval):
+            self.run_once()
+
+    def stop(self):
+        """
+        Stops the thread after its current pass.
+        """
+        self.stopped.set()
@@ -17,7 +17,6 @@ import tkinter as tk
 from tkinter import messagebox
 import socket
 import re
-import json
 
 
 def delete_message(
@@ -46,8 +45,7 @@ def delete_message(
         "command": "delete_msg",
         "data": {"delete_ids": delete_ids_str, "current_user": current_user},
     }
-    message = (json.dumps(message_dict) + "\0").encode("utf-8")
-    s().sendall(message)
+    s().send_request(message_dict)
 
     # Close the Tkinter window after sending the request
     root.destroy()
@@ -62,8 +60,7 @@ def launch_home(s: socket.socket, root: tk.Tk, username: str):
         "command": "refresh_home",
         "data": {"username": username},
     }
-    message = (json.dumps(message_dict) + "\0").encode("utf-8")
-    s().sendall(message)
+    s().send_request(message_dict)
 
     # Close the Tkinter window to return to home screen
     root.destroy()
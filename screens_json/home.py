@@ -8,6 +8,7 @@ From this interface, users can:
 - Delete messages from their inbox.
 - View a list of users in the system.
 - Log out or delete their account.
+- See the messages sent to them while the screen is open, as the server pushes them.
 
 This screen acts as a central navigation hub for user interactions.
 Also note that this script uses JSON format to structure and send search queries and refresh requests to the server.
@@ -16,13 +17,13 @@ Last updated: February 12, 2025
 """
 
 import tkinter as tk
+from tkinter import messagebox
 import socket
 import screens_json.signup
 import screens_json.user_list
 import screens_json.send_message
 import screens_json.messages
 import screens_json.delete_messages
-import json
 
 
 def open_read_messages(s: socket.socket, root: tk.Tk, username: str):
@@ -62,7 +63,7 @@ def logout(s: socket.socket, root: tk.Tk, username: str):
     Sends a logout request to the server and closes the application.
     """
     message_dict = {"version": 0, "command": "logout", "data": {"username": username}}
-    s().sendall((json.dumps(message_dict) + "\0").encode("utf-8"))
+    s().send_request(message_dict)
     root.destroy()
 
 
@@ -75,10 +76,26 @@ def delete_account(s: socket.socket, root: tk.Tk, username: str):
         "command": "delete_acct",
         "data": {"username": username},
     }
-    s().sendall((json.dumps(message_dict) + "\0").encode("utf-8"))
+    s().send_request(message_dict)
     root.destroy()
 
 
+def show_pushed_messages(s, root: tk.Tk):
+    """
+    Shows the messages the server pushed since the last check, then checks again in
+    half a second.
+    """
+    conn = s()
+    try:
+        pushed = conn.poll_pushes() if conn is not None else []
+    except (OSError, ValueError):
+        # The connection is lost, which the client notices when it next reads a reply
+        pushed = []
+    for msg in pushed:
+        messagebox.showinfo(f"New message from {msg['sender']}", msg["message"])
+    root.after(500, lambda: show_pushed_messages(s, root))
+
+
 def launch_window(s, username: str, num_messages: int):
     """
     Creates and displays the main home window with user options.
@@ -128,5 +145,8 @@ def launch_window(s, username: str, num_messages: int):
         command=lambda: delete_account(s, home_root, username),
     ).pack()
 
+    # Show new messages as they are pushed by the server
+    show_pushed_messages(s, home_root)
+
     # Run the main event loop
     home_root.mainloop()
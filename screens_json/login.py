@@ -18,7 +18,6 @@ from tkinter import messagebox
 import hashlib
 import socket
 import screens_json.signup
-import json
 
 
 def login(s, root: tk.Tk, username: tk.StringVar, password: tk.StringVar):
@@ -47,10 +46,9 @@ def login(s, root: tk.Tk, username: tk.StringVar, password: tk.StringVar):
             "password": hashlib.sha256(password_str.encode("utf-8")).hexdigest(),
         },
     }
-    message = (json.dumps(message_dict) + "\0").encode("utf-8")
 
     # Send login request to the server
-    s().sendall(message)
+    s().send_request(message_dict)
 
     # Close the login window after sending the credentials
     root.destroy()
@@ -16,7 +16,6 @@ Last updated: February 12, 2025
 import tkinter as tk
 from tkinter import scrolledtext, messagebox
 import socket
-import json
 
 
 def get_undelivered_messages(
@@ -40,7 +39,7 @@ def get_undelivered_messages(
     }
 
     # Send the request to fetch undelivered messages
-    s().sendall((json.dumps(message_dict) + "\0").encode("utf-8"))
+    s().send_request(message_dict)
 
     # Close the current Tkinter window
     root.destroy()
@@ -67,7 +66,7 @@ def get_delivered_messages(
     }
 
     # Send the request to fetch delivered messages
-    s().sendall((json.dumps(message_dict) + "\0").encode("utf-8"))
+    s().send_request(message_dict)
 
     # Close the current Tkinter window
     root.destroy()
@@ -92,8 +91,7 @@ def launch_home(s: socket.SocketType, root: tk.Tk, username: str):
         "command": "refresh_home",
         "data": {"username": username},
     }
-    message = (json.dumps(message_dict) + "\0").encode("utf-8")
-    s().sendall(message)
+    s().send_request(message_dict)
     root.destroy()
 
 
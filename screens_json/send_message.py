@@ -5,6 +5,7 @@ This script implements a Tkinter-based graphical user interface (GUI) for sendin
 Users can:
 - Enter the recipient's username and a message.
 - Validate that the recipient's username is alphanumeric.
+- Optionally have the message expire a number of seconds after it is sent.
 - Send the message to the server via a socket connection.
 - Navigate back to the home screen.
 
@@ -16,7 +17,6 @@ Last updated: February 12, 2025
 import tkinter as tk
 from tkinter import messagebox
 import socket
-import json
 
 
 def send_message(
@@ -25,6 +25,7 @@ def send_message(
     recipient: tk.StringVar,
     message: tk.Text,
     current_user: str,
+    ttl: tk.StringVar,
 ):
     """
     Sends a message from the current user to the specified recipient.
@@ -42,6 +43,18 @@ def send_message(
         messagebox.showerror("Error", "Username must be alphanumeric")
         return
 
+    # The expiry is optional, but must be a positive number of seconds when given
+    ttl_str = ttl.get().strip()
+    ttl_value = None
+    if ttl_str != "":
+        try:
+            ttl_value = float(ttl_str)
+        except ValueError:
+            ttl_value = 0
+        if not 0 < ttl_value < float("inf"):
+            messagebox.showerror("Error", "Expiry must be a positive number of seconds")
+            return
+
     # Format the message string for sending over the socket
     message_dict = {
         "version": 0,
@@ -52,8 +65,9 @@ def send_message(
             "message": message_str,
         },
     }
-    message = (json.dumps(message_dict) + "\0").encode("utf-8")
-    s().sendall(message)
+    if ttl_value is not None:
+        message_dict["data"]["ttl"] = ttl_value
+    s().send_request(message_dict)
 
     # Close the message window
     root.destroy()
@@ -68,8 +82,7 @@ def launch_home(s: socket.SocketType, root: tk.Tk, username: str):
         "command": "refresh_home",
         "data": {"username": username},
     }
-    message = (json.dumps(message_dict) + "\0").encode("utf-8")
-    s().sendall(message)
+    s().send_request(message_dict)
     root.destroy()
 
 
@@ -87,6 +100,11 @@ def launch_window(s, current_user: str):
     recipient_var = tk.StringVar(root)
     tk.Entry(root, textvariable=recipient_var).pack()
 
+    # Label and input field for the optional expiry of the message
+    tk.Label(root, text="Expires after (seconds, optional):").pack()
+    ttl_var = tk.StringVar(root)
+    tk.Entry(root, textvariable=ttl_var).pack()
+
     # Label and input field for message content
     tk.Label(root, text="Message:").pack()
     entry_message = tk.Text(root)
@@ -97,7 +115,7 @@ def launch_window(s, current_user: str):
         root,
         text="Send Message",
         command=lambda: send_message(
-            s, root, recipient_var, entry_message, current_user
+            s, root, recipient_var, entry_message, current_user, ttl_var
         ),
     )
     button_submit.pack()
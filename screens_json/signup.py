@@ -18,7 +18,6 @@ from tkinter import messagebox
 import socket
 import screens_json.login
 import hashlib
-import json
 
 
 def create_user(
@@ -51,9 +50,7 @@ def create_user(
             "password": hashlib.sha256(password_str.encode("utf-8")).hexdigest(),
         },
     }
-    message = (json.dumps(message_dict) + "\0").encode("utf-8")
-
-    s().sendall(message)
+    s().send_request(message_dict)
 
     # Close the signup window upon successful user creation request
     root.destroy()
@@ -16,7 +16,6 @@ import tkinter as tk
 from tkinter import messagebox
 from tkinter import scrolledtext
 import socket
-import json
 
 
 def search(s, root: tk.Tk, search: tk.StringVar):
@@ -41,8 +40,7 @@ def search(s, root: tk.Tk, search: tk.StringVar):
         "command": "search",
         "data": {"search": search_str},
     }
-    message = (json.dumps(message_dict) + "\0").encode("utf-8")
-    s().sendall(message)
+    s().send_request(message_dict)
     root.destroy()
 
 
@@ -65,8 +63,7 @@ def launch_home(s: socket.SocketType, root: tk.Tk, username: str):
         "command": "refresh_home",
         "data": {"username": username},
     }
-    message = (json.dumps(message_dict) + "\0").encode("utf-8")
-    s().sendall(message)
+    s().send_request(message_dict)
     # Close the current window
     root.destroy()
 
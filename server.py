@@ -1,12 +1,45 @@
+import command_table
+import contextlib
 import database_wrapper
 import fnmatch
+import framing
+import functools
+import group_commit
 import internal_communications
 import json
+import math
+import message_store
 import multiprocessing
+import partitioning
+import protocol
+import retention
 import selectors
 import socket
+import sqlite_store
+import threading
+import time
+import timer_wheel
 import types
 
+# Bytes of replies a client may leave unread before the server stops reading its requests
+MAX_PENDING_OUTPUT = 1024 * 1024
+
+# Seconds a wait_for_messages request is parked for when it does not say, and at most
+DEFAULT_WAIT_TIMEOUT = 30.0
+MAX_WAIT_TIMEOUT = 300.0
+
+
+def is_positive_seconds(value):
+    """
+    Returns whether a TTL or timeout sent by a client is a positive number of seconds.
+    """
+    return (
+        not isinstance(value, bool)
+        and isinstance(value, (int, float))
+        and math.isfinite(value)
+        and value > 0
+    )
+
 
 class FaultTolerantServer(multiprocessing.Process):
     def __init__(
@@ -18,10 +51,27 @@ class FaultTolerantServer(multiprocessing.Process):
         internal_other_servers=["localhost"],
         internal_other_ports=[60000],
         internal_max_ports=[10],
+        snapshot_interval=60.0,
+        snapshot_log_bytes=16 * 1024 * 1024,
+        storage="json",
+        durability="batch",
+        commit_window=0.0,
+        hot_messages=100,
+        history_cache_pages=64,
+        message_bodies="mmap",
+        retention_policy=None,
+        retention_interval=60.0,
+        retention_batch_size=1000,
+        partition=0,
+        num_partitions=1,
+        partition_links=None,
     ):
         super().__init__()
 
         self.id = f"{id}{port}"
+        # Workers that share a port each keep the database of their own partition
+        if num_partitions > 1:
+            self.id += f"p{partition}"
         self.host = host
         self.port = port
 
@@ -35,57 +85,213 @@ class FaultTolerantServer(multiprocessing.Process):
             "current_port": current_starting_port,
         }
 
-        users, messages, settings = database_wrapper.load_database(self.id)
-        self.database = {
-            "users": users,
-            "messages": messages,
-            "settings": settings,
-        }
+        self.storage = storage
+        self.durability = durability
+        # Loaded by open_database in the server process, as a loaded database holds
+        # views of memory-mapped files, and state of the write-ahead log kept by
+        # database_wrapper, neither of which a spawned process would get along with it
+        self.database = None
+
+        # Username -> address of the client they are logged in from. Sessions are
+        # volatile: they are never persisted, so every user is logged out on restart
+        self.sessions = {}
+
+        # Address -> socket and state of every client connected to this server, which
+        # new messages are pushed to
+        self.clients = {}
+
+        # Username -> wait_for_messages requests parked until a message for the user
+        # arrives or they time out
+        self.waiters = {}
+
+        self.committer = group_commit.GroupCommitter(
+            self.id, durability=durability, window=commit_window, send=self.send_held
+        )
+
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_log_bytes = snapshot_log_bytes
+        self.hot_messages = hot_messages
+        self.history_cache_pages = history_cache_pages
+        self.message_bodies = message_bodies
+        self.retention_policy = (
+            retention_policy
+            if retention_policy is not None
+            else retention.RetentionPolicy()
+        )
+        self.retention_interval = retention_interval
+        self.retention_batch_size = retention_batch_size
+
+        # Expires messages sent with a TTL, from the selector loop
+        self.timers = timer_wheel.TimerWheel()
+        # Socket written to from other threads to wake the selector loop up, so that
+        # it computes its timeout again after they scheduled a timer
+        self.wakeup = None
+
+        # Routes requests to the worker owning the users they concern, when the users of
+        # this node are partitioned across several worker processes. Links to the other
+        # workers are sockets, keyed by the partition of the worker at the other end
+        self.router = None
+        if num_partitions > 1:
+            self.router = partitioning.PartitionRouter(partition, num_partitions)
+        self.partition_links = partition_links or {}
+
+        # Handlers of the commands clients send, each passed the request once decoded
+        self.commands = command_table.CommandTable()
+        for command, handler in (
+            ("create", self.create_account),
+            ("login", self.login),
+            ("logout", self.logout),
+            ("search", self.search_messages),
+            ("delete_acct", self.delete_account),
+            ("send_msg", self.deliver_message),
+            ("get_undelivered", self.get_undelivered_messages),
+            ("get_delivered", self.get_delivered_messages),
+            ("refresh_home", self.refresh_home),
+            ("delete_msg", self.delete_messages),
+            ("wait_for_messages", self.wait_for_messages),
+            ("hello", self.negotiate_protocol),
+            ("check_connection", self.check_connection),
+            ("stats", self.send_stats),
+        ):
+            self.commands.register(command, handler)
 
         self.sel = None
 
-    def send_message(
-        self, sock: socket.socket, data_length: int, command, data, message: str
-    ):
+    def send_message(self, sock: socket.socket, command, data, message: str):
         """
-        Send a message back to the client. The message is a string, typically
-        prefixed with a short command name, followed by a JSON payload.
+        Send a message back to the client, encoded in the protocol version it
+        negotiated: as a JSON object in version 0, or packed in version 1.
         """
-        data_obj = {
-            "version": 0,
-            "command": command,
-            "data": message,
-        }
-        sock.send(json.dumps(data_obj).encode("utf-8"))
-        data.outb = data.outb[data_length:]
+        self.send_payload(
+            sock, data, protocol.encode_reply(command, message, data.version)
+        )
 
-    def send_error(
-        self, sock: socket.socket, data_length: int, data, error_message: str
-    ):
+    def send_messages(self, sock: socket.socket, data, msgs):
         """
-        Helper function to send an error message back to the client in JSON format.
+        Send a "messages" reply listing the given messages. Bodies are copied into the
+        reply already encoded, straight from the body segment when they are stored in
+        one, instead of being decoded and encoded again.
         """
-        error_obj = {
-            "version": 0,
-            "command": "error",
-            "data": {"error": error_message},
-        }
-        sock.send(json.dumps(error_obj).encode("utf-8"))
-        data.outb = data.outb[data_length:]
+        if data.version >= 1:
+            self.send_payload(sock, data, protocol.encode_messages_reply(msgs))
+            return
 
-    def parse_json_data(self, sock: socket.socket, data, internal_change=False):
-        if internal_change:
-            decoded_data = json.dumps(data)
+        entries = b", ".join(
+            b'{"id": %d, "sender": %b, "message": %b}'
+            % (msg.id, json.dumps(msg.sender).encode("utf-8"), msg.encoded_message())
+            for msg in msgs
+        )
+        self.send_payload(
+            sock,
+            data,
+            b'{"version": 0, "command": "messages", "data": {"messages": ['
+            + entries
+            + b"]}}",
+        )
+
+    def send_payload(self, sock: socket.socket, data, payload: bytes):
+        """
+        Send an encoded reply, unless the group committer holds it until the changes it
+        acknowledges are durable. Replies are length-prefixed for clients that send
+        length-prefixed frames, and collected in data.replies while service_connection
+        handles a batch of frames.
+        """
+        if data.frames.length_prefixed:
+            payload = framing.encode_frame(payload)
+        if self.committer.hold_reply(sock, payload):
+            return
+        if data.replies is not None:
+            data.replies.append(payload)
+        else:
+            self.queue_output(sock, data, payload)
+
+    def send_held(self, sock: socket.socket, payload: bytes):
+        """
+        Send replies that the group committer held, unless the client has disconnected
+        since.
+        """
+        if isinstance(sock, partitioning.RoutedRequest):
+            sock.send(payload)
+            return
+        try:
+            data = self.sel.get_key(sock).data
+        except (KeyError, ValueError):
+            return
+        self.queue_output(sock, data, payload)
+
+    def queue_output(self, sock: socket.socket, data, payload: bytes):
+        """
+        Send bytes to a client, queuing whatever the socket does not take right away
+        until it is writable again. Bytes are never sent ahead of those already queued.
+        """
+        if not data.pending:
+            try:
+                sent = sock.send(payload)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                # The connection is lost, which the next read reports
+                return
+            if sent == len(payload):
+                return
+            payload = memoryview(payload)[sent:]
+
+        data.pending += payload
+        self.update_events(sock, data)
+
+    def flush_output(self, sock: socket.socket, data):
+        """
+        Send as much of the queued output of a client as the socket takes.
+        """
+        try:
+            sent = sock.send(data.pending)
+        except BlockingIOError:
+            return
+        except OSError:
+            # The connection is lost, which the next read reports
+            sent = len(data.pending)
+        del data.pending[:sent]
+        self.update_events(sock, data)
+
+    def update_events(self, sock: socket.socket, data):
+        """
+        Only wait for a client to be writable while output is queued for it, and stop
+        reading its requests while too much of it is. Links to other workers are always
+        read, so that two workers never wait on each other to read.
+        """
+        if not data.pending:
+            events = selectors.EVENT_READ
+        elif len(data.pending) < MAX_PENDING_OUTPUT or data.partition is not None:
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE
         else:
-            decoded_data = data.outb.decode("utf-8").split("\0")[0]
-        json_data = json.loads(decoded_data)
+            events = selectors.EVENT_WRITE
+
+        if events != data.events:
+            self.sel.modify(sock, events, data=data)
+            data.events = events
+
+    def send_error(self, sock: socket.socket, data, error_message: str):
+        """
+        Helper function to send an error message back to the client.
+        """
+        self.send_message(sock, "error", data, {"error": error_message})
+
+    def parse_json_data(self, sock: socket.socket, data):
+        """
+        Parse the frame being handled, which handle_frame leaves in data.outb without
+        its framing. Frames are either JSON objects or version 1 binary requests. The
+        command is None if the client sent an unsupported version, which it is told.
+        """
+        decoded_data = data.outb
+        json_data = protocol.decode_request(decoded_data)
         version = json_data["version"]
         command = json_data["command"]
         command_data = json_data["data"]
-        data_length = len(decoded_data) + len("\0")
+        data_length = len(decoded_data)
 
-        if version != 0:
-            self.send_error(sock, data_length, data, "Unsupported protocol version")
+        if version not in protocol.VERSIONS:
+            self.send_error(sock, data, "Unsupported protocol version")
+            command = None
 
         return command, command_data, data, data_length
 
@@ -93,64 +299,217 @@ class FaultTolerantServer(multiprocessing.Process):
         """
         Return the number of undelivered messages for a specific user.
         """
-        num_messages = 0
-        for msg_obj in self.database["messages"]["undelivered"]:
-            if msg_obj["receiver"] == username:
-                num_messages += 1
-        return num_messages
+        return self.database["messages"].count(username)
+
+    def open_database(self):
+        """
+        Load the users, messages and settings tables of this server, replaying the
+        write-ahead log of the JSON engine.
+        """
+        if self.storage == "sqlite":
+            users, messages, settings = sqlite_store.load_database(
+                self.id, self.durability
+            )
+        else:
+            users, messages, settings = database_wrapper.load_database(
+                self.id,
+                hot_messages=self.hot_messages,
+                cache_pages=self.history_cache_pages,
+                mmap_bodies=self.message_bodies != "inline",
+                compress_bodies=self.message_bodies == "zlib",
+            )
+        self.database = {
+            "users": users,
+            "messages": messages,
+            "settings": settings,
+        }
+
+    def transaction(self):
+        """
+        Return a context manager that runs the changes made within it in a single
+        transaction with the SQLite engine. The JSON engine needs none, as its changes
+        are logged in batches anyway.
+        """
+        if self.storage == "sqlite":
+            return self.database["users"].db.transaction()
+        return contextlib.nullcontext()
+
+    def persist(self, *records):
+        """
+        Append mutation records to the write-ahead log, so that persisting a change
+        costs time proportional to the change rather than to the whole database.
+        """
+        if self.storage == "sqlite":
+            # SQLite commits the changes of each handler when its transaction ends
+            return
+        self.committer.commit(records)
+
+    def evict_messages(self, receiver: str, msg_ids):
+        """
+        Delete delivered messages of a receiver on behalf of the retention worker,
+        persist the deletion and replicate it to the other servers. Returns the IDs that
+        were actually deleted.
+        """
+        deleted_ids = self.database["messages"].delete(receiver, msg_ids)
+        if deleted_ids:
+            self.persist(
+                {"op": "delete_messages", "receiver": receiver, "ids": deleted_ids}
+            )
+            self.internal_communicator.distribute_update(
+                {
+                    "command": "delete_msg",
+                    "data": {"current_user": receiver, "delete_ids": deleted_ids},
+                }
+            )
+        return deleted_ids
 
-    def create_account(self, sock: socket.socket, unparsed_data, internal_change=False):
-        _, command_data, data, data_length = self.parse_json_data(
-            sock, unparsed_data, internal_change
+    def schedule_expiry(self, msg_id, receiver: str, expires_at):
+        """
+        Schedule a message sent with a TTL to be expired once `expires_at` has passed.
+        """
+        self.timers.schedule(
+            max(0.0, expires_at - time.time()), self.expire_message, msg_id, receiver
         )
-        username = command_data["username"].strip()
-        password = command_data["password"].strip()
+        # Followers schedule the expiry of replicated messages from the internal
+        # communicator's thread, while the selector loop may be waiting on a later timer
+        self.wake_loop()
 
-        if internal_change:
-            addr = command_data.get("addr")
+    def wake_loop(self):
+        """
+        Wake the selector loop up when called from another thread, so that it does
+        not sleep past a timer that thread scheduled, or the commit window of changes
+        it made.
+        """
+        if self.wakeup is None or threading.get_ident() == self.loop_thread:
+            return
+        try:
+            self.wakeup[1].send(b"\0")
+        except BlockingIOError:
+            # The loop has not drained the previous wakeups yet, so it is awake anyway
+            pass
 
-            self.database["users"][username] = {
-                "password": password,
-                "logged_in": True,
-                "addr": addr,
-            }
-            database_wrapper.save_database(
-                self.id,
+    def schedule_expirations(self):
+        """
+        Schedule the expiry of every stored message that was sent with a TTL, replacing
+        the timers scheduled so far.
+        """
+        self.timers.clear()
+        for msg_id, receiver, expires_at in self.database["messages"].expirations():
+            self.schedule_expiry(msg_id, receiver, expires_at)
+
+    def expire_message(self, msg_id, receiver: str):
+        """
+        Delete a message whose TTL has run out, whether it was delivered or not, and
+        persist the deletion. Every server expires messages on its own timers, so the
+        deletion is not replicated.
+        """
+        messages = self.database["messages"]
+        if messages.pop_expiry(msg_id) is None:
+            return
+
+        location = messages.locate(msg_id, receiver)
+        box = location[0] if location is not None else "delivered"
+        messages.delete(receiver, [msg_id], box)
+        self.persist(
+            {"op": "expire_message", "id": msg_id, "receiver": receiver, "box": box}
+        )
+
+    def export_database(self):
+        """
+        Return the whole database, along with the current sessions, as the tables of a
+        full-state sync, to be encoded with snapshot_format. Messages are in the
+        per-mailbox layout, with their bodies included.
+        """
+        return {
+            "users": dict(self.database["users"].items()),
+            "messages": self.database["messages"].export(),
+            "settings": dict(self.database["settings"]),
+            "sessions": dict(self.sessions),
+        }
+
+    def replace_database(self, database):
+        """
+        Replace the whole database with the tables of a full-state sync, as returned by
+        export_database, and persist it in full.
+        """
+        # Write out the pending batch first, so that it is covered by the new snapshot
+        self.committer.flush()
+
+        self.sessions = dict(database.get("sessions", {}))
+
+        if self.storage == "sqlite":
+            sqlite_store.replace_database(
                 self.database["users"],
                 self.database["messages"],
                 self.database["settings"],
+                database,
+            )
+        else:
+            self.database["users"] = database["users"]
+            self.database["messages"] = database_wrapper.build_message_store(
+                self.id,
+                database["messages"],
+                self.hot_messages,
+                self.history_cache_pages,
+                self.message_bodies != "inline",
+                self.message_bodies == "zlib",
             )
+            self.database["settings"] = database["settings"]
+            database_wrapper.save_database(
+                self.id,
+                database["users"],
+                self.database["messages"].snapshot(),
+                database["settings"],
+            )
+
+        self.schedule_expirations()
+        # Their timeouts were cleared along with the expirations
+        for username in list(self.waiters):
+            self.answer_waiters(username, [])
+
+    def user_record(self, username: str):
+        """
+        Build the write-ahead log record that stores the current state of a user.
+        """
+        return {
+            "op": "put_user",
+            "username": username,
+            "user": self.database["users"][username],
+        }
+
+    def create_account(
+        self, sock: socket.socket, data, command_data, internal_change=False
+    ):
+        username = command_data["username"].strip()
+        password = command_data["password"].strip()
+
+        if internal_change:
+            self.database["users"][username] = {"password": password}
+            self.sessions[username] = command_data.get("addr")
+            self.persist(self.user_record(username))
             return
 
         if not username.isalnum():
-            self.send_error(sock, data_length, data, "Username must be alphanumeric")
+            self.send_error(sock, data, "Username must be alphanumeric")
             return
 
         if username in self.database["users"]:
-            self.send_error(sock, data_length, data, "Username already exists")
+            self.send_error(sock, data, "Username already exists")
             return
 
         if password.strip() == "":
-            self.send_error(sock, data_length, data, "Password cannot be empty")
+            self.send_error(sock, data, "Password cannot be empty")
             return
 
-        # Create new user in the users dict
-        self.database["users"][username] = {
-            "password": password,
-            "logged_in": True,
-            "addr": f"{data.addr[0]}:{data.addr[1]}",
-        }
+        # Create new user in the users dict, and log them in
+        self.database["users"][username] = {"password": password}
+        self.sessions[username] = f"{data.addr[0]}:{data.addr[1]}"
 
         return_dict = {"username": username, "undeliv_messages": 0}
 
         # Send a response indicating successful login with 0 unread messages
-        self.send_message(sock, data_length, "login", data, return_dict)
-        database_wrapper.save_database(
-            self.id,
-            self.database["users"],
-            self.database["messages"],
-            self.database["settings"],
-        )
+        self.send_message(sock, "login", data, return_dict)
+        self.persist(self.user_record(username))
         self.internal_communicator.distribute_update(
             {
                 "command": "create",
@@ -162,55 +521,37 @@ class FaultTolerantServer(multiprocessing.Process):
             }
         )
 
-    def login(self, sock: socket.socket, unparsed_data, internal_change=False):
-        _, command_data, data, data_length = self.parse_json_data(
-            sock, unparsed_data, internal_change
-        )
+    def login(self, sock: socket.socket, data, command_data, internal_change=False):
 
         username = command_data["username"]
         password = command_data.get("password")
 
         if internal_change:
-            addr = command_data.get("addr")
-
-            self.database["users"][username]["logged_in"] = True
-            self.database["users"][username]["addr"] = addr
-            database_wrapper.save_database(
-                self.id,
-                self.database["users"],
-                self.database["messages"],
-                self.database["settings"],
-            )
+            self.sessions[username] = command_data.get("addr")
             return
 
-        if username not in self.database["users"]:
-            self.send_error(sock, data_length, data, "Username does not exist")
+        user = self.database["users"].get(username)
+        if user is None:
+            self.send_error(sock, data, "Username does not exist")
             return
 
-        if self.database["users"][username]["logged_in"]:
-            self.send_error(sock, data_length, data, "User already logged in")
+        if username in self.sessions:
+            self.send_error(sock, data, "User already logged in")
             return
 
-        if password != self.database["users"][username]["password"]:
-            self.send_error(sock, data_length, data, "Incorrect password")
+        if password != user["password"]:
+            self.send_error(sock, data, "Incorrect password")
             return
 
         # Count undelivered messages
         num_messages = self.get_new_messages(username)
 
-        # Mark as logged in
-        self.database["users"][username]["logged_in"] = True
-        self.database["users"][username]["addr"] = f"{data.addr[0]}:{data.addr[1]}"
-
         return_dict = {"username": username, "undeliv_messages": num_messages}
 
-        self.send_message(sock, data_length, "login", data, return_dict)
-        database_wrapper.save_database(
-            self.id,
-            self.database["users"],
-            self.database["messages"],
-            self.database["settings"],
-        )
+        self.send_message(sock, "login", data, return_dict)
+
+        # Mark as logged in
+        self.sessions[username] = f"{data.addr[0]}:{data.addr[1]}"
         self.internal_communicator.distribute_update(
             {
                 "command": "login",
@@ -222,39 +563,22 @@ class FaultTolerantServer(multiprocessing.Process):
             }
         )
 
-    def logout(self, sock: socket.socket, unparsed_data, internal_change=False):
-        _, command_data, data, data_length = self.parse_json_data(
-            sock, unparsed_data, internal_change
-        )
+    def logout(self, sock: socket.socket, data, command_data, internal_change=False):
 
         username = command_data["username"]
 
         if internal_change:
-            self.database["users"][username]["logged_in"] = False
-            self.database["users"][username]["addr"] = None
-            database_wrapper.save_database(
-                self.id,
-                self.database["users"],
-                self.database["messages"],
-                self.database["settings"],
-            )
+            self.sessions.pop(username, None)
             return
 
         if username not in self.database["users"]:
-            self.send_error(sock, data_length, data, "Username does not exist")
+            self.send_error(sock, data, "Username does not exist")
             return
 
+        self.send_message(sock, "logout", data, {})
+
         # Mark user as logged out
-        self.database["users"][username]["logged_in"] = False
-        self.database["users"][username]["addr"] = None
-
-        self.send_message(sock, data_length, "logout", data, {})
-        database_wrapper.save_database(
-            self.id,
-            self.database["users"],
-            self.database["messages"],
-            self.database["settings"],
-        )
+        self.sessions.pop(username, None)
         self.internal_communicator.distribute_update(
             {
                 "command": "logout",
@@ -264,84 +588,57 @@ class FaultTolerantServer(multiprocessing.Process):
             }
         )
 
-    def search_messages(self, sock: socket.socket, unparsed_data):
-        _, command_data, data, data_length = self.parse_json_data(sock, unparsed_data)
+    def search_messages(self, sock: socket.socket, data, command_data):
 
         pattern = command_data["search"]
         matched_users = fnmatch.filter(self.database["users"].keys(), pattern)
 
         return_dict = {"user_list": matched_users}
 
-        self.send_message(sock, data_length, "user_list", data, return_dict)
+        self.send_message(sock, "user_list", data, return_dict)
 
-    def delete_account(self, sock: socket.socket, unparsed_data, internal_change=False):
-        _, command_data, data, data_length = self.parse_json_data(
-            sock, unparsed_data, internal_change
-        )
+    def delete_account(
+        self, sock: socket.socket, data, command_data, internal_change=False
+    ):
         acct = command_data["username"]
 
         if internal_change:
             if acct in self.database["users"]:
                 del self.database["users"][acct]
+                self.sessions.pop(acct, None)
+            # The other partitions of a node still hold the messages the user sent
+            self.database["messages"].remove_user(acct)
 
-                def del_acct_msgs(msg_obj_lst, acct):
-                    msg_obj_lst[:] = [
-                        msg_obj
-                        for msg_obj in msg_obj_lst
-                        if msg_obj["sender"] != acct and msg_obj["receiver"] != acct
-                    ]
-
-                del_acct_msgs(self.database["messages"]["delivered"], acct)
-                del_acct_msgs(self.database["messages"]["undelivered"], acct)
-
-                database_wrapper.save_database(
-                    self.id,
-                    self.database["users"],
-                    self.database["messages"],
-                    self.database["settings"],
-                )
+            self.persist({"op": "delete_user", "username": acct})
             return
 
         if acct not in self.database["users"]:
-            self.send_error(sock, data_length, data, "Account does not exist")
+            self.send_error(sock, data, "Account does not exist")
             return
 
         # Remove user
         del self.database["users"][acct]
+        self.sessions.pop(acct, None)
 
         # Also remove messages where this user is sender or receiver
-        def del_acct_msgs(msg_obj_lst, acct):
-            msg_obj_lst[:] = [
-                msg_obj
-                for msg_obj in msg_obj_lst
-                if msg_obj["sender"] != acct and msg_obj["receiver"] != acct
-            ]
-
-        del_acct_msgs(self.database["messages"]["delivered"], acct)
-        del_acct_msgs(self.database["messages"]["undelivered"], acct)
-
-        self.send_message(sock, data_length, "logout", data, {})
-        database_wrapper.save_database(
-            self.id,
-            self.database["users"],
-            self.database["messages"],
-            self.database["settings"],
-        )
-        self.internal_communicator.distribute_update(
-            {
-                "command": "delete_acct",
-                "data": {
-                    "username": acct,
-                },
-            }
-        )
+        self.database["messages"].remove_user(acct)
+
+        self.send_message(sock, "logout", data, {})
+        self.persist({"op": "delete_user", "username": acct})
+        update = {
+            "command": "delete_acct",
+            "data": {
+                "username": acct,
+            },
+        }
+        self.internal_communicator.distribute_update(update)
+        if self.router is not None:
+            # Messages the user sent to the users of other partitions are stored there
+            self.router.notify(update)
 
     def deliver_message(
-        self, sock: socket.socket, unparsed_data, internal_change=False
+        self, sock: socket.socket, data, command_data, internal_change=False
     ):
-        _, command_data, data, data_length = self.parse_json_data(
-            sock, unparsed_data, internal_change
-        )
 
         sender = command_data["sender"]
         receiver = command_data["recipient"]
@@ -349,55 +646,65 @@ class FaultTolerantServer(multiprocessing.Process):
 
         if internal_change:
             self.database["settings"]["counter"] += 1
-            msg_obj = {
-                "id": self.database["settings"]["counter"],
-                "sender": sender,
-                "receiver": receiver,
-                "message": message,
-            }
+            msg = message_store.Message(
+                self.database["settings"]["counter"], sender, receiver, message
+            )
 
-            if self.database["users"][receiver]["logged_in"]:
-                self.database["messages"]["delivered"].append(msg_obj)
+            if receiver in self.sessions:
+                box = "delivered"
             else:
-                self.database["messages"]["undelivered"].append(msg_obj)
-
-            database_wrapper.save_database(
-                self.id,
-                self.database["users"],
-                self.database["messages"],
-                self.database["settings"],
+                box = "undelivered"
+            record = {"op": "add_message", "box": box, "message": msg.to_dict()}
+            self.database["messages"].add(msg, box)
+            self.record_expiry(msg, record, command_data.get("expires_at"))
+
+            self.persist(record)
+            if box == "delivered":
+                self.push_message(msg.id, sender, receiver, message)
+            self.answer_waiters(
+                receiver, [{"id": msg.id, "sender": sender, "message": message}]
             )
             return
 
         if receiver not in self.database["users"]:
-            self.send_error(sock, data_length, data, "Receiver does not exist")
+            self.send_error(sock, data, "Receiver does not exist")
             return
 
+        # Messages sent with a TTL expire that many seconds after they were sent
+        ttl = command_data.get("ttl")
+        expires_at = None
+        if ttl is not None:
+            if not is_positive_seconds(ttl):
+                self.send_error(sock, data, "TTL must be a positive number of seconds")
+                return
+            expires_at = time.time() + ttl
+
         # Increment the message counter
         self.database["settings"]["counter"] += 1
-        msg_obj = {
-            "id": self.database["settings"]["counter"],
-            "sender": sender,
-            "receiver": receiver,
-            "message": message,
-        }
+        msg = message_store.Message(
+            self.database["settings"]["counter"], sender, receiver, message
+        )
 
         # Decide if message is delivered or undelivered based on receiver log-in status
-        if self.database["users"][receiver]["logged_in"]:
-            self.database["messages"]["delivered"].append(msg_obj)
+        if receiver in self.sessions:
+            box = "delivered"
         else:
-            self.database["messages"]["undelivered"].append(msg_obj)
+            box = "undelivered"
+        # Build the log record before the body is moved to the body segment
+        record = {"op": "add_message", "box": box, "message": msg.to_dict()}
+        self.database["messages"].add(msg, box)
+        self.record_expiry(msg, record, expires_at)
 
         # Return the new count of undelivered messages for the sender
         num_messages = self.get_new_messages(sender)
         return_dict = {"undeliv_messages": num_messages}
 
-        self.send_message(sock, data_length, "refresh_home", data, return_dict)
-        database_wrapper.save_database(
-            self.id,
-            self.database["users"],
-            self.database["messages"],
-            self.database["settings"],
+        self.send_message(sock, "refresh_home", data, return_dict)
+        self.persist(record)
+        if box == "delivered":
+            self.push_message(msg.id, sender, receiver, message)
+        self.answer_waiters(
+            receiver, [{"id": msg.id, "sender": sender, "message": message}]
         )
         self.internal_communicator.distribute_update(
             {
@@ -406,56 +713,153 @@ class FaultTolerantServer(multiprocessing.Process):
                     "sender": sender,
                     "recipient": receiver,
                     "message": message,
+                    "expires_at": expires_at,
                 },
             }
         )
 
-    def get_undelivered_messages(self, sock: socket.socket, unparsed_data):
-        _, command_data, data, data_length = self.parse_json_data(sock, unparsed_data)
+    def push_message(self, msg_id, sender: str, receiver: str, message: str):
+        """
+        Push a message filed as delivered to the client its receiver is logged in from,
+        which may be connected to another worker of this node.
+        """
+        addr = self.sessions.get(receiver)
+        if addr is None:
+            return
+        push = {"id": msg_id, "sender": sender, "message": message}
+        if addr in self.clients:
+            self.push_to_address(addr, push)
+        elif self.router is not None:
+            self.router.notify(
+                {"command": "new_message", "data": {"addr": addr, "message": push}}
+            )
+
+    def push_to_address(self, addr: str, push):
+        """
+        Send a new_message frame to the client connected from `addr`, if any. Only
+        clients that send length-prefixed frames get them, as they are the only ones
+        that can tell a push apart from the reply to a request.
+        """
+        client = self.clients.get(addr)
+        if client is None:
+            return
+        sock, data = client
+        if data.closed or not data.frames.length_prefixed:
+            return
+        self.send_payload(
+            sock, data, protocol.encode_reply("new_message", push, data.version)
+        )
+
+    def wait_for_messages(self, sock: socket.socket, data, command_data):
+        """
+        Reply with the count of undelivered messages of a user once they have any. If
+        they have none yet, the request is parked until a message for them arrives,
+        which is sent along, or until the timeout given in seconds runs out. The
+        requests received after it on the connection wait for its reply.
+        """
+        username = command_data["username"]
+        timeout = command_data.get("timeout")
+        if timeout is None:
+            timeout = DEFAULT_WAIT_TIMEOUT
+        elif not is_positive_seconds(timeout):
+            self.send_error(sock, data, "Timeout must be a positive number of seconds")
+            return
+
+        if username not in self.database["users"]:
+            self.send_error(sock, data, "Username does not exist")
+            return
+
+        num_messages = self.get_new_messages(username)
+        if num_messages > 0:
+            return_dict = {"undeliv_messages": num_messages, "messages": []}
+            self.send_message(sock, "new_messages", data, return_dict)
+            return
+
+        waiter = types.SimpleNamespace(
+            sock=sock, data=data, username=username, timer=None
+        )
+        waiter.timer = self.timers.schedule(
+            min(timeout, MAX_WAIT_TIMEOUT), self.answer_waiter, waiter, []
+        )
+        self.waiters.setdefault(username, []).append(waiter)
+        data.routing = True
+
+    def answer_waiters(self, username: str, messages):
+        """
+        Answer every parked wait_for_messages request of a user, with the messages that
+        woke them.
+        """
+        for waiter in self.waiters.get(username, [])[:]:
+            self.timers.cancel(waiter.timer)
+            self.answer_waiter(waiter, messages)
+
+    def answer_waiter(self, waiter, messages):
+        """
+        Reply to a parked wait_for_messages request, then handle the requests the client
+        sent after it.
+        """
+        waiters = self.waiters[waiter.username]
+        waiters.remove(waiter)
+        if not waiters:
+            del self.waiters[waiter.username]
+
+        return_dict = {
+            "undeliv_messages": self.get_new_messages(waiter.username),
+            "messages": messages,
+        }
+        self.relay_reply(
+            waiter.sock,
+            waiter.data,
+            protocol.encode_reply("new_messages", return_dict, waiter.data.version),
+        )
+
+    def record_expiry(self, msg, record, expires_at):
+        """
+        Record when a new message expires, if it was sent with a TTL, both in the store
+        and in its add_message log record, and schedule its expiry.
+        """
+        if expires_at is None:
+            return
+        self.database["messages"].set_expiry(msg.id, msg.receiver, expires_at)
+        record["expires_at"] = expires_at
+        self.schedule_expiry(msg.id, msg.receiver, expires_at)
+
+    def get_undelivered_messages(
+        self, sock: socket.socket, data, command_data, internal_change=False
+    ):
 
         # user decides on the number of messages to view
         receiver = command_data["username"]  # i.e. logged in user
         num_msg_view = command_data["num_messages"]
 
-        delivered_msgs = self.database["messages"]["delivered"]
-        undelivered_msgs = self.database["messages"]["undelivered"]
-
-        to_deliver = []
-        remove_indices = []  # List to store indices to delete later
+        if internal_change:
+            moved = self.database["messages"].deliver(receiver, num_msg_view)
+            self.persist(
+                {
+                    "op": "deliver_messages",
+                    "receiver": receiver,
+                    "ids": [msg.id for msg in moved],
+                }
+            )
+            return
 
-        if len(undelivered_msgs) == 0 and num_msg_view > 0:
-            self.send_error(sock, data_length, data, "No undelivered messages")
+        if (
+            not self.database["messages"].has_messages("undelivered")
+            and num_msg_view > 0
+        ):
+            self.send_error(sock, data, "No undelivered messages")
             return
 
         # Move messages from undelivered to delivered
-        for ind, msg_obj in enumerate(undelivered_msgs):
-            if num_msg_view == 0:
-                break
+        moved = self.database["messages"].deliver(receiver, num_msg_view)
 
-            if msg_obj["receiver"] == receiver:
-                to_deliver.append(
-                    {
-                        "id": msg_obj["id"],
-                        "sender": msg_obj["sender"],
-                        "message": msg_obj["message"],
-                    }
-                )
-                delivered_msgs.append(msg_obj)
-                remove_indices.append(ind)  # Store index instead of deleting in-place
-                num_msg_view -= 1
-
-        # Delete from undelivered_msgs in reverse order to avoid index shifting
-        for ind in sorted(remove_indices, reverse=True):
-            del undelivered_msgs[ind]
-
-        return_dict = {"messages": to_deliver}
-
-        self.send_message(sock, data_length, "messages", data, return_dict)
-        database_wrapper.save_database(
-            self.id,
-            self.database["users"],
-            self.database["messages"],
-            self.database["settings"],
+        self.send_messages(sock, data, moved)
+        self.persist(
+            {
+                "op": "deliver_messages",
+                "receiver": receiver,
+                "ids": [msg.id for msg in moved],
+            }
         )
         self.internal_communicator.distribute_update(
             {
@@ -467,41 +871,21 @@ class FaultTolerantServer(multiprocessing.Process):
             }
         )
 
-    def get_delivered_messages(self, sock: socket.socket, unparsed_data):
-        _, command_data, data, data_length = self.parse_json_data(sock, unparsed_data)
+    def get_delivered_messages(self, sock: socket.socket, data, command_data):
 
         # User decides on the number of messages to view
         receiver = command_data["username"]  # i.e. logged in user
         num_msg_view = command_data["num_messages"]
 
-        delivered_msgs = self.database["messages"]["delivered"]
-
-        if len(delivered_msgs) == 0 and num_msg_view > 0:
-            self.send_error(sock, data_length, data, "No delivered messages")
+        if not self.database["messages"].has_messages("delivered") and num_msg_view > 0:
+            self.send_error(sock, data, "No delivered messages")
             return
 
-        to_deliver = []
-        for ind, msg_obj in enumerate(delivered_msgs):
-            if num_msg_view == 0:
-                break
+        to_deliver = self.database["messages"].peek(receiver, num_msg_view)
 
-            if msg_obj["receiver"] == receiver:
-                to_deliver.append(
-                    {
-                        "id": msg_obj["id"],
-                        "sender": msg_obj["sender"],
-                        "message": msg_obj["message"],
-                    }
-                )
+        self.send_messages(sock, data, to_deliver)
 
-                num_msg_view -= 1
-
-        return_dict = {"messages": to_deliver}
-
-        self.send_message(sock, data_length, "messages", data, return_dict)
-
-    def refresh_home(self, sock: socket.socket, unparsed_data):
-        _, command_data, data, data_length = self.parse_json_data(sock, unparsed_data)
+    def refresh_home(self, sock: socket.socket, data, command_data):
 
         # Count up undelivered messages
         username = command_data["username"]
@@ -510,65 +894,68 @@ class FaultTolerantServer(multiprocessing.Process):
 
         return_dict = {"undeliv_messages": num_messages}
 
-        self.send_message(sock, data_length, "refresh_home", data, return_dict)
+        self.send_message(sock, "refresh_home", data, return_dict)
+
+    def parse_message_ids(self, delete_ids):
+        """
+        Parse the IDs of the messages to delete, given either as a list of integers or
+        as a comma-separated string. Entries that are not valid IDs are skipped.
+        """
+        if isinstance(delete_ids, str):
+            delete_ids = delete_ids.split(",")
+
+        msg_ids = []
+        for msg_id in delete_ids:
+            if isinstance(msg_id, int):
+                msg_ids.append(msg_id)
+            elif msg_id.strip().isdigit():
+                msg_ids.append(int(msg_id))
+        return msg_ids
 
     def delete_messages(
-        self, sock: socket.socket, unparsed_data, internal_change=False
+        self, sock: socket.socket, data, command_data, internal_change=False
     ):
-        _, command_data, data, data_length = self.parse_json_data(
-            sock, unparsed_data, internal_change
-        )
 
         current_user = command_data["current_user"]
-        msgids_to_delete = set(command_data["delete_ids"].split(","))
+        msgids_to_delete = self.parse_message_ids(command_data["delete_ids"])
 
-        if internal_change:
-            self.database["messages"]["delivered"] = [
-                msg
-                for msg in self.database["messages"]["delivered"]
-                if not (
-                    str(msg["id"]) in msgids_to_delete
-                    and msg["receiver"] == current_user
-                )
-            ]
+        deleted_ids = self.database["messages"].delete(current_user, msgids_to_delete)
 
-            database_wrapper.save_database(
-                self.id,
-                self.database["users"],
-                self.database["messages"],
-                self.database["settings"],
+        if internal_change:
+            self.persist(
+                {"op": "delete_messages", "receiver": current_user, "ids": deleted_ids}
             )
             return
 
-        self.database["messages"]["delivered"] = [
-            msg
-            for msg in self.database["messages"]["delivered"]
-            if not (
-                str(msg["id"]) in msgids_to_delete and msg["receiver"] == current_user
-            )
-        ]
-
         num_messages = self.get_new_messages(current_user)
 
         return_dict = {"undeliv_messages": num_messages}
 
-        self.send_message(sock, data_length, "refresh_home", data, return_dict)
-        database_wrapper.save_database(
-            self.id,
-            self.database["users"],
-            self.database["messages"],
-            self.database["settings"],
+        self.send_message(sock, "refresh_home", data, return_dict)
+        self.persist(
+            {"op": "delete_messages", "receiver": current_user, "ids": deleted_ids}
         )
         self.internal_communicator.distribute_update(
             {
                 "command": "delete_msg",
                 "data": {
                     "current_user": current_user,
-                    "delete_ids": ",".join(list(msgids_to_delete)),
+                    "delete_ids": deleted_ids,
                 },
             }
         )
 
+    def negotiate_protocol(self, sock: socket.socket, data, command_data):
+        """
+        Agree with a client on the highest protocol version both of them support, which
+        every later reply on the connection is encoded in. The reply itself is JSON.
+        """
+        versions = set(command_data.get("versions", [0])) & set(protocol.VERSIONS)
+        version = max(versions, default=0)
+
+        self.send_message(sock, "hello", data, {"version": version})
+        data.version = version
+
     def accept_wrapper(self, sock):
         """
         Accept a new socket connection and register it with the selector.
@@ -576,9 +963,70 @@ class FaultTolerantServer(multiprocessing.Process):
         conn, addr = sock.accept()
         print(f"Accepted connection from {addr}")
         conn.setblocking(False)
-        data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"")
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        self.sel.register(conn, events, data=data)
+        data = self.connection_data(addr)
+        # Clients are only waited on for writing while output is queued for them
+        self.sel.register(conn, data.events, data=data)
+        self.clients[f"{addr[0]}:{addr[1]}"] = (conn, data)
+
+    def connection_data(self, addr, partition=None):
+        """
+        Return the state kept for a new client connection from `addr`. `partition` is
+        set for the links to other workers, and for requests routed from one of them.
+        """
+        return types.SimpleNamespace(
+            addr=addr,
+            inb=b"",
+            outb=b"",
+            frames=framing.FrameDecoder(),
+            replies=None,
+            pending=bytearray(),
+            events=selectors.EVENT_READ,
+            partition=partition,
+            # Protocol version the client negotiated, which replies are encoded in
+            version=0,
+            # Whether the reply to a request is still to come, from other workers or once
+            # messages arrive, which holds back the requests received after it
+            routing=False,
+            closed=False,
+        )
+
+    def close_connection(self, sock: socket.socket, data):
+        """
+        Close a client connection and log out the user connected through it.
+        """
+        print(f"Closing connection to {data.addr}")
+        self.sel.unregister(sock)
+        sock.close()
+        self.end_session(data)
+
+    def end_session(self, data):
+        """
+        Log out the user connected from the address of a closed connection, if any.
+        """
+        data.closed = True
+        addr = f"{data.addr[0]}:{data.addr[1]}"
+        self.clients.pop(addr, None)
+        self.log_out_address(addr)
+        if self.router is not None:
+            # The user may be owned by another partition
+            self.router.notify({"command": "end_session", "data": {"addr": addr}})
+
+    def log_out_address(self, addr: str):
+        """
+        Log out the user connected from `addr`, if any.
+        """
+        for user, user_addr in self.sessions.items():
+            if user_addr == addr:
+                del self.sessions[user]
+                self.internal_communicator.distribute_update(
+                    {
+                        "command": "logout",
+                        "data": {
+                            "username": user,
+                        },
+                    }
+                )
+                break
 
     def service_connection(self, key, mask):
         """
@@ -587,110 +1035,407 @@ class FaultTolerantServer(multiprocessing.Process):
         """
         sock = key.fileobj
         data = key.data
+        if mask & selectors.EVENT_WRITE:
+            self.flush_output(sock, data)
         if mask & selectors.EVENT_READ:
             try:
-                recv_data = sock.recv(1024)
+                recv_data = sock.recv(65536)
             except ConnectionResetError:
                 recv_data = None
 
             if recv_data:
-                data.outb += recv_data
+                data.frames.feed(recv_data)
             else:
                 # Client disconnected
-                print(f"Closing connection to {data.addr}")
+                self.close_connection(sock, data)
+                return
+
+            self.handle_received(sock, data)
+
+    def handle_received(self, sock: socket.socket, data):
+        """
+        Handle the frames received so far from a client, closing the connection if it
+        sent an invalid one.
+        """
+        try:
+            self.handle_frames(sock, data)
+        except framing.FrameError as e:
+            print(f"Invalid frame from {data.addr}: {e}")
+            self.close_connection(sock, data)
+
+    def handle_frames(self, sock: socket.socket, data):
+        """
+        Handle every complete frame received so far, collecting the replies to send them
+        back in a single write. Stops at a request that other workers handle, or that
+        waits for messages, so that replies are sent in order. Raises FrameError if the
+        client sent an invalid frame.
+        """
+        data.replies = []
+        try:
+            while not data.routing and (frame := data.frames.next_frame()) is not None:
+                self.handle_frame(sock, data, frame)
+        finally:
+            replies, data.replies = data.replies, None
+        if replies:
+            self.queue_output(sock, data, b"".join(replies))
+
+    def handle_frame(self, sock: socket.socket, data, frame: bytes):
+        """
+        Handle a single command received from a client.
+        """
+        # Kept for routing the request to other workers as it was received
+        data.outb = frame
+        command, command_data, _, _ = self.parse_json_data(sock, data)
+        if command is None:
+            return
+
+        # Requests routed from another worker are always handled where they arrive
+        if (
+            self.router is not None
+            and data.partition is None
+            and self.route_request(sock, data, command, command_data)
+        ):
+            return
+
+        with self.transaction():
+            handled = self.commands.handle(command, sock, data, command_data)
+        if not handled:
+            # Command not recognized
+            print(f"No valid command: {frame}")
+
+    def check_connection(self, sock: socket.socket, data, command_data):
+        """
+        Clients send check_connection to find out whether the server is still up. It
+        has no reply.
+        """
+
+    def send_stats(self, sock: socket.socket, data, command_data):
+        """
+        Reply with the number of calls and latency histogram of every command handled
+        so far: those sent by clients to this server, and the updates and messages it
+        received from the other servers.
+        """
+        internal = self.internal_communicator
+        stats = {
+            "commands": self.commands.stats(),
+            "updates": internal.updates.stats(),
+            "internal": internal.commands.stats(),
+        }
+        self.send_message(sock, "stats", data, stats)
+
+    def route_request(self, sock: socket.socket, data, command, command_data):
+        """
+        Route a request to the workers of the partitions it concerns, unless this worker
+        can handle it alone. Returns True if the request was routed, in which case the
+        reply is sent once they have handled it.
+        """
+        router = self.router
+        if command == "search":
+            self.route_search(sock, data)
+            return True
+
+        owner = router.owner(command, command_data)
+        if owner is None:
+            return False
+
+        if command == "send_msg":
+            sender_owner = router.partition_of(command_data.get("sender"))
+            if sender_owner is not None and sender_owner != owner:
+                self.route_send(sock, data, owner, sender_owner, command_data["sender"])
+                return True
+
+        if owner == router.index:
+            return False
+
+        data.routing = True
+        router.forward(
+            owner, data.addr, data.outb, functools.partial(self.relay_reply, sock, data)
+        )
+        return True
+
+    def route_send(self, sock: socket.socket, data, owner, sender_owner, sender: str):
+        """
+        Deliver a message on the partition of its receiver, then reply with the count of
+        undelivered messages of the sender, which is kept by the sender's partition.
+        """
+
+        def delivered(payload):
+            if protocol.decode_reply(payload)["command"] == "error":
+                self.relay_reply(sock, data, payload)
+                return
+            refresh = protocol.encode_request(
+                "refresh_home", {"username": sender}, data.version
+            )
+            self.dispatch(
+                sender_owner,
+                data.addr,
+                refresh,
+                functools.partial(self.relay_reply, sock, data),
+            )
+
+        data.routing = True
+        self.dispatch(owner, data.addr, data.outb, delivered)
+
+    def route_search(self, sock: socket.socket, data):
+        """
+        Search the users of every partition, and reply with all of their matches.
+        """
+        user_lists = {}
+
+        def searched(partition, payload):
+            user_lists[partition] = protocol.decode_reply(payload)["data"]["user_list"]
+            if len(user_lists) < self.router.count:
+                return
+            matched_users = [
+                username
+                for partition in sorted(user_lists)
+                for username in user_lists[partition]
+            ]
+            self.relay_reply(
+                sock,
+                data,
+                protocol.encode_reply(
+                    "user_list", {"user_list": matched_users}, data.version
+                ),
+            )
+
+        data.routing = True
+        for partition in range(self.router.count):
+            self.dispatch(
+                partition, data.addr, data.outb, functools.partial(searched, partition)
+            )
+
+    def dispatch(self, partition, addr, frame: bytes, callback):
+        """
+        Handle a request on the worker owning `partition`, and call `callback` with its
+        reply.
+        """
+        if partition == self.router.index:
+            self.handle_routed(partition, addr, frame, callback)
+        else:
+            self.router.forward(partition, addr, frame, callback)
+
+    def handle_routed(self, partition, addr, frame: bytes, callback):
+        """
+        Handle a request routed from the worker owning `partition`, passing its reply to
+        `callback` once it is sent.
+        """
+        data = self.connection_data(addr, partition=partition)
+        # Replies are sent back in the version of the request
+        if protocol.is_binary(frame):
+            data.version = protocol.VERSION
+        self.handle_frame(partitioning.RoutedRequest(callback), data, frame)
+
+    def relay_reply(self, sock: socket.socket, data, payload: bytes):
+        """
+        Send a client the reply to a request that was routed to other workers or that
+        waited for messages, then handle the requests it sent after it.
+        """
+        data.routing = False
+        if data.closed:
+            return
+        self.send_payload(sock, data, payload)
+        if data.replies is None:
+            self.handle_received(sock, data)
+
+    def link_data(self, partition):
+        """
+        Return the state kept for the link to the worker owning `partition`.
+        """
+        return self.connection_data(f"worker {partition}", partition=partition)
+
+    def service_link(self, key, mask):
+        """
+        Process I/O for the link to another worker of this node.
+        """
+        sock = key.fileobj
+        data = key.data
+        if mask & selectors.EVENT_WRITE:
+            self.flush_output(sock, data)
+        if mask & selectors.EVENT_READ:
+            try:
+                recv_data = sock.recv(65536)
+            except ConnectionResetError:
+                recv_data = None
+
+            if not recv_data:
+                print(f"{self.id} : Lost the link to {data.addr}")
                 self.sel.unregister(sock)
                 sock.close()
+                return
 
-                # Mark the corresponding user as logged out
-                for user in self.database["users"]:
-                    if (
-                        self.database["users"][user]["addr"]
-                        == f"{data.addr[0]}:{data.addr[1]}"
-                    ):
-                        self.database["users"][user]["logged_in"] = False
-                        self.database["users"][user]["addr"] = None
-                        self.internal_communicator.distribute_update(
-                            {
-                                "command": "logout",
-                                "data": {
-                                    "username": user,
-                                },
-                            }
-                        )
-                        break
-
-                database_wrapper.save_database(
-                    self.id,
-                    self.database["users"],
-                    self.database["messages"],
-                    self.database["settings"],
-                )
-        if mask & selectors.EVENT_WRITE:
-            if data.outb:
-                # Decode the entire payload, split by space for the command,
-                # then parse the rest as JSON
-                received_data = data.outb.decode("utf-8")
-                command, _, _, data_length = self.parse_json_data(sock, data)
-
-                ###################################################################
-                # Process recognized JSON-based commands.
-                ###################################################################
-
-                if command == "create":
-                    self.create_account(sock, data)
-                elif command == "login":
-                    self.login(sock, data)
-                elif command == "logout":
-                    self.logout(sock, data)
-                elif command == "search":
-                    self.search_messages(sock, data)
-                elif command == "delete_acct":
-                    self.delete_account(sock, data)
-                elif command == "send_msg":
-                    self.deliver_message(sock, data)
-                elif command == "get_undelivered":
-                    self.get_undelivered_messages(sock, data)
-                elif command == "get_delivered":
-                    self.get_delivered_messages(sock, data)
-                elif command == "refresh_home":
-                    self.refresh_home(sock, data)
-                elif command == "delete_msg":
-                    self.delete_messages(sock, data)
-                elif command == "check_connection":
-                    data.outb = data.outb[data_length:]
-                else:
-                    # Command not recognized
-                    print(f"No valid command: {received_data}")
-                    data.outb = data.outb[len(received_data) :]
+            data.frames.feed(recv_data)
+            for frame in data.frames:
+                self.handle_link_frame(data.partition, frame)
+
+    def handle_link_frame(self, partition, frame: bytes):
+        """
+        Handle a request, reply or update received from the worker owning `partition`.
+        """
+        kind, request_id, addr, body = partitioning.decode_link_frame(frame)
+        if kind == partitioning.REQUEST:
+            self.handle_routed(
+                partition,
+                addr,
+                body,
+                functools.partial(self.router.reply, partition, request_id),
+            )
+        elif kind == partitioning.REPLY:
+            self.router.complete(request_id, body)
+        elif kind == partitioning.UPDATE:
+            self.apply_partition_update(json.loads(body))
+
+    def apply_partition_update(self, update):
+        """
+        Apply a change that another worker of this node made to a user it owns, and
+        replicate it to the other servers, or push a message it filed as delivered to a
+        client connected to this worker.
+        """
+        if update["command"] == "end_session":
+            self.log_out_address(update["data"]["addr"])
+        elif update["command"] == "new_message":
+            self.push_to_address(update["data"]["addr"], update["data"]["message"])
+        elif update["command"] == "delete_acct":
+            self.delete_account(None, None, update["data"], True)
+            self.internal_communicator.distribute_update(update)
+
+    def start_workers(self):
+        """
+        Start the snapshotter, which runs alongside the client loop, and schedule the
+        expiry of stored messages. The retention worker is started separately, once
+        the internal communicator exists.
+        """
+        # Guards the database against concurrent access from the internal communicator
+        # and the snapshotter, which run in their own threads
+        self.db_lock = threading.RLock()
+
+        self.snapshotter = None
+        if self.storage == "json":
+            self.snapshotter = database_wrapper.Snapshotter(
+                self.id,
+                self.database,
+                self.db_lock,
+                interval=self.snapshot_interval,
+                max_log_bytes=self.snapshot_log_bytes,
+            )
+            self.snapshotter.start()
+
+        self.schedule_expirations()
+        self.retention_worker = None
+
+    def start_retention_worker(self):
+        """
+        Start the retention worker if a retention policy is set. It asks the internal
+        communicator whether this server is the leader, so it must be started after
+        the communicator has been created.
+        """
+        if retention.policy_enabled(self.retention_policy):
+            self.retention_worker = retention.RetentionWorker(
+                self,
+                self.retention_policy,
+                interval=self.retention_interval,
+                batch_size=self.retention_batch_size,
+            )
+            self.retention_worker.start()
+
+    def stop_workers(self):
+        """
+        Stop the background workers, persisting every pending change and taking a
+        final snapshot.
+        """
+        if self.retention_worker is not None:
+            self.retention_worker.stop()
+            self.retention_worker.join()
+        with self.db_lock:
+            self.committer.flush()
+        if self.snapshotter is not None:
+            self.snapshotter.stop()
+            self.snapshotter.join()
+            self.snapshotter.snapshot()
+
+    def next_timeout(self):
+        """
+        Return how long the client loop may wait before the next group commit or timer
+        is due, or None if neither is pending.
+        """
+        timeouts = [
+            timeout
+            for timeout in (self.committer.timeout(), self.timers.timeout())
+            if timeout is not None
+        ]
+        return min(timeouts, default=None)
+
+    def end_iteration(self):
+        """
+        Run the timers that are due and persist the changes made during this iteration
+        of the client loop as one batch. Called with the database lock held.
+        """
+        with self.transaction():
+            self.timers.run_due()
+        self.committer.end_iteration()
 
     def run(self):
+        self.open_database()
         self.sel = selectors.DefaultSelector()
+        self.loop_thread = threading.get_ident()
+        self.wakeup = socket.socketpair()
+        for wakeup_sock in self.wakeup:
+            wakeup_sock.setblocking(False)
+        self.sel.register(self.wakeup[0], selectors.EVENT_READ, data=None)
+        self.start_workers()
 
         self.internal_communicator = internal_communications.InternalCommunicator(
             **self.internal_communicator_args
         )
         self.internal_communicator.start()
+        self.start_retention_worker()
 
         # Create and bind the listening socket
         lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.router is not None:
+            # Every worker of the node listens on the same port, and the kernel spreads
+            # new connections across them
+            lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         lsock.bind((self.host, self.port))
         lsock.listen()
         print("Listening on", (self.host, self.port))
         lsock.setblocking(False)
         self.sel.register(lsock, selectors.EVENT_READ, data=None)
+
+        for partition, link in self.partition_links.items():
+            link.setblocking(False)
+            data = self.link_data(partition)
+            self.sel.register(link, data.events, data=data)
+            self.router.links[partition] = functools.partial(
+                self.queue_output, link, data
+            )
         try:
             while True:
-                events = self.sel.select(timeout=None)
-                for key, mask in events:
-                    if key.data is None:
-                        # Accept new connections
-                        self.accept_wrapper(key.fileobj)
-                    else:
-                        # Service existing connections
-                        self.service_connection(key, mask)
+                # Wake up in time for the next group commit or timer, if any
+                events = self.sel.select(timeout=self.next_timeout())
+                with self.db_lock:
+                    for key, mask in events:
+                        if key.fileobj is self.wakeup[0]:
+                            # Another thread scheduled a timer or committed changes
+                            self.wakeup[0].recv(4096)
+                        elif key.data is None:
+                            # Accept new connections
+                            self.accept_wrapper(key.fileobj)
+                        elif key.data.partition is not None:
+                            # Requests, replies and updates from other workers
+                            self.service_link(key, mask)
+                        else:
+                            # Service existing connections
+                            self.service_connection(key, mask)
+
+                    self.end_iteration()
         except KeyboardInterrupt:
             print(f"{self.id} : Caught keyboard interrupt, exiting")
         finally:
             # self.on_exit()
+            self.stop_workers()
             self.sel.close()
+            wakeup, self.wakeup = self.wakeup, None
+            for wakeup_sock in wakeup:
+                wakeup_sock.close()
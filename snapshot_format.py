@@ -0,0 +1,378 @@
+"""
+Snapshot Format Module
+
+This script implements the versioned binary format that snapshots of the database are
+written in, both by the persistence layer and by the leader when it sends its whole
+database to a replica that is bootstrapping. It replaces JSON documents of nested
+dictionaries, which were slow to encode and decode and repeated every username and key.
+
+Key Features:
+- Starts with a magic number and a format version, and ends with an end record, so that
+  files of another format or version, and truncated snapshots, are rejected instead of
+  misread.
+- Stores every table as a stream of length-prefixed records, written one at a time by
+  SnapshotWriter and read one at a time by iter_records, without building the whole
+  snapshot in memory first.
+- Interns strings: each distinct username (or setting key) is written once, in a string
+  record, and is referred to by its integer ID afterwards.
+- Stores the messages of a mailbox column by column (IDs, senders, bodies), each column
+  as an array of the smallest unsigned integer type that fits its values, so that most
+  of the encoding and decoding is done by array and bytes operations.
+- Reads mailboxes as views of the snapshot, so that loading a snapshot does not decode
+  any message; decode_entries decodes a mailbox when it is first needed.
+"""
+
+import io
+import json
+import struct
+import sys
+from array import array
+
+MAGIC = b"CS2620DB"
+VERSION = 1
+
+# Record tags
+END = 0
+STRING = 1
+USER = 2
+SETTING = 3
+MAILBOX = 4
+MESSAGES_INFO = 5
+EXPIRATION = 6
+SESSION = 7
+
+BOXES = ("undelivered", "delivered")
+
+# Tag and payload length of every record
+RECORD_HEADER = struct.Struct("<BI")
+STRING_ID = struct.Struct("<I")
+# Box, receiver, number of messages, bytes of their bodies, smallest ID and number of
+# senders of a mailbox
+MAILBOX_HEADER = struct.Struct("<BIIQqI")
+# Message ID, receiver and time the message expires at
+EXPIRATION_RECORD = struct.Struct("<qId")
+
+# Version of the column layout of mailbox entries, which is also what tells them apart
+# from the JSON lists of older snapshots, as those start with "["
+ENTRIES_FORMAT = 1
+# Typecode and number of values of a column
+COLUMN_HEADER = struct.Struct("<cI")
+COLUMN_TYPECODES = tuple(
+    (typecode, 1 << (8 * array(typecode).itemsize)) for typecode in "BHIQ"
+)
+BODY_TEXT = 0
+BODY_REF = 1
+
+
+def _pack_column(values):
+    """
+    Encodes non-negative integers as an array of the smallest type that fits them all.
+    """
+    largest = max(values, default=0)
+    for typecode, limit in COLUMN_TYPECODES:
+        if largest < limit:
+            break
+    column = array(typecode, values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return COLUMN_HEADER.pack(typecode.encode("ascii"), len(column)) + column.tobytes()
+
+
+def _unpack_column(view, offset):
+    """
+    Decodes a column written by _pack_column, and returns it with the offset it ends at.
+    """
+    typecode, length = COLUMN_HEADER.unpack_from(view, offset)
+    column = array(typecode.decode("ascii"))
+    offset += COLUMN_HEADER.size
+    end = offset + length * column.itemsize
+    if end > len(view):
+        raise ValueError("truncated column")
+    column.frombytes(view[offset:end])
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column, end
+
+
+def encode_entries(entries, senders):
+    """
+    Encodes the messages of a mailbox, given as (id, sender, body) entries whose body is
+    either the body itself or the (offset, length) of the body in a body segment.
+    `senders` lists every sender of the entries; entries refer to them by position.
+    """
+    sender_ids = {sender: i for i, sender in enumerate(senders)}
+    ids, entry_senders, kinds, firsts, seconds, texts = [], [], [], [], [], []
+    for msg_id, sender, body in entries:
+        ids.append(msg_id)
+        entry_senders.append(sender_ids[sender])
+        if isinstance(body, str):
+            text = body.encode("utf-8")
+            texts.append(text)
+            kinds.append(BODY_TEXT)
+            firsts.append(len(text))
+            seconds.append(0)
+        else:
+            kinds.append(BODY_REF)
+            firsts.append(body[0])
+            seconds.append(body[1])
+
+    return b"".join(
+        [
+            bytes([ENTRIES_FORMAT]),
+            _pack_column(ids),
+            _pack_column(entry_senders),
+            _pack_column(kinds),
+            _pack_column(firsts),
+            _pack_column(seconds),
+            *texts,
+        ]
+    )
+
+
+def decode_entries(data, senders):
+    """
+    Decodes the messages of a mailbox encoded by encode_entries into a list of
+    (id, sender, body) entries, where body is either the body itself or an
+    [offset, length] reference.
+    """
+    view = memoryview(data)
+    if len(view) == 0 or view[0] != ENTRIES_FORMAT:
+        raise ValueError("unsupported mailbox entries")
+
+    offset = 1
+    ids, offset = _unpack_column(view, offset)
+    entry_senders, offset = _unpack_column(view, offset)
+    kinds, offset = _unpack_column(view, offset)
+    firsts, offset = _unpack_column(view, offset)
+    seconds, offset = _unpack_column(view, offset)
+
+    texts = bytes(view[offset:])
+    decoded = texts.decode("utf-8")
+    # Bodies are sliced out of the decoded text when every character is a single byte,
+    # and decoded one by one otherwise
+    ascii_only = len(decoded) == len(texts)
+
+    entries = []
+    position = 0
+    for msg_id, sender, kind, first, second in zip(
+        ids, entry_senders, kinds, firsts, seconds
+    ):
+        if kind == BODY_TEXT:
+            if ascii_only:
+                body = decoded[position : position + first]
+            else:
+                body = texts[position : position + first].decode("utf-8")
+            position += first
+        else:
+            body = [first, second]
+        entries.append((msg_id, senders[sender], body))
+    return entries
+
+
+class SnapshotWriter:
+    """
+    Writes a snapshot to a binary file, one record at a time. Call close once every
+    table has been written; it does not close the file.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self._strings = {}
+        file.write(MAGIC + bytes([VERSION]))
+
+    def _record(self, tag, *parts):
+        self.file.write(RECORD_HEADER.pack(tag, sum(len(part) for part in parts)))
+        for part in parts:
+            self.file.write(part)
+
+    def _string_id(self, string):
+        """
+        Returns the ID of a string, writing it in a string record the first time.
+        """
+        string_id = self._strings.get(string)
+        if string_id is None:
+            string_id = self._strings[string] = len(self._strings)
+            self._record(STRING, string.encode("utf-8"))
+        return string_id
+
+    def write_user(self, username, user):
+        self._record(
+            USER,
+            STRING_ID.pack(self._string_id(username)),
+            user["password"].encode("utf-8"),
+        )
+
+    def write_setting(self, key, value):
+        self._record(
+            SETTING,
+            STRING_ID.pack(self._string_id(key)),
+            json.dumps(value).encode("utf-8"),
+        )
+
+    def write_mailbox(self, box, receiver, count, senders, size, min_id, data):
+        """
+        Writes a mailbox whose entries were encoded by encode_entries with `senders`.
+        """
+        sender_ids = array("I", [self._string_id(sender) for sender in senders])
+        if sys.byteorder == "big":
+            sender_ids.byteswap()
+        self._record(
+            MAILBOX,
+            MAILBOX_HEADER.pack(
+                BOXES.index(box),
+                self._string_id(receiver),
+                count,
+                size,
+                min_id,
+                len(senders),
+            ),
+            sender_ids.tobytes(),
+            data,
+        )
+
+    def write_expiration(self, msg_id, receiver, expires_at):
+        self._record(
+            EXPIRATION,
+            EXPIRATION_RECORD.pack(msg_id, self._string_id(receiver), expires_at),
+        )
+
+    def write_session(self, username, addr):
+        self._record(
+            SESSION, STRING_ID.pack(self._string_id(username)), addr.encode("utf-8")
+        )
+
+    def write_messages(self, messages):
+        """
+        Writes the messages table in the per-mailbox layout returned by
+        MessageStore.snapshot, whose mailbox entries are encoded by encode_entries.
+        """
+        info = {
+            key: value
+            for key, value in messages.items()
+            if key not in ("mailboxes", "expirations")
+        }
+        if info:
+            self._record(MESSAGES_INFO, json.dumps(info).encode("utf-8"))
+        for mailbox in messages["mailboxes"]:
+            self.write_mailbox(*mailbox)
+        for msg_id, receiver, expires_at in messages.get("expirations", []):
+            self.write_expiration(msg_id, receiver, expires_at)
+
+    def write_tables(self, tables):
+        """
+        Writes the tables in `tables`, which maps "users", "settings", "sessions" and
+        "messages" to their contents.
+        """
+        for username, user in tables.get("users", {}).items():
+            self.write_user(username, user)
+        for key, value in tables.get("settings", {}).items():
+            self.write_setting(key, value)
+        for username, addr in tables.get("sessions", {}).items():
+            self.write_session(username, addr)
+        if "messages" in tables:
+            self.write_messages(tables["messages"])
+
+    def close(self):
+        self._record(END)
+
+
+def iter_records(buffer):
+    """
+    Yields the (tag, payload) records of a snapshot, payloads being views of `buffer`.
+    Raises ValueError if `buffer` is not a snapshot of a supported version, or if it is
+    truncated.
+    """
+    view = memoryview(buffer)
+    if bytes(view[: len(MAGIC)]) != MAGIC:
+        raise ValueError("not a snapshot")
+    if len(view) <= len(MAGIC) or view[len(MAGIC)] != VERSION:
+        raise ValueError("unsupported snapshot version")
+
+    offset = len(MAGIC) + 1
+    while offset + RECORD_HEADER.size <= len(view):
+        tag, length = RECORD_HEADER.unpack_from(view, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > len(view):
+            break
+        if tag == END:
+            return
+        yield tag, view[offset : offset + length]
+        offset += length
+    raise ValueError("truncated snapshot")
+
+
+def read_tables(buffer):
+    """
+    Reads a snapshot into a dictionary of "users", "settings", "sessions" and "messages"
+    tables. The messages table is in the per-mailbox layout, with the entries of every
+    mailbox left encoded, as views of `buffer`.
+    """
+    strings = []
+    users, settings, sessions = {}, {}, {}
+    messages = {"mailboxes": [], "expirations": []}
+
+    for tag, payload in iter_records(buffer):
+        if tag == STRING:
+            strings.append(sys.intern(str(payload, "utf-8")))
+        elif tag == USER:
+            (username,) = STRING_ID.unpack_from(payload)
+            users[strings[username]] = {
+                "password": str(payload[STRING_ID.size :], "utf-8")
+            }
+        elif tag == SETTING:
+            (key,) = STRING_ID.unpack_from(payload)
+            settings[strings[key]] = json.loads(bytes(payload[STRING_ID.size :]))
+        elif tag == SESSION:
+            (username,) = STRING_ID.unpack_from(payload)
+            sessions[strings[username]] = str(payload[STRING_ID.size :], "utf-8")
+        elif tag == MAILBOX:
+            box, receiver, count, size, min_id, num_senders = (
+                MAILBOX_HEADER.unpack_from(payload)
+            )
+            sender_ids = array("I")
+            offset = MAILBOX_HEADER.size
+            end = offset + num_senders * sender_ids.itemsize
+            sender_ids.frombytes(payload[offset:end])
+            if sys.byteorder == "big":
+                sender_ids.byteswap()
+            messages["mailboxes"].append(
+                (
+                    BOXES[box],
+                    strings[receiver],
+                    count,
+                    [strings[sender] for sender in sender_ids],
+                    size,
+                    min_id,
+                    payload[end:],
+                )
+            )
+        elif tag == MESSAGES_INFO:
+            messages.update(json.loads(bytes(payload)))
+        elif tag == EXPIRATION:
+            msg_id, receiver, expires_at = EXPIRATION_RECORD.unpack_from(payload)
+            messages["expirations"].append([msg_id, strings[receiver], expires_at])
+
+    return {
+        "users": users,
+        "settings": settings,
+        "sessions": sessions,
+        "messages": messages,
+    }
+
+
+def dumps(tables):
+    """
+    Returns a snapshot of the given tables as bytes.
+    """
+    buffer = io.BytesIO()
+    writer = SnapshotWriter(buffer)
+    writer.write_tables(tables)
+    writer.close()
+    return buffer.getvalue()
+
+
+def loads(buffer):
+    """
+    Reads the tables of a snapshot returned by dumps.
+    """
+    return read_tables(buffer)
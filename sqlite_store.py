@@ -0,0 +1,489 @@
+"""
+SQLite Storage Module
+
+This script implements an alternative storage engine for the server on top of the standard
+library's sqlite3 module. Instead of keeping every table in memory and persisting it to
+JSON files, each handler runs indexed queries and single-row updates against a database
+file, so memory stays bounded as mailboxes grow and every write is transactional.
+
+Key Features:
+- Stores users, messages, message expiry times and settings in one SQLite file per server.
+- Indexes messages by receiver and delivery state, by sender, and by ID.
+- Exposes the tables through the same interfaces the server uses for the JSON engine: a
+  mapping of users, a mapping of settings, and a message store with mailbox methods that
+  take and return message_store.Message records.
+- Opens its connection lazily, so the objects can be created before the server process
+  is started.
+- Lets the server run every handler in a single transaction, so a handler that makes
+  several changes either makes all of them or none, and syncs commits to disk according
+  to the server's durability level.
+"""
+
+import contextlib
+import itertools
+import json
+import os
+import sqlite3
+from collections.abc import MutableMapping
+
+import message_store
+
+sqlite_database_path = lambda id: f"database/store_{id}.sqlite3"  # noqa: E731
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    sender TEXT NOT NULL,
+    receiver TEXT NOT NULL,
+    message TEXT NOT NULL,
+    delivered INTEGER NOT NULL,
+    seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_mailbox ON messages (receiver, delivered, seq);
+CREATE INDEX IF NOT EXISTS messages_by_sender ON messages (sender);
+CREATE INDEX IF NOT EXISTS messages_by_state ON messages (delivered, seq);
+CREATE TABLE IF NOT EXISTS expirations (
+    id INTEGER PRIMARY KEY,
+    receiver TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+BOX_STATES = {"undelivered": 0, "delivered": 1}
+
+# Durability level of the server -> synchronous setting of the connection. SQLite commits
+# each transaction on its own, so "batch" syncs every commit like "commit" does, and
+# "async" only syncs the write-ahead log when it is checkpointed
+SYNCHRONOUS = {"commit": "FULL", "batch": "FULL", "async": "NORMAL"}
+
+
+class SQLiteDatabase:
+    """
+    Lazily opened connection to the SQLite file of a server. The connection is reopened
+    in a new process, and is never pickled along with the server.
+    """
+
+    def __init__(self, vm_id, durability="batch"):
+        self.path = sqlite_database_path(vm_id)
+        self.synchronous = SYNCHRONOUS[durability]
+        self._connection = None
+        self._pid = None
+        self._next_seq = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_connection"] = None
+        state["_pid"] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            if not os.path.exists("database"):
+                os.makedirs("database")
+
+            # The internal communicator uses the connection from its own thread, but
+            # always while holding the server's database lock
+            self._connection = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._connection.executescript(SCHEMA)
+            self._pid = os.getpid()
+            self._next_seq = None
+        return self._connection
+
+    def execute(self, sql, params=()):
+        return self.connection.execute(sql, params)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Runs the enclosed statements in a single transaction.
+        """
+        connection = self.connection
+        if connection.in_transaction:
+            yield
+            return
+
+        connection.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def next_seq(self):
+        """
+        Returns the next position in filing order, used to keep each box ordered the
+        same way as the in-memory store.
+        """
+        if self._next_seq is None:
+            (max_seq,) = self.execute("SELECT MAX(seq) FROM messages").fetchone()
+            self._next_seq = (max_seq or 0) + 1
+        seq = self._next_seq
+        self._next_seq += 1
+        return seq
+
+
+class SQLiteUsers(MutableMapping):
+    """
+    Mapping of username to user record, backed by the users table. Records are returned
+    as copies, so changes must be written back by assigning the record again.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, username):
+        row = self.db.execute(
+            "SELECT password FROM users WHERE username = ?",
+            (username,),
+        ).fetchone()
+        if row is None:
+            raise KeyError(username)
+        return {"password": row[0]}
+
+    def __setitem__(self, username, user):
+        self.db.execute(
+            "INSERT OR REPLACE INTO users (username, password) VALUES (?, ?)",
+            (username, user["password"]),
+        )
+
+    def __delitem__(self, username):
+        cursor = self.db.execute("DELETE FROM users WHERE username = ?", (username,))
+        if cursor.rowcount == 0:
+            raise KeyError(username)
+
+    def __contains__(self, username):
+        return (
+            self.db.execute(
+                "SELECT 1 FROM users WHERE username = ?", (username,)
+            ).fetchone()
+            is not None
+        )
+
+    def __iter__(self):
+        for (username,) in self.db.execute(
+            "SELECT username FROM users ORDER BY rowid"
+        ).fetchall():
+            yield username
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def items(self):
+        return [
+            (username, {"password": password})
+            for username, password in self.db.execute(
+                "SELECT username, password FROM users ORDER BY rowid"
+            ).fetchall()
+        ]
+
+
+class SQLiteSettings(MutableMapping):
+    """
+    Mapping of setting name to JSON-encodable value, backed by the settings table.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, key):
+        row = self.db.execute(
+            "SELECT value FROM settings WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        self.db.execute(
+            "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+            (key, json.dumps(value)),
+        )
+
+    def __delitem__(self, key):
+        cursor = self.db.execute("DELETE FROM settings WHERE key = ?", (key,))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for (key,) in self.db.execute("SELECT key FROM settings").fetchall():
+            yield key
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM settings").fetchone()[0]
+
+
+class SQLiteMessageStore:
+    """
+    Undelivered and delivered messages backed by the messages table, with the same
+    mailbox methods as message_store.MessageStore.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def _rows_to_messages(self, rows):
+        return [message_store.Message(*row) for row in rows]
+
+    def to_dict(self):
+        return {box: self[box] for box in BOX_STATES}
+
+    def export(self):
+        """
+        Returns every message in the per-mailbox layout of a full-state sync, as
+        message_store.MessageStore.export does.
+        """
+        mailboxes = []
+        for box, state in BOX_STATES.items():
+            rows = self.db.execute(
+                "SELECT receiver, id, sender, message FROM messages "
+                "WHERE delivered = ? ORDER BY receiver, seq",
+                (state,),
+            ).fetchall()
+            for receiver, group in itertools.groupby(rows, key=lambda row: row[0]):
+                entries = [(msg_id, sender, body) for _, msg_id, sender, body in group]
+                mailboxes.append(
+                    message_store.encode_mailbox(
+                        box,
+                        receiver,
+                        entries,
+                        sum(len(body.encode("utf-8")) for _, _, body in entries),
+                    )
+                )
+        return {"mailboxes": mailboxes, "expirations": self.expirations()}
+
+    def __getitem__(self, box):
+        return [
+            msg.to_dict()
+            for msg in self._rows_to_messages(
+                self.db.execute(
+                    "SELECT id, sender, receiver, message FROM messages "
+                    "WHERE delivered = ? ORDER BY seq",
+                    (BOX_STATES[box],),
+                ).fetchall()
+            )
+        ]
+
+    def __setitem__(self, box, msg_objs):
+        with self.db.transaction():
+            self.db.execute(
+                "DELETE FROM messages WHERE delivered = ?", (BOX_STATES[box],)
+            )
+            for msg_obj in msg_objs:
+                self.add(message_store.Message.from_dict(msg_obj), box)
+
+    def size(self, box):
+        return self.db.execute(
+            "SELECT COUNT(*) FROM messages WHERE delivered = ?", (BOX_STATES[box],)
+        ).fetchone()[0]
+
+    def has_messages(self, box):
+        return (
+            self.db.execute(
+                "SELECT 1 FROM messages WHERE delivered = ? LIMIT 1",
+                (BOX_STATES[box],),
+            ).fetchone()
+            is not None
+        )
+
+    def add(self, msg, box):
+        self.db.execute(
+            "INSERT OR REPLACE INTO messages "
+            "(id, sender, receiver, message, delivered, seq) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                msg.id,
+                msg.sender,
+                msg.receiver,
+                msg.text,
+                BOX_STATES[box],
+                self.db.next_seq(),
+            ),
+        )
+
+    def locate(self, msg_id, receiver=None):
+        row = self.db.execute(
+            "SELECT delivered, receiver FROM messages WHERE id = ?", (msg_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return ("delivered" if row[0] else "undelivered", row[1])
+
+    def count(self, receiver, box="undelivered"):
+        return self.db.execute(
+            "SELECT COUNT(*) FROM messages WHERE receiver = ? AND delivered = ?",
+            (receiver, BOX_STATES[box]),
+        ).fetchone()[0]
+
+    def receivers(self, box="delivered"):
+        return {
+            receiver
+            for (receiver,) in self.db.execute(
+                "SELECT DISTINCT receiver FROM messages WHERE delivered = ?",
+                (BOX_STATES[box],),
+            ).fetchall()
+        }
+
+    def body_bytes(self, box="delivered", receiver=None):
+        if receiver is None:
+            row = self.db.execute(
+                "SELECT SUM(LENGTH(CAST(message AS BLOB))) FROM messages "
+                "WHERE delivered = ?",
+                (BOX_STATES[box],),
+            ).fetchone()
+        else:
+            row = self.db.execute(
+                "SELECT SUM(LENGTH(CAST(message AS BLOB))) FROM messages "
+                "WHERE receiver = ? AND delivered = ?",
+                (receiver, BOX_STATES[box]),
+            ).fetchone()
+        return row[0] or 0
+
+    def oldest_id(self, receiver, box="delivered"):
+        return self.db.execute(
+            "SELECT MIN(id) FROM messages WHERE receiver = ? AND delivered = ?",
+            (receiver, BOX_STATES[box]),
+        ).fetchone()[0]
+
+    def peek(self, receiver, num_messages, box="delivered"):
+        return self._rows_to_messages(
+            self.db.execute(
+                "SELECT id, sender, receiver, message FROM messages "
+                "WHERE receiver = ? AND delivered = ? ORDER BY seq LIMIT ?",
+                (receiver, BOX_STATES[box], num_messages),
+            ).fetchall()
+        )
+
+    def deliver(self, receiver, num_messages):
+        with self.db.transaction():
+            moved = self.peek(receiver, num_messages, "undelivered")
+            for msg in moved:
+                self.db.execute(
+                    "UPDATE messages SET delivered = 1, seq = ? WHERE id = ?",
+                    (self.db.next_seq(), msg.id),
+                )
+        return moved
+
+    def delete(self, receiver, msg_ids, box="delivered"):
+        msg_ids = list(msg_ids)
+        if not msg_ids:
+            return []
+
+        with self.db.transaction():
+            placeholders = ",".join("?" * len(msg_ids))
+            found = {
+                msg_id
+                for (msg_id,) in self.db.execute(
+                    f"SELECT id FROM messages WHERE id IN ({placeholders}) "
+                    "AND receiver = ? AND delivered = ?",
+                    (*msg_ids, receiver, BOX_STATES[box]),
+                ).fetchall()
+            }
+            self.db.execute(
+                f"DELETE FROM messages WHERE id IN ({placeholders}) "
+                "AND receiver = ? AND delivered = ?",
+                (*msg_ids, receiver, BOX_STATES[box]),
+            )
+        return [msg_id for msg_id in msg_ids if msg_id in found]
+
+    def remove_user(self, username):
+        self.db.execute(
+            "DELETE FROM messages WHERE sender = ? OR receiver = ?",
+            (username, username),
+        )
+
+    def set_expiry(self, msg_id, receiver, expires_at):
+        self.db.execute(
+            "INSERT OR REPLACE INTO expirations (id, receiver, expires_at) "
+            "VALUES (?, ?, ?)",
+            (msg_id, receiver, expires_at),
+        )
+
+    def pop_expiry(self, msg_id):
+        row = self.db.execute(
+            "SELECT receiver, expires_at FROM expirations WHERE id = ?", (msg_id,)
+        ).fetchone()
+        if row is not None:
+            self.db.execute("DELETE FROM expirations WHERE id = ?", (msg_id,))
+        return row
+
+    def expirations(self):
+        return [
+            list(row)
+            for row in self.db.execute(
+                "SELECT id, receiver, expires_at FROM expirations"
+            ).fetchall()
+        ]
+
+    def garbage_ratio(self):
+        (free_pages,) = self.db.execute("PRAGMA freelist_count").fetchone()
+        (pages,) = self.db.execute("PRAGMA page_count").fetchone()
+        return free_pages / pages if pages else 0.0
+
+    def compact(self):
+        # Rebuilds the file without its free pages
+        self.db.execute("VACUUM")
+
+
+def load_database(vm_id, durability="batch"):
+    """
+    Opens the SQLite database of a server and returns its users, messages and settings
+    tables. Nothing is rewritten on startup, as login states are not stored. Commits
+    are synced to disk as the server's durability level requires.
+    """
+    db = SQLiteDatabase(vm_id, durability)
+    users = SQLiteUsers(db)
+    messages = SQLiteMessageStore(db)
+    settings = SQLiteSettings(db)
+
+    with db.transaction():
+        for key, value in {
+            "counter": 0,
+            "host": "127.0.0.1",
+            "port": 54400,
+            "host_json": "127.0.0.1",
+            "port_json": 54444,
+        }.items():
+            db.execute(
+                "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
+                (key, json.dumps(value)),
+            )
+
+    return users, messages, settings
+
+
+def replace_database(users_table, messages_table, settings_table, database):
+    """
+    Replaces the contents of all tables with the users, messages and settings tables of
+    a full-state sync, in a single transaction. Messages are in the per-mailbox layout
+    with their bodies included.
+    """
+    db = users_table.db
+    with db.transaction():
+        db.execute("DELETE FROM users")
+        db.execute("DELETE FROM messages")
+        db.execute("DELETE FROM expirations")
+        db.execute("DELETE FROM settings")
+        for username, user in database["users"].items():
+            users_table[username] = user
+        for box, receiver, _, senders, _, _, data in database["messages"]["mailboxes"]:
+            for msg_id, sender, body in message_store.decode_mailbox(data, senders):
+                messages_table.add(
+                    message_store.Message(msg_id, sender, receiver, body), box
+                )
+        for msg_id, receiver, expires_at in database["messages"]["expirations"]:
+            messages_table.set_expiry(msg_id, receiver, expires_at)
+        for key, value in database["settings"].items():
+            settings_table[key] = value
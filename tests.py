@@ -1,46 +1,89 @@
 import unittest
+import asyncio
 import json
+import threading
+import time
 import types
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 # Import the modules to be tested.
 import server
 import database_wrapper
 import client_json
+import message_store
+import sqlite_store
+import group_commit
+import history_store
+import body_store
+import retention
+import timer_wheel
+import snapshot_format
+import framing
+import async_server
+import partitioning
+import internal_communications
+import command_table
+import protocol
 
 # --- Helper Classes and Functions ---
 
 
-# Dummy socket to capture sent data.
+# Dummy socket to capture sent data, and to feed received data.
 class DummySocket:
-    def __init__(self):
+    def __init__(self, send_limit=None):
         self.sent_data = []
+        self.received = []
+        # Maximum number of bytes accepted by the next send, if limited
+        self.send_limit = send_limit
 
     def send(self, data):
-        self.sent_data.append(data)
+        if self.send_limit is not None:
+            if self.send_limit == 0:
+                raise BlockingIOError
+            data = data[: self.send_limit]
+        self.sent_data.append(bytes(data))
         return len(data)
 
+    def recv(self, size):
+        return self.received.pop(0)
+
 
 # Helper function to create a dummy data object (simulating types.SimpleNamespace).
 def create_dummy_data(addr=("127.0.0.1", 12345), outb=b""):
-    return types.SimpleNamespace(addr=addr, outb=outb)
+    return types.SimpleNamespace(
+        addr=addr,
+        outb=outb,
+        frames=framing.FrameDecoder(),
+        replies=None,
+        pending=bytearray(),
+        events=server.selectors.EVENT_READ,
+        partition=None,
+        version=0,
+        routing=False,
+        closed=False,
+    )
 
 
 # Dummy internal communicator to override network updates.
 class DummyInternalCommunicator:
     def __init__(self):
         self.last_update = None
+        self.commands = command_table.CommandTable()
+        self.updates = command_table.CommandTable()
 
     def distribute_update(self, update):
         self.last_update = update
 
+    def is_leader(self):
+        return True
+
 
 # --- Unit Tests for FaultTolerantServer (server.py) ---
 class TestFaultTolerantServer(unittest.TestCase):
     def setUp(self):
         # Patch load_database to avoid file I/O.
         self.dummy_users = {}
-        self.dummy_messages = {"undelivered": [], "delivered": []}
+        self.dummy_messages = message_store.MessageStore()
         self.dummy_settings = {
             "counter": 0,
             "host": "127.0.0.1",
@@ -60,6 +103,11 @@ class TestFaultTolerantServer(unittest.TestCase):
         self.addCleanup(patcher2.stop)
         self.mock_save_database = patcher2.start()
 
+        # Patch append_log so that write-ahead log records are captured in memory.
+        patcher3 = patch("database_wrapper.append_log", return_value=None)
+        self.addCleanup(patcher3.stop)
+        self.mock_append_log = patcher3.start()
+
         # Create an instance of FaultTolerantServer.
         self.server_instance = server.FaultTolerantServer(
             id=0,
@@ -69,7 +117,10 @@ class TestFaultTolerantServer(unittest.TestCase):
             internal_other_servers=["localhost"],
             internal_other_ports=[60000],
             internal_max_ports=[10],
+            # Persist and reply right away, as there is no selector loop.
+            durability="commit",
         )
+        self.server_instance.open_database()
         # Replace internal communicator with a dummy.
         self.server_instance.internal_communicator = DummyInternalCommunicator()
 
@@ -86,6 +137,182 @@ class TestFaultTolerantServer(unittest.TestCase):
         self.assertEqual(command_data, {"key": "value"})
         self.assertEqual(data_length, len(data_str))
 
+    def test_service_connection_handles_framed_requests(self):
+        self.server_instance.database["users"] = {"user1": {"password": "pass1"}}
+        request = {"version": 0, "command": "search", "data": {"search": "user*"}}
+        encoded = json.dumps(request).encode("utf-8")
+        dummy_sock = DummySocket()
+        dummy_data = create_dummy_data()
+        key = types.SimpleNamespace(fileobj=dummy_sock, data=dummy_data)
+
+        # A version 0 request split across reads is handled once it is complete.
+        dummy_sock.received.append(encoded[:10])
+        self.server_instance.service_connection(key, server.selectors.EVENT_READ)
+        self.assertEqual(dummy_sock.sent_data, [])
+        dummy_sock.received.append(encoded[10:] + b"\0")
+        self.server_instance.service_connection(key, server.selectors.EVENT_READ)
+        response = json.loads(dummy_sock.sent_data[0].decode("utf-8"))
+        self.assertEqual(response["data"]["user_list"], ["user1"])
+
+        # Length-prefixed requests get length-prefixed replies.
+        dummy_sock.received.append(framing.encode_frame(encoded))
+        self.server_instance.service_connection(key, server.selectors.EVENT_READ)
+        reply = framing.FrameDecoder()
+        reply.feed(dummy_sock.sent_data[1])
+        self.assertEqual(json.loads(reply.next_frame()), response)
+
+    def test_stats_reports_handled_commands(self):
+        dummy_sock = DummySocket()
+        dummy_data = create_dummy_data()
+        key = types.SimpleNamespace(fileobj=dummy_sock, data=dummy_data)
+        requests = [
+            {"version": 0, "command": command, "data": {"search": "*"}}
+            for command in ("search", "search", "unknown", "stats")
+        ]
+        dummy_sock.received.append(
+            b"".join(
+                framing.encode_frame(json.dumps(request).encode("utf-8"))
+                for request in requests
+            )
+        )
+        self.server_instance.service_connection(key, server.selectors.EVENT_READ)
+
+        replies = framing.FrameDecoder()
+        replies.feed(dummy_sock.sent_data[0])
+        response = json.loads(list(replies)[-1])
+        self.assertEqual(response["command"], "stats")
+        commands = response["data"]["commands"]
+        self.assertEqual(list(commands), ["search"])
+        self.assertEqual(commands["search"]["calls"], 2)
+        self.assertEqual(sum(commands["search"]["histogram"].values()), 2)
+
+    def test_replicated_updates_are_dispatched_once_decoded(self):
+        communicator = internal_communications.InternalCommunicator(
+            self.server_instance, "0", ["localhost"], [60000], [1], "localhost", 60000
+        )
+        update = {"username": "user1", "password": "pass1", "addr": None}
+        msg = {
+            "version": 0,
+            "command": "distribute_update",
+            "data": {"version": 0, "command": "create", "data": update},
+        }
+        communicator.handle_message(None, msg, b"", json.dumps(msg))
+
+        self.assertIn("user1", self.server_instance.database["users"])
+        self.assertEqual(communicator.updates.stats()["create"]["calls"], 1)
+        self.assertEqual(communicator.commands.stats()["distribute_update"]["calls"], 1)
+
+    def test_replicated_message_wakes_waiters(self):
+        self.server_instance.database["users"] = {"user1": {"password": "pass1"}}
+        communicator = internal_communications.InternalCommunicator(
+            self.server_instance, "0", ["localhost"], [60000], [1], "localhost", 60000
+        )
+        dummy_sock = DummySocket()
+        self.server_instance.wait_for_messages(
+            dummy_sock, create_dummy_data(), {"username": "user1"}
+        )
+
+        update = {"sender": "user2", "recipient": "user1", "message": "Hi"}
+        msg = {
+            "version": 0,
+            "command": "distribute_update",
+            "data": {"version": 0, "command": "send_msg", "data": update},
+        }
+        communicator.handle_message(None, msg, b"", json.dumps(msg))
+
+        response = json.loads(dummy_sock.sent_data[0].decode("utf-8"))
+        self.assertEqual(response["command"], "new_messages")
+        self.assertEqual(response["data"]["messages"][0]["message"], "Hi")
+
+    def test_hello_negotiates_binary_protocol(self):
+        self.server_instance.database["users"] = {"user1": {"password": "pass1"}}
+        dummy_sock = DummySocket()
+        dummy_data = create_dummy_data()
+        key = types.SimpleNamespace(fileobj=dummy_sock, data=dummy_data)
+
+        # The hello is answered in JSON, with the highest version both sides support.
+        hello = {"version": 0, "command": "hello", "data": {"versions": [0, 1, 7]}}
+        dummy_sock.received.append(json.dumps(hello).encode("utf-8") + b"\0")
+        self.server_instance.service_connection(key, server.selectors.EVENT_READ)
+        response = json.loads(dummy_sock.sent_data[0].decode("utf-8"))
+        self.assertEqual(response["data"], {"version": 1})
+        self.assertEqual(dummy_data.version, 1)
+
+        # Later replies are encoded in version 1.
+        request = protocol.encode_request("search", {"search": "user*"}, version=1)
+        dummy_sock.received.append(framing.encode_frame(request))
+        self.server_instance.service_connection(key, server.selectors.EVENT_READ)
+        reply = framing.FrameDecoder()
+        reply.feed(dummy_sock.sent_data[1])
+        frame = reply.next_frame()
+        self.assertTrue(protocol.is_binary(frame))
+        self.assertEqual(protocol.decode_reply(frame)["data"], {"user_list": ["user1"]})
+
+    def test_service_connection_drains_pipelined_requests(self):
+        self.server_instance.database["users"] = {"user1": {"password": "pass1"}}
+        dummy_sock = DummySocket()
+        dummy_data = create_dummy_data()
+        key = types.SimpleNamespace(fileobj=dummy_sock, data=dummy_data)
+        requests = [
+            {"version": 0, "command": "search", "data": {"search": pattern}}
+            for pattern in ("user*", "nobody", "*")
+        ]
+        dummy_sock.received.append(
+            b"".join(
+                framing.encode_frame(json.dumps(request).encode())
+                for request in requests
+            )
+        )
+
+        # Every request is handled in one call, and the replies sent in one write.
+        self.server_instance.service_connection(key, server.selectors.EVENT_READ)
+        self.assertEqual(len(dummy_sock.sent_data), 1)
+        replies = framing.FrameDecoder()
+        replies.feed(dummy_sock.sent_data[0])
+        self.assertEqual(
+            [json.loads(reply)["data"]["user_list"] for reply in replies],
+            [["user1"], [], ["user1"]],
+        )
+        self.assertIsNone(dummy_data.replies)
+
+    def test_output_is_queued_until_socket_is_writable(self):
+        self.server_instance.sel = Mock()
+        dummy_sock = DummySocket(send_limit=4)
+        dummy_data = create_dummy_data()
+        key = types.SimpleNamespace(fileobj=dummy_sock, data=dummy_data)
+
+        # Whatever the socket does not take is queued, and write readiness awaited.
+        self.server_instance.queue_output(dummy_sock, dummy_data, b"hello")
+        self.server_instance.queue_output(dummy_sock, dummy_data, b" world")
+        self.assertEqual(dummy_sock.sent_data, [b"hell"])
+        self.assertEqual(dummy_data.pending, b"o world")
+        self.server_instance.sel.modify.assert_called_once_with(
+            dummy_sock,
+            server.selectors.EVENT_READ | server.selectors.EVENT_WRITE,
+            data=dummy_data,
+        )
+
+        dummy_sock.send_limit = 0
+        self.server_instance.service_connection(key, server.selectors.EVENT_WRITE)
+        self.assertEqual(dummy_data.pending, b"o world")
+
+        # Write readiness is no longer awaited once the queue is sent.
+        dummy_sock.send_limit = None
+        self.server_instance.service_connection(key, server.selectors.EVENT_WRITE)
+        self.assertEqual(dummy_sock.sent_data, [b"hell", b"o world"])
+        self.assertEqual(dummy_data.pending, b"")
+        self.server_instance.sel.modify.assert_called_with(
+            dummy_sock, server.selectors.EVENT_READ, data=dummy_data
+        )
+
+    def test_reading_stops_while_too_much_output_is_queued(self):
+        self.server_instance.sel = Mock()
+        dummy_sock = DummySocket(send_limit=0)
+        dummy_data = create_dummy_data()
+        payload = b"x" * server.MAX_PENDING_OUTPUT
+        self.server_instance.queue_output(dummy_sock, dummy_data, payload)
+        self.assertEqual(dummy_data.events, server.selectors.EVENT_WRITE)
+
     def test_create_account_valid(self):
         # Test valid account creation.
         command_obj = {
@@ -99,9 +326,7 @@ class TestFaultTolerantServer(unittest.TestCase):
         )
         dummy_sock = DummySocket()
 
-        self.server_instance.create_account(
-            dummy_sock, dummy_data, internal_change=False
-        )
+        self.server_instance.create_account(dummy_sock, dummy_data, command_obj["data"])
 
         # Verify that the user is added.
         self.assertIn("user1", self.server_instance.database["users"])
@@ -123,9 +348,7 @@ class TestFaultTolerantServer(unittest.TestCase):
         )
         dummy_sock = DummySocket()
 
-        self.server_instance.create_account(
-            dummy_sock, dummy_data, internal_change=False
-        )
+        self.server_instance.create_account(dummy_sock, dummy_data, command_obj["data"])
         # Verify that an error response was sent.
         self.assertTrue(len(dummy_sock.sent_data) > 0)
         response = json.loads(dummy_sock.sent_data[0].decode("utf-8"))
@@ -144,7 +367,7 @@ class TestFaultTolerantServer(unittest.TestCase):
         )
         dummy_sock = DummySocket()
 
-        self.server_instance.login(dummy_sock, dummy_data, internal_change=False)
+        self.server_instance.login(dummy_sock, dummy_data, command_obj["data"])
         self.assertTrue(len(dummy_sock.sent_data) > 0)
         response = json.loads(dummy_sock.sent_data[0].decode("utf-8"))
         self.assertEqual(response["command"], "error")
@@ -162,16 +385,12 @@ class TestFaultTolerantServer(unittest.TestCase):
     def test_deliver_message_logged_in(self):
         # Set up users where the recipient is logged in.
         self.server_instance.database["users"] = {
-            "user1": {
-                "password": "pass1",
-                "logged_in": True,
-                "addr": "127.0.0.1:12345",
-            },
-            "user2": {
-                "password": "pass2",
-                "logged_in": True,
-                "addr": "127.0.0.1:54321",
-            },
+            "user1": {"password": "pass1"},
+            "user2": {"password": "pass2"},
+        }
+        self.server_instance.sessions = {
+            "user1": "127.0.0.1:12345",
+            "user2": "127.0.0.1:54321",
         }
         command_obj = {
             "version": 0,
@@ -185,7 +404,7 @@ class TestFaultTolerantServer(unittest.TestCase):
         dummy_sock = DummySocket()
 
         self.server_instance.deliver_message(
-            dummy_sock, dummy_data, internal_change=False
+            dummy_sock, dummy_data, command_obj["data"]
         )
         delivered = self.server_instance.database["messages"]["delivered"]
         self.assertEqual(len(delivered), 1)
@@ -194,17 +413,10 @@ class TestFaultTolerantServer(unittest.TestCase):
     def test_deliver_message_not_logged_in(self):
         # Set up users where the recipient is not logged in.
         self.server_instance.database["users"] = {
-            "user1": {
-                "password": "pass1",
-                "logged_in": True,
-                "addr": "127.0.0.1:12345",
-            },
-            "user2": {
-                "password": "pass2",
-                "logged_in": False,
-                "addr": "127.0.0.1:54321",
-            },
+            "user1": {"password": "pass1"},
+            "user2": {"password": "pass2"},
         }
+        self.server_instance.sessions = {"user1": "127.0.0.1:12345"}
         command_obj = {
             "version": 0,
             "command": "send_msg",
@@ -217,12 +429,1424 @@ class TestFaultTolerantServer(unittest.TestCase):
         dummy_sock = DummySocket()
 
         self.server_instance.deliver_message(
-            dummy_sock, dummy_data, internal_change=False
+            dummy_sock, dummy_data, command_obj["data"]
         )
         undelivered = self.server_instance.database["messages"]["undelivered"]
         self.assertEqual(len(undelivered), 1)
         self.assertEqual(undelivered[0]["message"], "Hello")
 
+    def test_deliver_message_pushes_to_online_receiver(self):
+        self.server_instance.database["users"] = {
+            "user1": {"password": "pass1"},
+            "user2": {"password": "pass2"},
+        }
+        # user2 is logged in from a client sending length-prefixed frames.
+        receiver_sock = DummySocket()
+        receiver_data = create_dummy_data(addr=("127.0.0.1", 54321))
+        self.server_instance.clients["127.0.0.1:54321"] = (receiver_sock, receiver_data)
+        login = {"username": "user2", "password": "pass2"}
+        receiver_data.frames.feed(
+            framing.encode_frame(
+                json.dumps({"version": 0, "command": "login", "data": login}).encode()
+            )
+        )
+        self.server_instance.handle_frames(receiver_sock, receiver_data)
+        receiver_sock.sent_data.clear()
+
+        command_data = {"sender": "user1", "recipient": "user2", "message": "Hello"}
+        self.server_instance.deliver_message(
+            DummySocket(), create_dummy_data(), command_data
+        )
+
+        frames = framing.FrameDecoder()
+        frames.feed(b"".join(receiver_sock.sent_data))
+        push = json.loads(frames.next_frame())
+        self.assertEqual(push["command"], "new_message")
+        self.assertEqual(push["data"], {"id": 1, "sender": "user1", "message": "Hello"})
+
+        # Clients whose replies are not length-prefixed are never pushed to.
+        unframed_sock = DummySocket()
+        self.server_instance.clients["127.0.0.1:54321"] = (
+            unframed_sock,
+            create_dummy_data(addr=("127.0.0.1", 54321)),
+        )
+        self.server_instance.deliver_message(
+            DummySocket(), create_dummy_data(), command_data
+        )
+        self.assertEqual(unframed_sock.sent_data, [])
+
+    def test_wait_for_messages_is_woken_by_a_new_message(self):
+        self.server_instance.database["users"] = {
+            "user1": {"password": "pass1"},
+            "user2": {"password": "pass2"},
+        }
+        dummy_sock = DummySocket()
+        dummy_data = create_dummy_data()
+        requests = [
+            ("wait_for_messages", {"username": "user2"}),
+            ("refresh_home", {"username": "user2"}),
+        ]
+        dummy_data.frames.feed(
+            b"".join(
+                framing.encode_frame(
+                    json.dumps(
+                        {"version": 0, "command": command, "data": data}
+                    ).encode()
+                )
+                for command, data in requests
+            )
+        )
+
+        # The wait is parked, and holds back the request sent after it.
+        self.server_instance.handle_frames(dummy_sock, dummy_data)
+        self.assertEqual(dummy_sock.sent_data, [])
+        self.assertEqual(len(self.server_instance.waiters["user2"]), 1)
+
+        command_data = {"sender": "user1", "recipient": "user2", "message": "Hello"}
+        self.server_instance.deliver_message(
+            DummySocket(), create_dummy_data(), command_data
+        )
+        replies = framing.FrameDecoder()
+        replies.feed(b"".join(dummy_sock.sent_data))
+        wait_reply, refresh_reply = [json.loads(reply) for reply in replies]
+        self.assertEqual(
+            wait_reply["data"],
+            {
+                "undeliv_messages": 1,
+                "messages": [{"id": 1, "sender": "user1", "message": "Hello"}],
+            },
+        )
+        self.assertEqual(refresh_reply["command"], "refresh_home")
+        self.assertEqual(self.server_instance.waiters, {})
+        self.assertEqual(len(self.server_instance.timers), 0)
+
+    def test_wait_for_messages_times_out(self):
+        self.server_instance.database["users"] = {"user1": {"password": "pass1"}}
+        now = [0.0]
+        self.server_instance.timers = timer_wheel.TimerWheel(clock=lambda: now[0])
+        dummy_sock = DummySocket()
+        dummy_data = create_dummy_data()
+
+        self.server_instance.wait_for_messages(
+            dummy_sock, dummy_data, {"username": "user1", "timeout": 2}
+        )
+        now[0] = 1.9
+        self.server_instance.timers.run_due()
+        self.assertEqual(dummy_sock.sent_data, [])
+        now[0] = 2.0
+        self.server_instance.timers.run_due()
+        response = json.loads(dummy_sock.sent_data[0].decode("utf-8"))
+        self.assertEqual(response["data"], {"undeliv_messages": 0, "messages": []})
+        self.assertFalse(dummy_data.routing)
+
+        # Users with undelivered messages are answered right away, and invalid
+        # timeouts are rejected.
+        self.dummy_messages.add(
+            message_store.Message(1, "user2", "user1", "Hello"), "undelivered"
+        )
+        for timeout, command in ((None, "new_messages"), (-1, "error")):
+            dummy_sock = DummySocket()
+            self.server_instance.wait_for_messages(
+                dummy_sock,
+                create_dummy_data(),
+                {"username": "user1", "timeout": timeout},
+            )
+            response = json.loads(dummy_sock.sent_data[0].decode("utf-8"))
+            self.assertEqual(response["command"], command)
+        self.assertEqual(self.server_instance.waiters, {})
+
+    def test_deliver_message_appends_log_record(self):
+        # Sending a message should log a single add_message record.
+        self.server_instance.database["users"] = {
+            "user1": {"password": "pass1"},
+            "user2": {"password": "pass2"},
+        }
+        command_obj = {
+            "version": 0,
+            "command": "send_msg",
+            "data": {"sender": "user1", "recipient": "user2", "message": "Hello"},
+        }
+        dummy_data = create_dummy_data(outb=json.dumps(command_obj).encode("utf-8"))
+
+        self.server_instance.deliver_message(
+            DummySocket(), dummy_data, command_obj["data"]
+        )
+
+        self.mock_save_database.assert_not_called()
+        vm_id, records = self.mock_append_log.call_args.args
+        self.assertEqual(vm_id, self.server_instance.id)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["op"], "add_message")
+        self.assertEqual(records[0]["box"], "undelivered")
+        self.assertEqual(records[0]["message"]["message"], "Hello")
+
+    def test_deliver_message_with_ttl_expires(self):
+        self.server_instance.database["users"] = {
+            "user1": {"password": "pass1"},
+            "user2": {"password": "pass2"},
+        }
+        now = [0.0]
+        self.server_instance.timers = timer_wheel.TimerWheel(clock=lambda: now[0])
+        command_obj = {
+            "version": 0,
+            "command": "send_msg",
+            "data": {
+                "sender": "user1",
+                "recipient": "user2",
+                "message": "Hello",
+                "ttl": 5,
+            },
+        }
+        dummy_data = create_dummy_data(outb=json.dumps(command_obj).encode("utf-8"))
+
+        with patch("time.time", return_value=1000):
+            self.server_instance.deliver_message(
+                DummySocket(), dummy_data, command_obj["data"]
+            )
+
+        # The expiry time is logged, stored and replicated along with the message.
+        _, records = self.mock_append_log.call_args.args
+        self.assertEqual(records[0]["expires_at"], 1005)
+        self.assertEqual(self.dummy_messages.expirations(), [[1, "user2", 1005]])
+        self.assertEqual(
+            self.server_instance.internal_communicator.last_update["data"][
+                "expires_at"
+            ],
+            1005,
+        )
+
+        now[0] = 4.9
+        self.assertEqual(self.server_instance.timers.run_due(), 0)
+        self.assertEqual(self.dummy_messages.count("user2"), 1)
+
+        now[0] = 5.0
+        self.assertEqual(self.server_instance.timers.run_due(), 1)
+        self.assertEqual(self.dummy_messages.count("user2"), 0)
+        self.assertEqual(self.dummy_messages.expirations(), [])
+        _, records = self.mock_append_log.call_args.args
+        self.assertEqual(
+            list(records),
+            [
+                {
+                    "op": "expire_message",
+                    "id": 1,
+                    "receiver": "user2",
+                    "box": "undelivered",
+                }
+            ],
+        )
+
+    def test_replicated_expiry_wakes_the_server_loop(self):
+        self.server_instance.database["users"] = {"user2": {"password": "pass2"}}
+        self.server_instance.port = 0
+        communicator = self.server_instance.internal_communicator
+        communicator.start = Mock()
+
+        def stop():
+            raise KeyboardInterrupt
+
+        def from_another_thread(callback, *args):
+            # As the internal communicator does with replicated changes
+            with self.server_instance.db_lock:
+                callback(*args)
+                self.server_instance.wake_loop()
+
+        with patch(
+            "internal_communications.InternalCommunicator", return_value=communicator
+        ), patch("database_wrapper.Snapshotter"):
+            loop = threading.Thread(target=self.server_instance.run, daemon=True)
+            loop.start()
+            deadline = time.monotonic() + 5
+            while self.server_instance.wakeup is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            # The loop is waiting without a timeout when the message is replicated.
+            from_another_thread(
+                self.server_instance.deliver_message,
+                None,
+                None,
+                {
+                    "sender": "user1",
+                    "recipient": "user2",
+                    "message": "Hello",
+                    "expires_at": time.time() + 0.1,
+                },
+                True,
+            )
+            self.assertEqual(self.dummy_messages.count("user2"), 1)
+            while self.dummy_messages.count("user2") and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self.dummy_messages.count("user2"), 0)
+
+            from_another_thread(self.server_instance.timers.schedule, 0, stop)
+            loop.join(5)
+        self.assertFalse(loop.is_alive())
+
+    def test_replicated_changes_are_flushed_after_the_commit_window(self):
+        self.server_instance.committer = group_commit.GroupCommitter(
+            self.server_instance.id, durability="batch", window=0.2
+        )
+        self.server_instance.port = 0
+        communicator = internal_communications.InternalCommunicator(
+            self.server_instance, "0", ["localhost"], [60000], [1], "localhost", 60000
+        )
+        communicator.start = Mock()
+
+        def stop():
+            raise KeyboardInterrupt
+
+        with patch(
+            "internal_communications.InternalCommunicator", return_value=communicator
+        ), patch("database_wrapper.Snapshotter"):
+            loop = threading.Thread(target=self.server_instance.run, daemon=True)
+            loop.start()
+            deadline = time.monotonic() + 5
+            while self.server_instance.wakeup is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            # As the internal communicator does once it applied replicated changes
+            msg = {
+                "version": 0,
+                "command": "distribute_update",
+                "data": {
+                    "version": 0,
+                    "command": "create",
+                    "data": {"username": "user1", "password": "pass1", "addr": None},
+                },
+            }
+            with self.server_instance.db_lock:
+                communicator.handle_message(None, msg, b"", json.dumps(msg))
+                self.server_instance.wake_loop()
+            replicated = time.monotonic()
+            self.mock_append_log.assert_not_called()
+
+            # The client loop persists them once the commit window has passed.
+            while not self.mock_append_log.called and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertGreaterEqual(time.monotonic() - replicated, 0.15)
+            self.mock_append_log.assert_called_once()
+
+            with self.server_instance.db_lock:
+                self.server_instance.timers.schedule(0, stop)
+                self.server_instance.wake_loop()
+            loop.join(5)
+        self.assertFalse(loop.is_alive())
+
+    def test_deliver_message_rejects_invalid_ttl(self):
+        self.server_instance.database["users"] = {
+            "user1": {"password": "pass1"},
+            "user2": {"password": "pass2"},
+        }
+        for ttl in (0, -1, "5", True):
+            command_obj = {
+                "version": 0,
+                "command": "send_msg",
+                "data": {
+                    "sender": "user1",
+                    "recipient": "user2",
+                    "message": "Hello",
+                    "ttl": ttl,
+                },
+            }
+            dummy_data = create_dummy_data(outb=json.dumps(command_obj).encode("utf-8"))
+            dummy_sock = DummySocket()
+            self.server_instance.deliver_message(
+                dummy_sock, dummy_data, command_obj["data"]
+            )
+
+            response = json.loads(dummy_sock.sent_data[0].decode("utf-8"))
+            self.assertEqual(response["command"], "error")
+        self.assertEqual(self.dummy_messages.count("user2"), 0)
+
+    def test_full_state_sync_round_trip(self):
+        self.server_instance.database["users"] = {
+            "user1": {"password": "pass1"},
+            "user2": {"password": "pass2"},
+        }
+        self.server_instance.sessions = {"user1": "127.0.0.1:50001"}
+        # Keep bodies in memory, so that the new store writes no body segment.
+        self.server_instance.message_bodies = "inline"
+        self.dummy_messages.add(
+            message_store.Message(1, "user1", "user2", "Hello"), "undelivered"
+        )
+        self.dummy_messages.add(
+            message_store.Message(2, "user2", "user1", "Hi ✓"), "delivered"
+        )
+        self.dummy_messages.set_expiry(1, "user2", 5000)
+
+        snapshot = snapshot_format.dumps(self.server_instance.export_database())
+        self.server_instance.sessions = {}
+        self.server_instance.replace_database(snapshot_format.loads(snapshot))
+
+        messages = self.server_instance.database["messages"]
+        self.assertEqual(self.server_instance.sessions, {"user1": "127.0.0.1:50001"})
+        self.assertEqual(
+            self.server_instance.database["users"]["user2"]["password"], "pass2"
+        )
+        self.assertEqual(
+            str(messages.peek("user2", 1, "undelivered")[0].message), "Hello"
+        )
+        self.assertEqual(str(messages.peek("user1", 1, "delivered")[0].message), "Hi ✓")
+        self.assertEqual(messages.expirations(), [[1, "user2", 5000]])
+
+    def test_get_undelivered_messages_moves_to_delivered(self):
+        self.server_instance.database["messages"]["undelivered"] = [
+            {"receiver": "user1", "id": 1, "sender": "user2", "message": "Hello"},
+            {"receiver": "user2", "id": 2, "sender": "user1", "message": "Hey"},
+            {"receiver": "user1", "id": 3, "sender": "user3", "message": "Hi"},
+        ]
+        command_obj = {
+            "version": 0,
+            "command": "get_undelivered",
+            "data": {"username": "user1", "num_messages": 5},
+        }
+        dummy_data = create_dummy_data(outb=json.dumps(command_obj).encode("utf-8"))
+        dummy_sock = DummySocket()
+
+        self.server_instance.get_undelivered_messages(
+            dummy_sock, dummy_data, command_obj["data"]
+        )
+
+        response = json.loads(dummy_sock.sent_data[0].decode("utf-8"))
+        self.assertEqual([msg["id"] for msg in response["data"]["messages"]], [1, 3])
+        self.assertEqual(self.server_instance.get_new_messages("user1"), 0)
+        self.assertEqual(self.server_instance.get_new_messages("user2"), 1)
+        # Replicas are asked to move the same number of messages.
+        self.assertEqual(
+            self.server_instance.internal_communicator.last_update["data"],
+            {"username": "user1", "num_messages": 5},
+        )
+
+    def test_delete_messages_accepts_string_and_list(self):
+        self.server_instance.database["messages"]["delivered"] = [
+            {"receiver": "user1", "id": 1, "sender": "user2", "message": "Hello"},
+            {"receiver": "user2", "id": 2, "sender": "user1", "message": "Hey"},
+            {"receiver": "user1", "id": 3, "sender": "user3", "message": "Hi"},
+        ]
+        for delete_ids, expected in (("1,2", [3]), ([3], [])):
+            command_obj = {
+                "version": 0,
+                "command": "delete_msg",
+                "data": {"current_user": "user1", "delete_ids": delete_ids},
+            }
+            dummy_data = create_dummy_data(outb=json.dumps(command_obj).encode("utf-8"))
+            self.server_instance.delete_messages(
+                DummySocket(), dummy_data, command_obj["data"]
+            )
+            self.assertEqual(
+                [
+                    msg.id
+                    for msg in self.server_instance.database["messages"].peek(
+                        "user1", 10
+                    )
+                ],
+                expected,
+            )
+        # Message 2 belongs to user2 and must survive.
+        self.assertEqual(
+            self.server_instance.database["messages"].locate(2), ("delivered", "user2")
+        )
+        self.assertEqual(
+            self.server_instance.internal_communicator.last_update["data"],
+            {"current_user": "user1", "delete_ids": [3]},
+        )
+
+    def add_delivered(self, receiver, msg_ids, body="hi"):
+        for msg_id in msg_ids:
+            self.dummy_messages.add(
+                message_store.Message(msg_id, "a", receiver, body), "delivered"
+            )
+        self.dummy_settings["counter"] = max(msg_ids)
+
+    def retention_worker(self, **policy):
+        import threading
+
+        self.server_instance.db_lock = threading.RLock()
+        return retention.RetentionWorker(
+            self.server_instance, retention.RetentionPolicy(**policy), batch_size=2
+        )
+
+    def test_retention_evicts_oldest_messages_over_count(self):
+        self.add_delivered("b", [1, 2, 3, 4, 5])
+        self.add_delivered("c", [6])
+        worker = self.retention_worker(max_messages=2)
+
+        # Evictions happen in batches of two until the policy holds.
+        self.assertEqual(worker.run_once(), 3)
+        self.assertEqual([msg.id for msg in self.dummy_messages.peek("b", 10)], [4, 5])
+        self.assertEqual(self.dummy_messages.count("c", "delivered"), 1)
+
+        # Evictions are persisted and replicated like deletions.
+        self.assertEqual(
+            self.server_instance.internal_communicator.last_update,
+            {"command": "delete_msg", "data": {"current_user": "b", "delete_ids": [3]}},
+        )
+        self.assertEqual(self.mock_append_log.call_count, 2)
+
+    def test_retention_evicts_messages_by_age(self):
+        self.add_delivered("b", [1, 2])
+        worker = self.retention_worker(max_age=60)
+        worker.sample_counter(now=1000)
+        self.add_delivered("b", [3])
+        worker.sample_counter(now=1030)
+
+        # Only the messages sent before the oldest sample old enough have expired.
+        self.assertIsNone(worker.expired_id(now=1059))
+        self.assertEqual(worker.expired_id(now=1060), 2)
+        with patch("time.time", return_value=1070):
+            self.assertEqual(worker._evict_expired(10), 2)
+        self.assertEqual([msg.id for msg in self.dummy_messages.peek("b", 10)], [3])
+
+    def test_retention_evicts_largest_mailboxes_over_bytes(self):
+        self.add_delivered("b", [1, 2, 3], body="x" * 10)
+        self.add_delivered("c", [4], body="x" * 10)
+        worker = self.retention_worker(max_bytes=25)
+
+        self.assertEqual(worker.run_once(), 2)
+        self.assertEqual(self.dummy_messages.body_bytes(), 20)
+        self.assertEqual(self.dummy_messages.count("b", "delivered"), 1)
+        self.assertEqual(self.dummy_messages.count("c", "delivered"), 1)
+
+    def test_retention_worker_starts_with_the_server_loop(self):
+        self.add_delivered("b", [1, 2, 3, 4, 5])
+        self.server_instance.retention_policy = retention.RetentionPolicy(
+            max_messages=2
+        )
+        self.server_instance.port = 0
+        # The internal communicator only exists once run() has created it.
+        del self.server_instance.internal_communicator
+        communicator = DummyInternalCommunicator()
+        communicator.start = Mock()
+        messages = self.dummy_messages
+
+        class SelectorStoppedOnceEvicted(server.selectors.DefaultSelector):
+            def select(self, timeout=None):
+                deadline = time.monotonic() + 5
+                while messages.count("b", "delivered") > 2:
+                    if time.monotonic() > deadline:
+                        break
+                    time.sleep(0.01)
+                raise KeyboardInterrupt
+
+        with patch(
+            "internal_communications.InternalCommunicator", return_value=communicator
+        ), patch("database_wrapper.Snapshotter"), patch(
+            "selectors.DefaultSelector", SelectorStoppedOnceEvicted
+        ):
+            self.server_instance.run()
+
+        self.assertEqual([msg.id for msg in self.dummy_messages.peek("b", 10)], [4, 5])
+        self.assertEqual(
+            communicator.last_update,
+            {
+                "command": "delete_msg",
+                "data": {"current_user": "b", "delete_ids": [1, 2, 3]},
+            },
+        )
+        self.assertFalse(self.server_instance.retention_worker.is_alive())
+
+
+# --- Unit Tests for the asyncio engine (async_server.py) ---
+class DummyTransport:
+    def __init__(self):
+        self.written = []
+        self.closed = False
+        self.reading = True
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 12345)
+
+    def set_write_buffer_limits(self, high):
+        self.high = high
+
+    def write(self, data):
+        self.written.append(data)
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+
+class TestAsyncServer(unittest.TestCase):
+    def setUp(self):
+        patcher = patch(
+            "database_wrapper.load_database",
+            return_value=({}, message_store.MessageStore(), {"counter": 0}),
+        )
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        patcher2 = patch("database_wrapper.append_log", return_value=None)
+        self.addCleanup(patcher2.stop)
+        patcher2.start()
+
+        self.server_instance = async_server.AsyncFaultTolerantServer(
+            id=0, host="localhost", port=50000, durability="batch"
+        )
+        self.server_instance.open_database()
+        self.server_instance.internal_communicator = DummyInternalCommunicator()
+        self.server_instance.db_lock = threading.RLock()
+
+    def test_requests_are_answered_at_the_end_of_the_iteration(self):
+        requests = [
+            {
+                "version": 0,
+                "command": "create",
+                "data": {"username": name, "password": "p"},
+            }
+            for name in ("user1", "user2")
+        ]
+        stream = b"".join(
+            framing.encode_frame(json.dumps(request).encode()) for request in requests
+        )
+
+        async def scenario():
+            self.server_instance.loop = asyncio.get_running_loop()
+            self.server_instance.loop_thread = threading.get_ident()
+            self.server_instance.iteration_handle = None
+            transport = DummyTransport()
+            protocol = async_server.ClientProtocol(self.server_instance)
+            protocol.connection_made(transport)
+
+            protocol.data_received(stream[:10])
+            protocol.data_received(stream[10:])
+            # Replies are held until the batch is persisted, at the end of the iteration.
+            self.assertEqual(transport.written, [])
+            await asyncio.sleep(0)
+            return transport
+
+        transport = asyncio.run(scenario())
+        self.assertEqual(len(transport.written), 1)
+        replies = framing.FrameDecoder()
+        replies.feed(transport.written[0])
+        self.assertEqual(
+            [json.loads(reply)["data"]["username"] for reply in replies],
+            ["user1", "user2"],
+        )
+        self.assertEqual(
+            sorted(self.server_instance.database["users"]), ["user1", "user2"]
+        )
+
+    def test_held_replies_from_other_threads_are_written_by_the_loop(self):
+        transport = DummyTransport()
+        protocol = async_server.ClientProtocol(self.server_instance)
+        protocol.connection_made(transport)
+
+        async def scenario():
+            self.server_instance.loop = asyncio.get_running_loop()
+            self.server_instance.loop_thread = threading.get_ident()
+            # The retention worker flushes the group committer from its own thread.
+            worker = threading.Thread(
+                target=self.server_instance.send_held, args=(protocol, b"reply")
+            )
+            worker.start()
+            worker.join()
+            self.assertEqual(transport.written, [])
+            await asyncio.sleep(0)
+
+        asyncio.run(scenario())
+        self.assertEqual(transport.written, [b"reply"])
+
+    def test_reading_pauses_while_output_is_buffered(self):
+        transport = DummyTransport()
+        protocol = async_server.ClientProtocol(self.server_instance)
+        protocol.connection_made(transport)
+        self.assertEqual(transport.high, server.MAX_PENDING_OUTPUT)
+        protocol.pause_writing()
+        self.assertFalse(transport.reading)
+        protocol.resume_writing()
+        self.assertTrue(transport.reading)
+
+
+# --- Unit Tests for partitioned workers (partitioning.py) ---
+class TestPartitionedServers(unittest.TestCase):
+    def setUp(self):
+        # Each worker loads a database of its own.
+        patcher = patch(
+            "database_wrapper.load_database",
+            side_effect=lambda *args, **kwargs: (
+                {},
+                message_store.MessageStore(),
+                {"counter": 0},
+            ),
+        )
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        patcher2 = patch("database_wrapper.append_log", return_value=None)
+        self.addCleanup(patcher2.stop)
+        patcher2.start()
+
+        # Frames sent on the links are delivered when pump is called.
+        self.in_flight = []
+        self.workers = []
+        for partition in range(2):
+            worker = server.FaultTolerantServer(
+                id=0,
+                host="localhost",
+                port=50000,
+                durability="commit",
+                partition=partition,
+                num_partitions=2,
+            )
+            worker.open_database()
+            worker.internal_communicator = DummyInternalCommunicator()
+            self.workers.append(worker)
+        for partition, worker in enumerate(self.workers):
+            other = 1 - partition
+            worker.router.links[other] = (
+                lambda payload, other=other, partition=partition: self.in_flight.append(
+                    (other, partition, payload)
+                )
+            )
+
+        # A user owned by each partition.
+        self.users = [
+            next(
+                f"user{i}"
+                for i in range(100)
+                if partitioning.partition_of(f"user{i}", 2) == partition
+            )
+            for partition in range(2)
+        ]
+
+    def pump(self):
+        while self.in_flight:
+            target, source, payload = self.in_flight.pop(0)
+            frames = framing.FrameDecoder()
+            frames.feed(payload)
+            for frame in frames:
+                self.workers[target].handle_link_frame(source, frame)
+
+    def request(self, worker, sock, data, command, command_data):
+        request = {"version": 0, "command": command, "data": command_data}
+        data.frames.feed(framing.encode_frame(json.dumps(request).encode()))
+        worker.handle_frames(sock, data)
+        self.pump()
+
+    def replies(self, sock):
+        frames = framing.FrameDecoder()
+        frames.feed(b"".join(sock.sent_data))
+        sock.sent_data.clear()
+        return [json.loads(frame) for frame in frames]
+
+    def test_link_frame_round_trip(self):
+        frame = partitioning.encode_link_frame(
+            partitioning.REQUEST, 7, b"body", ("::1", 5000)
+        )
+        frames = framing.FrameDecoder()
+        frames.feed(frame)
+        self.assertEqual(
+            partitioning.decode_link_frame(frames.next_frame()),
+            (partitioning.REQUEST, 7, ("::1", 5000), b"body"),
+        )
+
+    def test_requests_are_handled_by_the_owning_partition(self):
+        front = self.workers[0]
+        sock, data = DummySocket(), create_dummy_data()
+        for username in self.users:
+            self.request(
+                front, sock, data, "create", {"username": username, "password": "p"}
+            )
+        for partition, username in enumerate(self.users):
+            self.assertEqual(
+                list(self.workers[partition].database["users"]), [username]
+            )
+            self.assertIn(username, self.workers[partition].sessions)
+        self.assertEqual(
+            [reply["data"]["username"] for reply in self.replies(sock)], self.users
+        )
+
+        self.request(front, sock, data, "search", {"search": "user*"})
+        self.assertEqual(self.replies(sock)[0]["data"]["user_list"], self.users)
+
+    def test_cross_partition_send(self):
+        front = self.workers[1]
+        sender, receiver = self.users
+        self.workers[0].database["users"][sender] = {"password": "p"}
+        self.workers[1].database["users"][receiver] = {"password": "p"}
+        self.workers[0].database["messages"].add(
+            message_store.Message(1, receiver, sender, "unread"), "undelivered"
+        )
+        sock, data = DummySocket(), create_dummy_data()
+
+        self.request(
+            front,
+            sock,
+            data,
+            "send_msg",
+            {"sender": sender, "recipient": receiver, "message": "hi"},
+        )
+        # The message is stored by the receiver's partition, and the reply counts the
+        # sender's undelivered messages, kept by the sender's partition.
+        self.assertEqual(self.workers[1].get_new_messages(receiver), 1)
+        self.assertEqual(self.replies(sock)[0]["data"], {"undeliv_messages": 1})
+
+        # Deleting the sender removes the messages they sent on every partition.
+        self.request(front, sock, data, "delete_acct", {"username": sender})
+        self.assertEqual(self.replies(sock)[0]["command"], "logout")
+        self.assertEqual(self.workers[1].get_new_messages(receiver), 0)
+
+    def test_push_reaches_the_worker_the_receiver_is_connected_to(self):
+        sender, receiver = self.users
+        for partition, username in enumerate(self.users):
+            self.workers[partition].database["users"][username] = {"password": "p"}
+        # The receiver is owned by worker 1, but connected to worker 0.
+        receiver_sock = DummySocket()
+        receiver_data = create_dummy_data(addr=("127.0.0.1", 54321))
+        self.workers[0].clients["127.0.0.1:54321"] = (receiver_sock, receiver_data)
+        self.request(
+            self.workers[0],
+            receiver_sock,
+            receiver_data,
+            "login",
+            {"username": receiver, "password": "p"},
+        )
+        self.assertEqual(self.replies(receiver_sock)[0]["command"], "login")
+
+        sock, data = DummySocket(), create_dummy_data()
+        self.request(
+            self.workers[1],
+            sock,
+            data,
+            "send_msg",
+            {"sender": sender, "recipient": receiver, "message": "hi"},
+        )
+        self.assertEqual(self.replies(sock)[0]["command"], "refresh_home")
+        self.assertEqual(
+            self.replies(receiver_sock),
+            [
+                {
+                    "version": 0,
+                    "command": "new_message",
+                    "data": {"id": 1, "sender": sender, "message": "hi"},
+                }
+            ],
+        )
+
+    def test_wait_is_parked_by_the_owning_partition(self):
+        sender, receiver = self.users
+        for partition, username in enumerate(self.users):
+            self.workers[partition].database["users"][username] = {"password": "p"}
+        sock, data = DummySocket(), create_dummy_data()
+        self.request(
+            self.workers[0], sock, data, "wait_for_messages", {"username": receiver}
+        )
+        self.assertIn(receiver, self.workers[1].waiters)
+        self.assertTrue(data.routing)
+
+        self.request(
+            self.workers[0],
+            DummySocket(),
+            create_dummy_data(),
+            "send_msg",
+            {"sender": sender, "recipient": receiver, "message": "hi"},
+        )
+        reply = self.replies(sock)[0]
+        self.assertEqual(reply["command"], "new_messages")
+        self.assertEqual(reply["data"]["undeliv_messages"], 1)
+        self.assertFalse(data.routing)
+
+    def test_pipelined_replies_keep_their_order(self):
+        front = self.workers[0]
+        for partition, username in enumerate(self.users):
+            self.workers[partition].database["users"][username] = {"password": "p"}
+        sock, data = DummySocket(), create_dummy_data()
+        requests = [
+            {"version": 0, "command": "refresh_home", "data": {"username": username}}
+            for username in (self.users[1], self.users[0], self.users[1])
+        ] + [{"version": 0, "command": "logout", "data": {"username": "missing"}}]
+        data.frames.feed(
+            b"".join(
+                framing.encode_frame(json.dumps(request).encode())
+                for request in requests
+            )
+        )
+
+        front.handle_frames(sock, data)
+        # The first request waits for the other partition, and holds back the others.
+        self.assertEqual(sock.sent_data, [])
+        self.pump()
+        self.assertEqual(
+            [reply["command"] for reply in self.replies(sock)],
+            ["refresh_home", "refresh_home", "refresh_home", "error"],
+        )
+
+    def test_closed_connection_ends_sessions_on_every_partition(self):
+        front = self.workers[0]
+        self.workers[1].sessions[self.users[1]] = "127.0.0.1:12345"
+        front.end_session(create_dummy_data())
+        self.pump()
+        self.assertEqual(self.workers[1].sessions, {})
+
+
+# --- Unit Tests for the Message Store (message_store.py) ---
+class TestMessageStore(unittest.TestCase):
+    def setUp(self):
+        self.store = message_store.MessageStore(
+            undelivered=[
+                {"id": 1, "sender": "a", "receiver": "b", "message": "1"},
+                {"id": 2, "sender": "b", "receiver": "a", "message": "2"},
+                {"id": 3, "sender": "c", "receiver": "b", "message": "3"},
+            ],
+            delivered=[{"id": 4, "sender": "a", "receiver": "c", "message": "4"}],
+        )
+
+    def test_count_is_per_receiver(self):
+        self.assertEqual(self.store.count("b"), 2)
+        self.assertEqual(self.store.count("a"), 1)
+        self.assertEqual(self.store.count("nobody"), 0)
+        self.assertEqual(self.store.count("c", "delivered"), 1)
+
+    def test_deliver_moves_oldest_messages(self):
+        moved = self.store.deliver("b", 1)
+        self.assertEqual([msg.id for msg in moved], [1])
+        self.assertEqual(self.store.count("b"), 1)
+        self.assertEqual([msg.id for msg in self.store.peek("b", 10)], [1])
+        self.assertEqual([msg["id"] for msg in self.store["undelivered"]], [2, 3])
+        self.assertEqual([msg["id"] for msg in self.store["delivered"]], [4, 1])
+
+    def test_delete_only_touches_own_mailbox(self):
+        self.store.deliver("b", 2)
+        # Message 4 belongs to "c" and message 2 is still undelivered.
+        deleted = self.store.delete("b", [1, 2, 4, 99])
+        self.assertEqual(deleted, [1])
+        self.assertIsNone(self.store.locate(1))
+        self.assertEqual(self.store.locate(3), ("delivered", "b"))
+        self.assertEqual(self.store.locate(4), ("delivered", "c"))
+        self.assertEqual([msg.id for msg in self.store.peek("b", 10)], [3])
+
+    def test_setitem_rebuilds_mailboxes(self):
+        self.store["undelivered"] = [
+            {"id": 5, "sender": "a", "receiver": "c", "message": "5"}
+        ]
+        self.assertEqual(self.store.count("b"), 0)
+        self.assertEqual(self.store.count("c"), 1)
+
+    def test_remove_user(self):
+        self.store.remove_user("a")
+        self.assertEqual([msg["id"] for msg in self.store["undelivered"]], [3])
+        self.assertEqual(self.store["delivered"], [])
+        self.assertEqual(self.store.count("a"), 0)
+
+    def test_remove_user_cleans_up_the_sender_index(self):
+        # Mailboxes of "d" and "f" are loaded from a snapshot and not decoded yet.
+        snapshot = message_store.MessageStore(
+            delivered=[
+                {"id": 10, "sender": "a", "receiver": "d", "message": "10"},
+                {"id": 11, "sender": "x", "receiver": "d", "message": "11"},
+                {"id": 12, "sender": "x", "receiver": "f", "message": "12"},
+            ]
+        ).snapshot()
+        for mailbox in snapshot["mailboxes"]:
+            self.store.add_encoded_mailbox(*mailbox)
+        self.store.add(message_store.Message(13, "a", "e", "13"), "delivered")
+        self.store.add(message_store.Message(14, "x", "e", "14"), "delivered")
+
+        self.store.remove_user("a")
+
+        # Neither "a" nor "b", whose only message was to "a", are left in the sender
+        # index, while the messages of other senders still are.
+        self.assertEqual(self.store._sent, {"c": {3}, "x": {11, 14}})
+        # The mailbox of "f" holds no message from "a", so it was not decoded.
+        self.assertIn("f", self.store._encoded["delivered"])
+
+        # Every message "a" sent, to any receiver, or received is gone.
+        for msg_id in (1, 2, 4, 10, 13):
+            self.assertIsNone(self.store.locate(msg_id))
+        self.assertEqual(self.store.count("b"), 1)
+        self.assertEqual(self.store.count("c", "delivered"), 0)
+        self.assertEqual([msg.id for msg in self.store.peek("d", 10)], [11])
+        self.assertEqual([msg.id for msg in self.store.peek("e", 10)], [14])
+        self.assertEqual(self.store.count("a"), 0)
+        self.assertEqual([msg.id for msg in self.store.peek("f", 10)], [12])
+        # Decoding it once needed indexes its messages by sender.
+        self.assertEqual(self.store._sent["x"], {11, 12, 14})
+
+    def test_records_are_compact(self):
+        msg = self.store.peek("b", 1, "undelivered")[0]
+        self.assertFalse(hasattr(msg, "__dict__"))
+        self.assertEqual(msg.to_dict(), self.store["undelivered"][0])
+        # Usernames decoded separately end up as the same string object.
+        first = message_store.Message(5, "".join(["us", "er"]), "b", "5")
+        second = message_store.Message(6, "".join(["use", "r"]), "b", "6")
+        self.assertIs(first.sender, second.sender)
+
+    def test_round_trip_through_dict(self):
+        copy = message_store.MessageStore.from_dict(self.store.to_dict())
+        self.assertEqual(copy.to_dict(), self.store.to_dict())
+        self.assertEqual(copy.count("b"), 2)
+
+
+# --- Unit Tests for the SQLite Storage Engine (sqlite_store.py) ---
+class TestSQLiteStore(unittest.TestCase):
+    def setUp(self):
+        self.test_vm_id = "test_sqlite"
+        self.remove_files()
+        self.users, self.messages, self.settings = sqlite_store.load_database(
+            self.test_vm_id
+        )
+
+    def tearDown(self):
+        self.users.db.connection.close()
+        self.remove_files()
+
+    def remove_files(self):
+        import os
+
+        path = sqlite_store.sqlite_database_path(self.test_vm_id)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    def test_users_and_settings_mappings(self):
+        self.users["user1"] = {"password": "pass"}
+        self.assertIn("user1", self.users)
+        self.assertEqual(self.users["user1"], {"password": "pass"})
+        self.assertEqual(list(self.users), ["user1"])
+        del self.users["user1"]
+        self.assertNotIn("user1", self.users)
+
+        self.assertEqual(self.settings["counter"], 0)
+        self.settings["counter"] += 1
+        self.assertEqual(self.settings["counter"], 1)
+
+    def test_message_store_interface(self):
+        for msg_id, receiver in ((1, "b"), (2, "a"), (3, "b")):
+            self.messages.add(
+                message_store.Message(msg_id, "c", receiver, "hi"), "undelivered"
+            )
+        self.assertEqual(self.messages.count("b"), 2)
+        self.assertEqual([msg.id for msg in self.messages.deliver("b", 1)], [1])
+        self.assertEqual(self.messages.locate(1), ("delivered", "b"))
+        self.assertEqual(self.messages.delete("b", [1, 2, 3]), [1])
+        self.assertFalse(self.messages.has_messages("delivered"))
+        self.messages.remove_user("c")
+        self.assertEqual(self.messages.to_dict(), {"undelivered": [], "delivered": []})
+
+    def test_users_hold_no_login_state(self):
+        self.users["user1"] = {"password": "pass", "logged_in": True, "addr": "a:1"}
+        users, _, _ = sqlite_store.load_database(self.test_vm_id)
+        self.assertEqual(users["user1"], {"password": "pass"})
+
+    def test_server_handlers_use_sqlite(self):
+        with patch(
+            "sqlite_store.load_database",
+            return_value=(
+                self.users,
+                self.messages,
+                self.settings,
+            ),
+        ):
+            server_instance = server.FaultTolerantServer(
+                id=0,
+                host="localhost",
+                port=50000,
+                storage="sqlite",
+                durability="commit",
+            )
+            server_instance.open_database()
+        server_instance.internal_communicator = DummyInternalCommunicator()
+        self.users["user1"] = {"password": "pass1"}
+
+        command_obj = {
+            "version": 0,
+            "command": "send_msg",
+            "data": {"sender": "user1", "recipient": "user1", "message": "Hello"},
+        }
+        dummy_data = create_dummy_data(outb=json.dumps(command_obj).encode("utf-8"))
+        server_instance.deliver_message(DummySocket(), dummy_data, command_obj["data"])
+        self.assertEqual(self.messages.count("user1"), 1)
+        self.assertEqual(self.settings["counter"], 1)
+
+        command_obj = {
+            "version": 0,
+            "command": "login",
+            "data": {"username": "user1", "password": "pass1"},
+        }
+        dummy_data = create_dummy_data(outb=json.dumps(command_obj).encode("utf-8"))
+        dummy_sock = DummySocket()
+        server_instance.login(dummy_sock, dummy_data, command_obj["data"])
+        response = json.loads(dummy_sock.sent_data[0].decode("utf-8"))
+        self.assertEqual(response["data"]["undeliv_messages"], 1)
+        self.assertIn("user1", server_instance.sessions)
+        self.assertEqual(self.users["user1"], {"password": "pass1"})
+
+    def test_handlers_run_in_a_single_transaction(self):
+        with patch(
+            "sqlite_store.load_database",
+            return_value=(self.users, self.messages, self.settings),
+        ):
+            server_instance = server.FaultTolerantServer(
+                id=0, host="localhost", port=50000, storage="sqlite"
+            )
+            server_instance.open_database()
+        server_instance.internal_communicator = DummyInternalCommunicator()
+        self.users["user1"] = {"password": "pass1"}
+
+        request = {
+            "version": 0,
+            "command": "send_msg",
+            "data": {"sender": "user1", "recipient": "user1", "message": "Hello"},
+        }
+        frame = json.dumps(request).encode("utf-8")
+        # The message counter is updated before the message is stored.
+        with patch.object(self.messages, "add", side_effect=RuntimeError("full")):
+            with self.assertRaises(RuntimeError):
+                server_instance.handle_frame(DummySocket(), create_dummy_data(), frame)
+        self.assertEqual(self.settings["counter"], 0)
+
+        server_instance.handle_frame(DummySocket(), create_dummy_data(), frame)
+        self.assertEqual(self.settings["counter"], 1)
+        self.assertEqual(self.messages.count("user1"), 1)
+
+    def test_durability_sets_synchronous(self):
+        for durability, synchronous in (("commit", 2), ("batch", 2), ("async", 1)):
+            users, _, _ = sqlite_store.load_database(self.test_vm_id, durability)
+            (value,) = users.db.execute("PRAGMA synchronous").fetchone()
+            self.assertEqual(value, synchronous)
+            users.db.connection.close()
+
+
+# --- Unit Tests for the Timer Wheel (timer_wheel.py) ---
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.fired = []
+        # Two wheels of four one-second slots cover 16 seconds.
+        self.wheel = timer_wheel.TimerWheel(
+            tick=1, slots=4, levels=2, clock=lambda: self.now
+        )
+
+    def schedule(self, delay):
+        return self.wheel.schedule(delay, self.fired.append, delay)
+
+    def run_until(self, now):
+        self.now = now
+        return self.wheel.run_due()
+
+    def test_timers_fire_in_order_across_wheels(self):
+        for delay in (40, 9, 2, 2.5, 15):
+            self.schedule(delay)
+
+        self.assertEqual(self.run_until(1), 0)
+        self.assertEqual(self.run_until(3), 2)
+        self.assertEqual(self.run_until(39), 2)
+        self.assertEqual(self.fired, [2, 2.5, 9, 15])
+        self.assertEqual(len(self.wheel), 1)
+
+        # Timers beyond the last wheel are filed again until they are due.
+        self.assertEqual(self.run_until(40), 1)
+        self.assertEqual(self.fired[-1], 40)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel(self):
+        timer = self.schedule(3)
+        self.schedule(5)
+        self.wheel.cancel(timer)
+        self.wheel.cancel(timer)
+        self.assertEqual(len(self.wheel), 1)
+
+        self.run_until(10)
+        self.assertEqual(self.fired, [5])
+
+    def test_timeout(self):
+        self.assertIsNone(self.wheel.timeout())
+
+        self.schedule(2)
+        self.assertEqual(self.wheel.timeout(), 2)
+
+        # Far timers only wake the loop up when their wheel is cascaded.
+        self.wheel.clear()
+        self.schedule(10)
+        self.assertEqual(self.wheel.timeout(), 4)
+
+
+# --- Unit Tests for the Snapshot Format (snapshot_format.py) ---
+class TestSnapshotFormat(unittest.TestCase):
+    def setUp(self):
+        entries = [(3, "bob", "hi"), (4, "carol", "héllo ✓"), (7, "bob", (120, 9))]
+        self.tables = {
+            "users": {"alice": {"password": "x"}, "bob": {"password": "y"}},
+            "settings": {"counter": 8, "host": "127.0.0.1"},
+            "sessions": {"alice": "127.0.0.1:50000"},
+            "messages": {
+                "mailboxes": [
+                    message_store.encode_mailbox("undelivered", "alice", entries, 31)
+                ],
+                "expirations": [[4, "alice", 1234.5]],
+                "bodies": {"generation": 2},
+            },
+        }
+
+    def test_round_trip(self):
+        tables = snapshot_format.loads(snapshot_format.dumps(self.tables))
+        self.assertEqual(tables["users"], self.tables["users"])
+        self.assertEqual(tables["settings"], self.tables["settings"])
+        self.assertEqual(tables["sessions"], self.tables["sessions"])
+        self.assertEqual(tables["messages"]["expirations"], [[4, "alice", 1234.5]])
+        self.assertEqual(tables["messages"]["bodies"], {"generation": 2})
+
+        box, receiver, count, senders, size, min_id, data = tables["messages"][
+            "mailboxes"
+        ][0]
+        self.assertEqual(
+            (box, receiver, count, size, min_id), ("undelivered", "alice", 3, 31, 3)
+        )
+        self.assertEqual(
+            message_store.decode_mailbox(data, senders),
+            [(3, "bob", "hi"), (4, "carol", "héllo ✓"), (7, "bob", [120, 9])],
+        )
+
+    def test_strings_are_interned(self):
+        snapshot = snapshot_format.dumps(self.tables)
+        self.assertEqual(snapshot.count(b"alice"), 1)
+        self.assertEqual(snapshot.count(b"bob"), 1)
+
+    def test_rejects_truncated_and_foreign_snapshots(self):
+        snapshot = snapshot_format.dumps(self.tables)
+        with self.assertRaises(ValueError):
+            snapshot_format.loads(snapshot[:-1])
+        with self.assertRaises(ValueError):
+            snapshot_format.loads(b"{" + snapshot[1:])
+        with self.assertRaises(ValueError):
+            snapshot_format.loads(snapshot[:8] + b"\x09" + snapshot[9:])
+
+
+# --- Unit Tests for Framing (framing.py) ---
+class TestFrameDecoder(unittest.TestCase):
+    def setUp(self):
+        self.decoder = framing.FrameDecoder(max_frame_bytes=64)
+
+    def test_version_0_frames_split_across_reads(self):
+        for piece in (b'{"a": ', b'1}\0{"b"', b": 2}\0{"):
+            self.decoder.feed(piece)
+        self.assertEqual(list(self.decoder), [b'{"a": 1}', b'{"b": 2}'])
+        self.assertEqual(len(self.decoder), 1)
+        self.assertFalse(self.decoder.length_prefixed)
+
+    def test_length_prefixed_frames_mixed_with_version_0(self):
+        stream = framing.encode_frame(b"a\0b") + b"{}\0" + framing.encode_frame(b"")
+        # Frames are only returned once all of their bytes have arrived.
+        for i in range(len(stream) - 1):
+            self.decoder.feed(stream[i : i + 1])
+        self.assertEqual(list(self.decoder), [b"a\0b", b"{}"])
+        self.decoder.feed(stream[-1:])
+        self.assertEqual(self.decoder.next_frame(), b"")
+        self.assertTrue(self.decoder.length_prefixed)
+
+    def test_consumed_bytes_are_dropped(self):
+        for _ in range(100):
+            self.decoder.feed(b"{}\0{")
+            self.assertEqual(self.decoder.next_frame(), b"{}")
+            self.decoder.feed(b"}\0")
+            self.assertEqual(self.decoder.next_frame(), b"{}")
+        self.assertIsNone(self.decoder.next_frame())
+        self.assertLess(len(self.decoder.buffer), 10)
+
+    def test_rejects_large_frames(self):
+        self.decoder.feed(framing.FRAME_HEADER.pack(framing.LENGTH_PREFIXED, 65))
+        with self.assertRaises(framing.FrameError):
+            self.decoder.next_frame()
+
+        decoder = framing.FrameDecoder(max_frame_bytes=64)
+        decoder.feed(b"x" * 65)
+        with self.assertRaises(framing.FrameError):
+            decoder.next_frame()
+
+
+# --- Unit Tests for the Command Table (command_table.py) ---
+class TestCommandTable(unittest.TestCase):
+    def test_handle_counts_calls_per_command(self):
+        table = command_table.CommandTable()
+        calls = []
+        table.register("a", lambda *args: calls.append(args))
+        table.register("b", Mock(side_effect=ValueError))
+
+        self.assertTrue(table.handle("a", 1, 2))
+        self.assertFalse(table.handle("c"))
+        self.assertFalse(table.handle(["a"]))
+        # Calls that raise are counted too.
+        with self.assertRaises(ValueError):
+            table.handle("b")
+        self.assertEqual(calls, [(1, 2)])
+        self.assertEqual(
+            {command: stats["calls"] for command, stats in table.stats().items()},
+            {"a": 1, "b": 1},
+        )
+
+    def test_latency_histogram_buckets(self):
+        histogram = command_table.LatencyHistogram()
+        for seconds in (0, 3e-6, 3e-6, 100e-6, 1000.0):
+            histogram.record(seconds)
+        self.assertEqual(
+            histogram.to_dict()["histogram"],
+            {"1": 1, "4": 2, "128": 1, str(2 ** (command_table.NUM_BUCKETS - 1)): 1},
+        )
+        self.assertEqual(histogram.percentile(0.5), 4)
+        self.assertEqual(histogram.percentile(0.8), 128)
+        self.assertEqual(command_table.LatencyHistogram().percentile(0.5), 0)
+
+
+# --- Unit Tests for the Client Protocol (protocol.py) ---
+class TestProtocol(unittest.TestCase):
+    def test_requests_round_trip(self):
+        requests = {
+            "create": {"username": "alice", "password": "p" * 64},
+            "send_msg": {
+                "sender": "alice",
+                "recipient": "bob",
+                "message": "h\u00e9llo\0",
+                "ttl": None,
+            },
+            "get_delivered": {"username": "bob", "num_messages": -1},
+            "delete_msg": {"current_user": "bob", "delete_ids": [1, 2**32 - 1]},
+            "check_connection": {},
+        }
+        for command, data in requests.items():
+            payload = protocol.encode_request(command, data, version=1)
+            self.assertTrue(protocol.is_binary(payload))
+            self.assertEqual(
+                protocol.decode_request(payload),
+                {"version": 1, "command": command, "data": data},
+            )
+        # Comma-separated IDs are sent as integers, skipping invalid ones.
+        payload = protocol.encode_request(
+            "delete_msg", {"current_user": "bob", "delete_ids": "3, x,4"}, version=1
+        )
+        self.assertEqual(protocol.decode_request(payload)["data"]["delete_ids"], [3, 4])
+
+    def test_replies_round_trip_and_fall_back_to_json(self):
+        messages = [{"id": 7, "sender": "alice", "message": "hi"}]
+        payload = protocol.encode_reply("messages", {"messages": messages}, version=1)
+        self.assertLess(
+            len(payload),
+            len(protocol.encode_reply("messages", {"messages": messages})),
+        )
+        self.assertEqual(protocol.decode_reply(payload)["data"], {"messages": messages})
+        record = message_store.Message(7, "alice", "bob", "hi")
+        self.assertEqual(protocol.encode_messages_reply([record]), payload)
+
+        # Commands without an opcode, and version 0, are encoded as JSON.
+        for command, version in (("hello", 1), ("messages", 0)):
+            payload = protocol.encode_reply(command, {"messages": []}, version)
+            self.assertFalse(protocol.is_binary(payload))
+            self.assertEqual(protocol.decode_reply(payload)["command"], command)
+
+    def test_lists_round_trip_column_by_column(self):
+        users = ["alice", "b\u00f6b", "", "\U0001f600 carol"]
+        messages = [
+            {"id": i, "sender": user, "message": f"h\u00e9llo {user}"}
+            for i, user in enumerate(users)
+        ]
+        for command, data in (
+            ("user_list", {"user_list": users}),
+            ("messages", {"messages": messages}),
+            ("messages", {"messages": []}),
+        ):
+            payload = protocol.encode_reply(command, data, version=1)
+            self.assertEqual(protocol.decode_reply(payload)["data"], data)
+
+        # Lengths that do not add up to the strings sent are rejected.
+        payload = bytearray(
+            protocol.encode_reply("user_list", {"user_list": users}, version=1)
+        )
+        payload[7] += 1
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.decode_reply(bytes(payload))
+
+    def test_rejects_malformed_payloads(self):
+        payload = protocol.encode_request(
+            "login", {"username": "a", "password": "b"}, 1
+        )
+        for malformed in (payload[:-1], payload + b"x", b"\x01\xff", b"\x01"):
+            with self.assertRaises(protocol.ProtocolError):
+                protocol.decode_request(malformed)
+
+    def test_connection_sets_pushed_messages_aside(self):
+        push = {"id": 1, "sender": "alice", "message": "hi"}
+        sock = Mock()
+        sock.recv.return_value = framing.encode_frame(
+            protocol.encode_reply("new_message", push, version=1)
+        ) + framing.encode_frame(
+            protocol.encode_reply("refresh_home", {"undeliv_messages": 2}, version=1)
+        )
+        connection = protocol.Connection(sock)
+        connection.version = 1
+
+        self.assertEqual(connection.recv_reply()["command"], "refresh_home")
+        self.assertEqual(connection.pushed, [push])
+
+    def test_connection_falls_back_to_version_0(self):
+        sock = Mock()
+        sock.recv.return_value = json.dumps(
+            {"version": 0, "command": "error", "data": {"error": "Invalid command"}}
+        ).encode("utf-8")
+        connection = protocol.Connection(sock)
+        self.assertEqual(connection.negotiate(), 0)
+
+        connection.send_request({"version": 0, "command": "search", "data": {}})
+        self.assertTrue(sock.sendall.call_args.args[0].endswith(b"\0"))
+
+
+# --- Unit Tests for the Group Committer (group_commit.py) ---
+class TestGroupCommitter(unittest.TestCase):
+    def setUp(self):
+        patcher = patch("database_wrapper.append_log", return_value=None)
+        self.addCleanup(patcher.stop)
+        self.mock_append_log = patcher.start()
+
+    def test_commit_durability_writes_every_commit(self):
+        committer = group_commit.GroupCommitter("vm", durability="commit")
+        committer.commit([{"op": "a"}])
+        committer.commit([{"op": "b"}])
+        self.assertEqual(self.mock_append_log.call_count, 2)
+        self.assertTrue(self.mock_append_log.call_args.kwargs["fsync"])
+        self.assertFalse(committer.hold_reply(DummySocket(), b"reply"))
+        self.assertIsNone(committer.timeout())
+
+    def test_batch_durability_holds_replies_until_flush(self):
+        committer = group_commit.GroupCommitter("vm", durability="batch")
+        dummy_sock = DummySocket()
+        committer.commit([{"op": "a"}])
+        self.assertTrue(committer.hold_reply(dummy_sock, b"reply"))
+        committer.commit([{"op": "b"}])
+        self.mock_append_log.assert_not_called()
+        self.assertEqual(dummy_sock.sent_data, [])
+
+        committer.end_iteration()
+        self.mock_append_log.assert_called_once_with(
+            "vm", [{"op": "a"}, {"op": "b"}], fsync=True
+        )
+        self.assertEqual(dummy_sock.sent_data, [b"reply"])
+        self.assertIsNone(committer.timeout())
+
+    def test_batch_durability_sends_held_replies_together(self):
+        committer = group_commit.GroupCommitter("vm", durability="batch")
+        first_sock, second_sock = DummySocket(), DummySocket()
+        committer.hold_reply(first_sock, b"a")
+        committer.hold_reply(second_sock, b"b")
+        committer.hold_reply(first_sock, b"c")
+        committer.flush()
+        self.assertEqual(first_sock.sent_data, [b"ac"])
+        self.assertEqual(second_sock.sent_data, [b"b"])
+
+    def test_window_delays_flush(self):
+        committer = group_commit.GroupCommitter("vm", durability="async", window=60)
+        committer.commit([{"op": "a"}])
+        self.assertFalse(committer.hold_reply(DummySocket(), b"reply"))
+        committer.end_iteration()
+        self.mock_append_log.assert_not_called()
+        self.assertGreater(committer.timeout(), 0)
+        committer.flush()
+        self.mock_append_log.assert_called_once()
+
 
 # --- Unit Tests for the Database Wrapper (database_wrapper.py) ---
 class TestDatabaseWrapper(unittest.TestCase):
@@ -232,6 +1856,9 @@ class TestDatabaseWrapper(unittest.TestCase):
         database_wrapper.reset_database(self.test_vm_id)
 
     def tearDown(self):
+        self.remove_database(self.test_vm_id)
+
+    def remove_database(self, vm_id):
         # Clean up files created during the tests.
         import os
 
@@ -240,9 +1867,12 @@ class TestDatabaseWrapper(unittest.TestCase):
             database_wrapper.messages_database_path,
             database_wrapper.settings_database_path,
         ]:
-            path = func(self.test_vm_id)
+            path = func(vm_id)
             if os.path.exists(path):
                 os.remove(path)
+        database_wrapper.truncate_log(vm_id)
+        history_store.remove_old_generations(vm_id)
+        body_store.remove_old_generations(vm_id)
         if os.path.exists("database") and not os.listdir("database"):
             os.rmdir("database")
 
@@ -253,9 +1883,7 @@ class TestDatabaseWrapper(unittest.TestCase):
         self.assertEqual(settings["counter"], 0)
 
     def test_save_and_load_database(self):
-        dummy_users = {
-            "user1": {"password": "pass", "logged_in": True, "addr": "127.0.0.1:12345"}
-        }
+        dummy_users = {"user1": {"password": "pass"}}
         dummy_messages = {
             "undelivered": [
                 {"id": 1, "sender": "user2", "receiver": "user1", "message": "Hi"}
@@ -276,9 +1904,591 @@ class TestDatabaseWrapper(unittest.TestCase):
             self.test_vm_id
         )
         self.assertEqual(loaded_users, dummy_users)
-        self.assertEqual(loaded_messages, dummy_messages)
+        self.assertEqual(loaded_messages.to_dict(), dummy_messages)
         self.assertEqual(loaded_settings, dummy_settings)
 
+    def test_server_started_with_spawn_loads_snapshot(self):
+        import multiprocessing
+        import socket
+
+        ports = []
+        for _ in range(2):
+            with socket.socket() as free:
+                free.bind(("localhost", 0))
+                ports.append(free.getsockname()[1])
+        server_instance = server.FaultTolerantServer(
+            id=self.test_vm_id,
+            host="localhost",
+            port=ports[0],
+            current_starting_port=ports[1],
+            internal_other_ports=[ports[1]],
+            internal_max_ports=[1],
+        )
+        # The server names its files after its port as well
+        self.addCleanup(self.remove_database, server_instance.id)
+        database_wrapper.save_database(
+            server_instance.id,
+            {"user1": {"password": "pass"}},
+            {"undelivered": [], "delivered": []},
+            {"counter": 0},
+        )
+        # Started the way macOS and Windows start processes, so the server is pickled
+        # and must load the snapshot in the process it runs in
+        server_instance._Popen = multiprocessing.get_context("spawn").Process._Popen
+        server_instance.start()
+        try:
+            for _ in range(100):
+                try:
+                    sock = socket.create_connection(("localhost", ports[0]))
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            else:
+                self.fail("the server did not start listening")
+            with sock:
+                connection = protocol.Connection(sock)
+                connection.send_request(
+                    {"version": 0, "command": "search", "data": {"search": "*"}}
+                )
+                reply = connection.recv_reply()
+        finally:
+            server_instance.terminate()
+            server_instance.join()
+        self.assertEqual(reply["data"]["user_list"], ["user1"])
+
+    def test_load_database_replays_log(self):
+        database_wrapper.append_log(
+            self.test_vm_id,
+            [
+                {
+                    "op": "put_user",
+                    "username": "user1",
+                    "user": {"password": "pass"},
+                },
+                {
+                    "op": "add_message",
+                    "box": "undelivered",
+                    "message": {
+                        "id": 1,
+                        "sender": "user1",
+                        "receiver": "user1",
+                        "message": "Hi",
+                    },
+                },
+                {
+                    "op": "add_message",
+                    "box": "undelivered",
+                    "message": {
+                        "id": 2,
+                        "sender": "user1",
+                        "receiver": "user1",
+                        "message": "Bye",
+                    },
+                },
+            ],
+        )
+        database_wrapper.append_log(
+            self.test_vm_id,
+            [
+                {"op": "deliver_messages", "ids": [1]},
+                {"op": "delete_messages", "receiver": "user1", "ids": [1]},
+            ],
+        )
+        users, messages, settings = database_wrapper.load_database(self.test_vm_id)
+        self.assertIn("user1", users)
+        self.assertEqual([msg["id"] for msg in messages["undelivered"]], [2])
+        self.assertEqual(messages["delivered"], [])
+        self.assertEqual(settings["counter"], 2)
+
+    def test_load_database_ignores_torn_log_record(self):
+        database_wrapper.append_log(
+            self.test_vm_id,
+            [
+                {
+                    "op": "put_user",
+                    "username": "user1",
+                    "user": {"password": "pass"},
+                }
+            ],
+        )
+        segment = database_wrapper.list_log_segments(self.test_vm_id)[-1]
+        with open(
+            database_wrapper.log_database_path(self.test_vm_id, segment), "a"
+        ) as f:
+            f.write('{"op": "put_us')
+        users, _, _ = database_wrapper.load_database(self.test_vm_id)
+        self.assertEqual(list(users), ["user1"])
+
+    def test_save_database_truncates_log(self):
+        database_wrapper.append_log(
+            self.test_vm_id, [{"op": "delete_user", "username": "user1"}]
+        )
+        database_wrapper.save_database(
+            self.test_vm_id, {}, {"undelivered": [], "delivered": []}, {"counter": 0}
+        )
+        self.assertEqual(database_wrapper.read_log(self.test_vm_id), [])
+
+    def test_save_database_syncs_before_replacing_and_removing(self):
+        import os
+
+        database_wrapper.append_log(
+            self.test_vm_id, [{"op": "delete_user", "username": "user1"}]
+        )
+        calls = []
+
+        def recorder(name, function):
+            def record(*args):
+                calls.append(name)
+                return function(*args)
+
+            return record
+
+        with patch("os.fsync", recorder("fsync", os.fsync)), patch(
+            "os.replace", recorder("replace", os.replace)
+        ), patch("os.remove", recorder("remove", os.remove)):
+            database_wrapper.save_database(
+                self.test_vm_id, {}, {"undelivered": [], "delivered": []}, {}
+            )
+
+        # Every table and the manifest are synced before they replace the old files,
+        # and the directory is synced before the covered log segment is removed.
+        replaced = [i for i, call in enumerate(calls) if call == "replace"]
+        self.assertEqual(len(replaced), 4)
+        for i in replaced:
+            self.assertEqual(calls[i - 1], "fsync")
+        self.assertEqual(calls[-2:], ["fsync", "remove"])
+
+    def test_snapshot_only_writes_dirty_tables(self):
+        import threading
+
+        database = {
+            "users": {"user1": {"password": "pass"}},
+            "messages": message_store.MessageStore(),
+            "settings": {"counter": 0},
+        }
+        # A login only changes the users table.
+        database_wrapper.append_log(
+            self.test_vm_id,
+            [
+                {
+                    "op": "put_user",
+                    "username": "user1",
+                    "user": database["users"]["user1"],
+                }
+            ],
+        )
+        self.assertEqual(database_wrapper.dirty_tables(self.test_vm_id), {"users"})
+
+        snapshotter = database_wrapper.Snapshotter(
+            self.test_vm_id, database, threading.Lock()
+        )
+        with patch(
+            "database_wrapper.write_table_atomically",
+            wraps=database_wrapper.write_table_atomically,
+        ) as mock_write:
+            self.assertTrue(snapshotter.snapshot())
+        written = [call.args[0] for call in mock_write.call_args_list]
+        self.assertEqual(
+            written, [database_wrapper.users_database_path(self.test_vm_id)]
+        )
+        self.assertEqual(database_wrapper.dirty_tables(self.test_vm_id), set())
+
+        users, _, _ = database_wrapper.load_database(self.test_vm_id)
+        self.assertIn("user1", users)
+
+    def test_snapshot_encodes_messages_without_the_lock(self):
+        store = message_store.MessageStore()
+        store.add(message_store.Message(1, "user2", "user1", "Hi"), "delivered")
+        database = {"users": {}, "messages": store, "settings": {"counter": 1}}
+        database_wrapper.append_log(
+            self.test_vm_id, [{"op": "deliver_messages", "ids": [1]}]
+        )
+        lock = threading.Lock()
+        snapshotter = database_wrapper.Snapshotter(self.test_vm_id, database, lock)
+
+        encode_snapshot = message_store.encode_snapshot
+        locked = []
+
+        def encode(messages):
+            locked.append(lock.locked())
+            return encode_snapshot(messages)
+
+        with patch("message_store.encode_snapshot", side_effect=encode):
+            self.assertTrue(snapshotter.snapshot())
+        self.assertEqual(locked, [False])
+
+        _, messages, _ = database_wrapper.load_database(self.test_vm_id)
+        self.assertEqual([msg.text for msg in messages.peek("user1", 10)], ["Hi"])
+
+    def test_failed_snapshot_keeps_tables_dirty(self):
+        database = {
+            "users": {"user1": {"password": "pass"}},
+            "messages": message_store.MessageStore(),
+            "settings": {"counter": 0},
+        }
+        database_wrapper.append_log(
+            self.test_vm_id,
+            [{"op": "put_user", "username": "user1", "user": {"password": "pass"}}],
+        )
+        snapshotter = database_wrapper.Snapshotter(
+            self.test_vm_id,
+            database,
+            threading.Lock(),
+            interval=0.01,
+            poll_interval=0.01,
+        )
+        with patch(
+            "database_wrapper.write_snapshot", side_effect=OSError("disk full")
+        ) as mock_write:
+            snapshotter.start()
+            # The thread keeps retrying after a failed write.
+            deadline = time.monotonic() + 5
+            while mock_write.call_count < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            snapshotter.stop()
+            snapshotter.join()
+        self.assertGreaterEqual(mock_write.call_count, 2)
+        self.assertEqual(database_wrapper.dirty_tables(self.test_vm_id), {"users"})
+
+        self.assertTrue(snapshotter.snapshot())
+        self.assertEqual(database_wrapper.dirty_tables(self.test_vm_id), set())
+        users, _, _ = database_wrapper.load_database(self.test_vm_id)
+        self.assertIn("user1", users)
+
+    def test_snapshot_compacts_log(self):
+        import threading
+
+        database = {
+            "users": {"user1": {"password": "pass"}},
+            "messages": message_store.MessageStore(),
+            "settings": {"counter": 0},
+        }
+        database_wrapper.append_log(
+            self.test_vm_id,
+            [
+                {
+                    "op": "put_user",
+                    "username": "user1",
+                    "user": database["users"]["user1"],
+                }
+            ],
+        )
+        snapshotter = database_wrapper.Snapshotter(
+            self.test_vm_id, database, threading.Lock()
+        )
+        self.assertTrue(snapshotter.snapshot())
+        self.assertEqual(database_wrapper.list_log_segments(self.test_vm_id), [])
+        # Nothing was logged since, so there is nothing to snapshot.
+        self.assertFalse(snapshotter.snapshot())
+
+        # Records logged after the snapshot are replayed on top of it.
+        database_wrapper.append_log(
+            self.test_vm_id, [{"op": "delete_user", "username": "user1"}]
+        )
+        users, _, _ = database_wrapper.load_database(self.test_vm_id)
+        self.assertEqual(users, {})
+        covered = database_wrapper.snapshot_log_segment(self.test_vm_id)
+        for segment in database_wrapper.list_log_segments(self.test_vm_id):
+            self.assertGreaterEqual(segment, covered)
+
+    def test_history_archives_old_delivered_messages(self):
+        history = history_store.HistoryStore(
+            self.test_vm_id, hot_messages=2, page_size=2
+        )
+        store = message_store.MessageStore(history=history)
+        for msg_id in range(1, 8):
+            sender = "a" if msg_id % 2 else "c"
+            store.add(
+                message_store.Message(msg_id, sender, "b", str(msg_id)), "delivered"
+            )
+
+        # The four oldest messages were archived in two pages.
+        self.assertIsNone(store.locate(1))
+        self.assertEqual(store.locate(5), ("delivered", "b"))
+        self.assertEqual(store.count("b", "delivered"), 7)
+        self.assertEqual([msg.id for msg in store.peek("b", 5)], [1, 2, 3, 4, 5])
+
+        self.assertEqual(store.delete("b", [2, 6, 9]), [2, 6])
+        store.remove_user("c")
+        self.assertEqual([msg.id for msg in store.peek("b", 10)], [1, 3, 5, 7])
+
+        # Snapshots only store the page index, and archived messages are read back.
+        database_wrapper.save_database(
+            self.test_vm_id, {}, store.snapshot(), {"counter": 7}
+        )
+        self.assertEqual([mailbox[2] for mailbox in store.snapshot()["mailboxes"]], [2])
+        _, loaded, _ = database_wrapper.load_database(self.test_vm_id)
+        self.assertEqual(loaded.to_dict(), store.to_dict())
+
+        # A snapshot without archived messages discards the history file.
+        self.assertEqual(
+            history_store.list_generations(self.test_vm_id), [history.generation]
+        )
+        database_wrapper.reset_database(self.test_vm_id)
+        self.assertEqual(history_store.list_generations(self.test_vm_id), [])
+
+    def test_history_delete_only_rewrites_pages_holding_the_ids(self):
+        history = history_store.HistoryStore(self.test_vm_id, page_size=2)
+        for first_id in range(1, 10, 2):
+            history.archive(
+                "b",
+                [
+                    message_store.Message(msg_id, "a", "b", str(msg_id))
+                    for msg_id in (first_id, first_id + 1)
+                ],
+            )
+        pages = list(history.pages["b"])
+
+        with patch.object(history, "_read_page", wraps=history._read_page) as mock_read:
+            self.assertEqual(history.delete("b", [4, 7, 20]), [4, 7])
+        self.assertEqual(
+            [call.args[1] for call in mock_read.call_args_list], [pages[1], pages[3]]
+        )
+        # Untouched pages keep their place in the file.
+        self.assertEqual(
+            [page.offset for page in history.pages["b"]][::2],
+            [page.offset for page in pages][::2],
+        )
+        self.assertEqual(
+            [msg.id for msg in history.peek("b", 10)], [1, 2, 3, 5, 6, 8, 9, 10]
+        )
+
+    def test_message_bodies_are_kept_in_body_segment(self):
+        body = 'h\u00e9llo "there"'
+        store = database_wrapper.build_message_store(
+            self.test_vm_id, {"undelivered": [], "delivered": []}, mmap_bodies=True
+        )
+        store.add(message_store.Message(1, "a", "b", body), "undelivered")
+
+        msg = store.peek("b", 1, "undelivered")[0]
+        self.assertNotIsInstance(msg.message, str)
+        self.assertEqual(json.loads(bytes(msg.encoded_message())), body)
+
+        # Snapshots refer to the bodies instead of holding them.
+        snapshot = store.snapshot()
+        self.assertNotIn(b"there", bytes(snapshot["mailboxes"][0][-1]))
+        database_wrapper.save_database(self.test_vm_id, {}, snapshot, {"counter": 1})
+        _, loaded, _ = database_wrapper.load_database(self.test_vm_id)
+        self.assertEqual(
+            loaded["undelivered"],
+            [{"id": 1, "sender": "a", "receiver": "b", "message": body}],
+        )
+
+    def test_snapshot_syncs_the_segments_it_refers_to(self):
+        import os
+
+        store = database_wrapper.build_message_store(
+            self.test_vm_id,
+            {"undelivered": [], "delivered": []},
+            hot_messages=1,
+            mmap_bodies=True,
+        )
+        # Enough messages for a page of them to be archived.
+        for msg_id in range(1, history_store.PAGE_SIZE + 2):
+            store.add(message_store.Message(msg_id, "a", "b", "hi"), "delivered")
+        snapshot = store.snapshot()
+        segments = [
+            body_store.bodies_database_path(
+                self.test_vm_id, snapshot["bodies"]["generation"]
+            ),
+            history_store.history_database_path(
+                self.test_vm_id, snapshot["history"]["generation"]
+            ),
+        ]
+
+        synced = []
+        replace = os.replace
+
+        def record_replace(source, destination):
+            synced.append(destination)
+            return replace(source, destination)
+
+        with patch(
+            "database_wrapper._sync_path", side_effect=lambda path: synced.append(path)
+        ), patch("os.replace", side_effect=record_replace):
+            database_wrapper.save_database(self.test_vm_id, {}, snapshot, {})
+
+        # Both segments are synced before the messages table refers to them.
+        messages_path = database_wrapper.messages_database_path(self.test_vm_id)
+        for path in segments:
+            self.assertLess(synced.index(path), synced.index(messages_path))
+
+    def test_new_compressed_store_trains_a_dictionary(self):
+        store = database_wrapper.build_message_store(
+            self.test_vm_id,
+            {"undelivered": [], "delivered": []},
+            mmap_bodies=True,
+            compress_bodies=True,
+        )
+        # There is nothing to train a dictionary from yet.
+        self.assertIsNone(store.bodies.dictionary)
+        generation = store.bodies.generation
+
+        bodies = [f"see you at the meeting tomorrow, room {i}" for i in range(10)]
+        with patch("body_store.DICTIONARY_SAMPLES", 8):
+            for msg_id, body in enumerate(bodies):
+                store.add(message_store.Message(msg_id, "a", "b", body), "delivered")
+                if msg_id < 7:
+                    self.assertIsNone(store.bodies.dictionary)
+
+        # The segment was primed with a dictionary once it had enough bodies, and the
+        # bodies appended before it were left in place.
+        self.assertIn(b" meeting", store.bodies.dictionary)
+        self.assertEqual(store.bodies.generation, generation)
+        self.assertEqual([msg.text for msg in store.peek("b", 10)], bodies)
+
+        database_wrapper.save_database(
+            self.test_vm_id, {}, store.snapshot(), {"counter": 10}
+        )
+        _, loaded, _ = database_wrapper.load_database(
+            self.test_vm_id, mmap_bodies=True, compress_bodies=True
+        )
+        self.assertEqual(loaded.bodies.dictionary, store.bodies.dictionary)
+        self.assertEqual([msg.text for msg in loaded.peek("b", 10)], bodies)
+
+    def test_training_a_dictionary_does_not_stall_add(self):
+        store = database_wrapper.build_message_store(
+            self.test_vm_id,
+            {"undelivered": [], "delivered": []},
+            mmap_bodies=True,
+            compress_bodies=True,
+        )
+        store.bodies.untrained = None
+        for msg_id in range(20000):
+            store.add(
+                message_store.Message(msg_id, "a", f"user{msg_id % 100}", "hello"),
+                "undelivered",
+            )
+        stored_bytes = store.bodies.stored_bytes()
+
+        store.bodies.untrained = [b'"hello again"']
+        with patch("body_store.DICTIONARY_SAMPLES", 2):
+            start = time.perf_counter()
+            store.add(
+                message_store.Message(20000, "a", "user0", "hello again"), "undelivered"
+            )
+            elapsed = time.perf_counter() - start
+
+        # Only the new body was written, instead of the store being compacted.
+        self.assertIsNotNone(store.bodies.dictionary)
+        self.assertEqual(
+            store.bodies.stored_bytes(), stored_bytes + len('"hello again"\n')
+        )
+        self.assertLess(elapsed, 0.05)
+
+    def test_message_bodies_are_compressed(self):
+        bodies = [f"see you at the meeting tomorrow, room {i}" for i in range(20)]
+        store = database_wrapper.build_message_store(
+            self.test_vm_id,
+            {
+                "undelivered": [
+                    {"id": i, "sender": "a", "receiver": "b", "message": body}
+                    for i, body in enumerate(bodies)
+                ],
+                "delivered": [],
+            },
+            mmap_bodies=True,
+            compress_bodies=True,
+        )
+        # The dictionary is trained from the plain messages the store is built from.
+        self.assertIn(b" meeting", store.bodies.dictionary)
+        store.add(message_store.Message(20, "a", "b", "x"), "undelivered")
+
+        # Bodies are stored compressed, unless that does not make them smaller, and
+        # only decompressed when they are read.
+        msgs = store.peek("b", 21, "undelivered")
+        self.assertLess(msgs[0].body_size, len(json.dumps(bodies[0])))
+        self.assertEqual(msgs[-1].body_size, len('"x"'))
+        self.assertEqual([msg.text for msg in msgs], bodies + ["x"])
+
+        database_wrapper.save_database(
+            self.test_vm_id, {}, store.snapshot(), {"counter": 20}
+        )
+        _, loaded, _ = database_wrapper.load_database(
+            self.test_vm_id, mmap_bodies=True, compress_bodies=True
+        )
+        self.assertEqual(loaded.bodies.dictionary, store.bodies.dictionary)
+        self.assertEqual(
+            [msg.text for msg in loaded.peek("b", 21, "undelivered")], bodies + ["x"]
+        )
+
+        # Compaction retrains the dictionary for the new generation.
+        loaded.compact()
+        self.assertEqual(loaded.bodies.generation, store.bodies.generation + 1)
+        self.assertIsNotNone(loaded.bodies.dictionary)
+        self.assertEqual(
+            [msg.text for msg in loaded.peek("b", 21, "undelivered")], bodies + ["x"]
+        )
+
+    def test_load_decodes_mailboxes_on_demand(self):
+        store = message_store.MessageStore()
+        for msg_id, receiver in ((1, "a"), (2, "b"), (3, "a")):
+            store.add(message_store.Message(msg_id, "c", receiver, "hi"), "undelivered")
+        database_wrapper.save_database(
+            self.test_vm_id, {}, store.snapshot(), {"counter": 3}
+        )
+
+        _, loaded, _ = database_wrapper.load_database(self.test_vm_id)
+        self.assertEqual(
+            set(database_wrapper.load_timings[self.test_vm_id]),
+            {"users", "messages", "settings", "log"},
+        )
+        self.assertEqual(loaded.size("undelivered"), 3)
+        self.assertEqual(loaded.count("a"), 2)
+        self.assertEqual([msg.id for msg in loaded.deliver("a", 1)], [1])
+
+        # Mailboxes that were never used are written back as they were loaded.
+        mailboxes = {
+            (box, receiver): (count, data)
+            for box, receiver, count, _, _, _, data in loaded.snapshot()["mailboxes"]
+        }
+        self.assertEqual(mailboxes[("undelivered", "b")][0], 1)
+        self.assertIsInstance(mailboxes[("undelivered", "b")][1], memoryview)
+        self.assertEqual(
+            message_store.decode_mailbox(mailboxes[("undelivered", "a")][1], ["c"]),
+            [(3, "c", "hi")],
+        )
+        self.assertEqual(loaded.to_dict()["undelivered"][0]["id"], 3)
+
+    def test_load_does_not_rewrite_corrupted_files(self):
+        path = database_wrapper.users_database_path(self.test_vm_id)
+        with open(path, "w") as f:
+            f.write("{not json")
+        users, _, _ = database_wrapper.load_database(self.test_vm_id)
+        self.assertEqual(users, {})
+        with open(path) as f:
+            self.assertEqual(f.read(), "{not json")
+
+    def test_compaction_drops_deleted_messages(self):
+        bodies = body_store.BodySegment(self.test_vm_id)
+        history = history_store.HistoryStore(
+            self.test_vm_id, hot_messages=2, page_size=2, bodies=bodies
+        )
+        store = message_store.MessageStore(history=history, bodies=bodies)
+        for msg_id in range(1, 9):
+            store.add(message_store.Message(msg_id, "a", "b", "x" * 100), "delivered")
+        self.assertEqual(store.body_bytes(), 8 * 102)
+        self.assertEqual(store.oldest_id("b"), 1)
+
+        store.delete("b", [1, 2, 3, 5, 6, 7])
+        self.assertGreater(store.garbage_ratio(), 0.5)
+        contents = store.to_dict()
+
+        store.compact()
+        self.assertEqual(store.to_dict(), contents)
+        self.assertLess(store.garbage_ratio(), 0.1)
+        self.assertEqual(store.bodies.generation, bodies.generation + 1)
+
+        # The next snapshot no longer refers to the old generations, which are removed.
+        database_wrapper.save_database(
+            self.test_vm_id, {}, store.snapshot(), {"counter": 8}
+        )
+        self.assertEqual(
+            body_store.list_generations(self.test_vm_id), [store.bodies.generation]
+        )
+        _, loaded, _ = database_wrapper.load_database(self.test_vm_id)
+        self.assertEqual(loaded.to_dict(), contents)
+
 
 # --- Unit Test for Client JSON Argument Parsing (client_json.py) ---
 class TestClientJson(unittest.TestCase):
@@ -0,0 +1,163 @@
+"""
+Timer Wheel Module
+
+This script implements a hierarchical timer wheel, used by the server to run callbacks at a
+given time from its selector loop (e.g. to expire messages) without scanning any list of
+pending work. Scheduling, cancelling and firing a timer are O(1) amortized, however many
+timers are pending.
+
+Key Features:
+- Rounds deadlines up to ticks of `tick` seconds and files each timer into a slot of one of
+  `levels` wheels of `slots` slots each. The first wheel covers the next `slots` ticks, and
+  each further wheel covers `slots` times more.
+- When the first wheel wraps around, the next slot of the wheel above is cascaded down, so
+  a timer is moved at most `levels` times before it fires.
+- Timers further away than the last wheel covers are parked in its furthest slot and filed
+  again once they are cascaded.
+- Cancelled timers are only flagged and are dropped when their slot is reached.
+- Reports how long the selector loop may block before the next tick that may have a timer
+  due, and skips ahead when no timer is pending.
+"""
+
+import math
+import time
+
+
+class Timer:
+    """
+    Callback scheduled on a TimerWheel. Cancel it with TimerWheel.cancel.
+    """
+
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel with a resolution of `tick` seconds. Timers only fire
+    from run_due, which the owner calls from its loop.
+    """
+
+    def __init__(self, tick=0.1, slots=64, levels=4, clock=time.monotonic):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.clock = clock
+
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.current_tick = self._tick_at(clock())
+        self.pending = 0
+
+    def __len__(self):
+        return self.pending
+
+    def _tick_at(self, now):
+        return int(now / self.tick)
+
+    def _place(self, timer):
+        """
+        Files a timer into the slot covering its deadline.
+        """
+        delta = timer.deadline - self.current_tick
+        level = 0
+        while level < self.levels - 1 and delta >= self.slots ** (level + 1):
+            level += 1
+
+        # Timers beyond the last wheel are parked in its furthest slot
+        deadline = min(timer.deadline, self.current_tick + self.slots**self.levels - 1)
+        index = (deadline // self.slots**level) % self.slots
+        self.wheels[level][index].append(timer)
+
+    def schedule(self, delay, callback, *args):
+        """
+        Schedules `callback(*args)` to run once `delay` seconds have passed, and returns
+        the timer.
+        """
+        deadline = math.ceil((self.clock() + delay) / self.tick)
+        timer = Timer(max(deadline, self.current_tick + 1), callback, args)
+        self._place(timer)
+        self.pending += 1
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancels a timer that has not fired yet.
+        """
+        if not timer.cancelled:
+            timer.cancelled = True
+            self.pending -= 1
+
+    def clear(self):
+        """
+        Cancels every pending timer.
+        """
+        for wheel in self.wheels:
+            for timers in wheel:
+                for timer in timers:
+                    timer.cancelled = True
+                timers.clear()
+        self.pending = 0
+
+    def _advance(self):
+        """
+        Moves to the next tick, cascading the wheels it wraps around, and returns the
+        timers of the slot it reaches.
+        """
+        self.current_tick += 1
+        for level in range(1, self.levels):
+            if self.current_tick % self.slots**level:
+                break
+            index = (self.current_tick // self.slots**level) % self.slots
+            timers, self.wheels[level][index] = self.wheels[level][index], []
+            for timer in timers:
+                if not timer.cancelled:
+                    self._place(timer)
+
+        index = self.current_tick % self.slots
+        timers, self.wheels[0][index] = self.wheels[0][index], []
+        return timers
+
+    def run_due(self):
+        """
+        Runs the callbacks of every timer that is due, and returns how many ran.
+        """
+        now_tick = self._tick_at(self.clock())
+        if not self.pending:
+            self.current_tick = max(self.current_tick, now_tick)
+            return 0
+
+        ran = 0
+        while self.current_tick < now_tick and self.pending:
+            for timer in self._advance():
+                if timer.cancelled:
+                    continue
+                if timer.deadline > self.current_tick:
+                    # A parked timer that is still too far away
+                    self._place(timer)
+                    continue
+                timer.cancelled = True
+                self.pending -= 1
+                timer.callback(*timer.args)
+                ran += 1
+        self.current_tick = max(self.current_tick, now_tick)
+        return ran
+
+    def timeout(self):
+        """
+        Returns how long the owner's loop may block before a timer may be due, or None if
+        no timer is pending. That is the next tick whose slot holds a timer, or the next
+        time the first wheel wraps around and the wheel above is cascaded into it.
+        """
+        if not self.pending:
+            return None
+
+        for offset in range(1, self.slots + 1):
+            tick = self.current_tick + offset
+            if tick % self.slots == 0 or self.wheels[0][tick % self.slots]:
+                break
+        return max(0.0, tick * self.tick - self.clock())